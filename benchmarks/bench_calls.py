@@ -0,0 +1,279 @@
+"""
+  Per-call overhead benchmark of generated kernels.
+
+  Calls the kernels of the test_scalar, test_array and test_mixed
+  extension modules (see xndtools/kernel_generator/tests) for each
+  argument intent and kernel kind, with contiguous, sliced and
+  Fortran-contiguous inputs of various sizes, and records the best
+  time per call. The kind of the called kernel is recorded when the
+  module collects kernel statistics.
+
+  The test modules must be built first:
+
+    python setup.py build_ext --inplace
+
+  Run (from the repository root) and compare two xndtools versions:
+
+    python benchmarks/bench_calls.py -o bench_calls-old.json
+    ...  # switch to another version of xndtools, rebuild
+    python benchmarks/bench_calls.py -o bench_calls-new.json
+    python benchmarks/bench_calls.py --compare bench_calls-old.json \\
+                                               bench_calls-new.json
+
+  To benchmark an earlier xndtools version, copy this script to its
+  source tree. Kernels missing from its test modules are skipped.
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+tests_dir = os.path.join(root_dir, 'xndtools', 'kernel_generator', 'tests')
+sys.path.insert(0, root_dir)
+
+# gumath must be imported prior the generated extension modules, see
+# tests/conftest.py
+import gumath  # noqa: E402, F401
+from xnd import xnd  # noqa: E402
+import xndtools  # noqa: E402
+from xndtools.kernel_generator.utils import NormalizedTypeMap  # noqa: E402
+
+long_t = NormalizedTypeMap()('long')
+
+
+def array(layout, size, ndim=1):
+    """Return zero array of given layout: contiguous, sliced (every
+    second item of the last dimension) or fortran.
+    """
+    if layout == 'scalar':
+        return xnd(0, type=long_t)
+    dims = ' * '.join([str(size)] * ndim)
+    if layout == 'contiguous':
+        return xnd.empty('{} * {}'.format(dims, long_t))
+    if layout == 'fortran':
+        return xnd.empty('!{} * {}'.format(dims, long_t))
+    if layout == 'sliced':
+        a = xnd.empty('{} * {} * {}'.format(dims, 2, long_t))
+        return a[(slice(None),) * ndim + (0,)]
+    raise ValueError(layout)
+
+
+# (module, kernel, intent, ndim or None for size argument, layouts)
+scalar_layouts = ['scalar', 'contiguous', 'sliced']
+vector_layouts = ['contiguous', 'sliced']
+matrix_layouts = ['contiguous', 'sliced', 'fortran']
+cases = [
+    ('test_scalar', 'test_scalar_input', 'input', 1, scalar_layouts),
+    ('test_scalar', 'test_scalar_inplace', 'inplace', 1, scalar_layouts),
+    ('test_scalar', 'test_scalar_inout', 'inout', 1, scalar_layouts),
+    ('test_scalar', 'test_scalar_input_output', 'input,output', 1,
+     scalar_layouts),
+    ('test_scalar', 'test_scalar_inplace_output', 'inplace,output', 1,
+     scalar_layouts),
+    ('test_scalar', 'test_scalar_ptr_input', 'input', 1, scalar_layouts),
+    ('test_scalar', 'test_scalar_ptr_inplace', 'inplace', 1, scalar_layouts),
+    ('test_scalar', 'test_scalar_return_input', 'input', 1, scalar_layouts),
+    ('test_array', 'test_array_range_input', 'input', 1, vector_layouts),
+    ('test_array', 'test_array_range_inplace', 'inplace', 1, vector_layouts),
+    ('test_array', 'test_array_range_inout', 'inout', 1, vector_layouts),
+    ('test_array', 'test_array_range_input_output', 'input,output', 1,
+     vector_layouts),
+    ('test_array', 'test_array_range_inplace_output', 'inplace,output', 1,
+     vector_layouts),
+    ('test_array', 'test_array_range_inout_output', 'inout,output', 1,
+     vector_layouts),
+    ('test_array', 'test_array_range_output', 'output', None, ['scalar']),
+    ('test_array', 'test_array_cumsum_input_strided', 'input', 1,
+     vector_layouts),
+    ('test_array', 'test_array_cumsum_inplace_strided', 'inplace', 1,
+     vector_layouts),
+    ('test_array', 'test_array_cumsum_input_output_strided', 'input,output',
+     1, vector_layouts),
+    ('test_array', 'test_array_cumsum_incx_input', 'input', 1,
+     vector_layouts),
+    ('test_array', 'test_array_ranges_input', 'input', 2, matrix_layouts),
+    ('test_mixed', 'test_mixed_matrices_inout_CC', 'inout', 2,
+     matrix_layouts),
+    ('test_mixed', 'test_mixed_matrices_inout_FF', 'inout', 2,
+     matrix_layouts),
+    ('test_mixed', 'test_mixed_matrices_input_CF', 'input', 2,
+     matrix_layouts),
+]
+
+wrapper_kind_match = re.compile(r'_(?:symbolic|variable)_([A-Za-z]+)_').search
+
+
+def called_kinds(module, func, args):
+    """Call func(*args) and return the kinds of called kernels, or None
+    when the module does not collect kernel statistics.
+    """
+    if not hasattr(module, '_kernel_stats'):  # earlier xndtools versions
+        func(*args)
+        return None
+    module._reset_kernel_stats()
+    func(*args)
+    stats = module._kernel_stats()
+    if not stats:
+        return None
+    kinds = set()
+    for name, item in stats.items():
+        if item['calls']:
+            match = wrapper_kind_match(name)
+            kinds.add(match.group(1) if match else name)
+    return ','.join(sorted(kinds))
+
+
+def timeit(func, args, repeat, min_time):
+    """Return times (in seconds) per call of func(*args) over repeats.
+    """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            func(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 10
+    times = [elapsed / number]
+    for r in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(number):
+            func(*args)
+        times.append((time.perf_counter() - start) / number)
+    return times, number
+
+
+def run(args):
+    sys.path.insert(0, tests_dir)
+    modules = {}
+    results = []
+    for module_name, kernel, intent, ndim, layouts in cases:
+        if module_name not in modules:
+            modules[module_name] = __import__(module_name)
+        module = modules[module_name]
+        func = getattr(module, kernel, None)
+        if func is None:  # kernel of a newer xndtools version
+            print('{}.{}: not found, skipping'.format(module_name, kernel),
+                  flush=True)
+            continue
+        for layout in layouts:
+            for size in ([None] if layout == 'scalar' else args.sizes):
+                if ndim is None:
+                    call_args = (xnd(size or 1, type=long_t),)
+                elif ndim == 2 and size is not None:
+                    # matrices of about size items
+                    side = max(1, int(round(size ** 0.5)))
+                    call_args = (array(layout, side, 2),)
+                    if module_name == 'test_mixed':
+                        call_args = call_args * 2
+                else:
+                    call_args = (array(layout, size, ndim),)
+                result = dict(module=module_name, kernel=kernel,
+                              intent=intent, layout=layout, size=size)
+                try:
+                    result['kind'] = called_kinds(module, func, call_args)
+                except Exception as msg:
+                    # e.g. intent inout arguments with wrong layout
+                    result['error'] = '{}: {}'.format(type(msg).__name__, msg)
+                else:
+                    times, number = timeit(func, call_args, args.repeat,
+                                           args.min_time)
+                    result.update(time_ns=min(times) * 1e9,
+                                  median_ns=statistics.median(times) * 1e9,
+                                  number=number)
+                results.append(result)
+                print('{module}.{kernel}[{layout}, size={size}]:'
+                      ' {0}'.format(
+                          '{} {:.0f} ns'.format(result['kind'],
+                                                result['time_ns'])
+                          if 'time_ns' in result else result['error'],
+                          **result), flush=True)
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=root_dir,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    return (result['module'], result['kernel'], result['layout'],
+            result['size'])
+
+
+def compare(base_file, new_file):
+    """Print the ratios of call times in new_file and base_file.
+    """
+    with open(base_file) as f:
+        base = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    print('base: xndtools {} ({})'.format(base['xndtools'], base['git']))
+    print('new:  xndtools {} ({})'.format(new['xndtools'], new['git']))
+    base_results = {case_key(r): r for r in base['results']}
+    ratios = []
+    for r in new['results']:
+        b = base_results.get(case_key(r))
+        if b is None or 'time_ns' not in b or 'time_ns' not in r:
+            continue
+        ratio = r['time_ns'] / b['time_ns']
+        ratios.append(ratio)
+        print('{:>8.0f} {:>8.0f} ns {:6.2f}x  {}.{}[{}, size={}]'.format(
+            b['time_ns'], r['time_ns'], ratio, *case_key(r)))
+    if ratios:
+        # statistics.geometric_mean requires Python 3.8
+        print('geometric mean of new/base: {:.3f}'.format(
+            math.exp(sum(map(math.log, ratios)) / len(ratios))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1, 10, 100, 1000, 10000, 100000],
+                        help='Numbers of array items. Default is 1 10 100'
+                        ' 1000 10000 100000.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timings per case. Default is 5.')
+    parser.add_argument('--min-time', type=float, default=0.02,
+                        help='Minimal duration of a timing in seconds.'
+                        ' Default is 0.02.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Path to JSON output. Default is stdout.')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='Compare two JSON outputs and exit.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = dict(xndtools=getattr(xndtools, '__version__', 'unknown'),
+                  git=git_revision(),
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  repeat=args.repeat,
+                  results=run(args))
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('results are written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+/*
+  Microbenchmark of xndtools strided copies.
+
+  Compares the xndtools_cpy/xndtools_invcpy copy engine against the
+  original recursive implementation (included below as legacy_cpy and
+  legacy_invcpy) for various shapes and layouts, and checks the
+  results against a naive element-wise reference.
+
+  Build and run (from the repository root):
+
+    NDT=$(python -c "import ndtypes,os;print(os.path.dirname(ndtypes.__file__))")
+    XND=$(python -c "import xnd,os;print(os.path.dirname(xnd.__file__))")
+    cc -O2 -std=c11 -I$NDT -I$XND -Ixndtools/kernel_generator \
+       benchmarks/bench_copy.c xndtools/kernel_generator/xndtools.c \
+       -L$NDT -L$XND -Wl,-rpath,$NDT -Wl,-rpath,$XND -lxnd -lndtypes \
+       -o bench_copy
+    ./bench_copy
+*/
+
+#define _POSIX_C_SOURCE 199309L  /* clock_gettime */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "xndtools.h"
+
+/*
+  The recursive implementation of xndtools_cpy/xndtools_invcpy that
+  the copy engine replaces. Note that for non-contiguous arrays with
+  more than one dimension the Fortran copies are in C order.
+ */
+
+static int legacy_cpy(char* dest, const xnd_t* stack_ptr, bool fortran) {
+  int ndim = xnd_ndim(stack_ptr);
+  int64_t itemsize = stack_ptr->type->Concrete.FixedDim.itemsize;
+  char* ptr0 = stack_ptr->ptr + stack_ptr->index * itemsize;
+  if (ndim==0) {
+    memcpy(dest, ptr0, itemsize);
+    return itemsize;
+  } else if (!fortran && ndt_is_c_contiguous(stack_ptr->type)) {
+    int64_t nbytes = xndtools_fixed_nbytes(stack_ptr);
+    memcpy(dest, ptr0, nbytes);
+    return nbytes;
+  } else if (fortran && ndt_is_f_contiguous(stack_ptr->type)) {
+    int64_t nbytes = xndtools_fixed_nbytes(stack_ptr);
+    memcpy(dest, ptr0, nbytes);
+    return nbytes;
+  } else if (ndim>1) {
+    int64_t N = xnd_fixed_shape_at(stack_ptr, 0);
+    int64_t N1 = 1;
+    for (int64_t i=0; i<N; i++) {
+      xnd_t row = xnd_fixed_dim_next(stack_ptr, i);
+      N1 = legacy_cpy(dest + N1*i, &row, fortran);
+    }
+    return N * N1;
+  } else if (ndim==1) {
+    int64_t N = xnd_fixed_shape_at(stack_ptr, 0);
+    int64_t step = stack_ptr->type->Concrete.FixedDim.step * itemsize;
+    double* out = (double*)dest;
+    for (int64_t i=0; i< N; i++)
+      out[i] = *(const double*)(ptr0+i*step);
+    return N*itemsize;
+  }
+  return -1;
+}
+
+static int legacy_invcpy(const char* src, const xnd_t* stack_ptr, bool fortran) {
+  int ndim = xnd_ndim(stack_ptr);
+  int64_t itemsize = stack_ptr->type->Concrete.FixedDim.itemsize;
+  char* ptr0 = stack_ptr->ptr + stack_ptr->index * itemsize;
+  if (ndim==0) {
+    memcpy(ptr0, src, itemsize);
+    return itemsize;
+  } else if (!fortran && ndt_is_c_contiguous(stack_ptr->type)) {
+    int64_t nbytes = xndtools_fixed_nbytes(stack_ptr);
+    memcpy(ptr0, src, nbytes);
+    return nbytes;
+  } else if (fortran && ndt_is_f_contiguous(stack_ptr->type)) {
+    int64_t nbytes = xndtools_fixed_nbytes(stack_ptr);
+    memcpy(ptr0, src, nbytes);
+    return nbytes;
+  } else if (ndim>1) {
+    int64_t N = xnd_fixed_shape_at(stack_ptr, 0);
+    int64_t N1 = 1;
+    for (int64_t i=0; i<N; i++) {
+      xnd_t row = xnd_fixed_dim_next(stack_ptr, i);
+      N1 = legacy_invcpy(src + N1*i, &row, fortran);
+    }
+    return N * N1;
+  } else if (ndim==1) {
+    int64_t N = xnd_fixed_shape_at(stack_ptr, 0);
+    int64_t step = stack_ptr->type->Concrete.FixedDim.step * itemsize;
+    const double* in = (const double*)src;
+    for (int64_t i=0; i< N; i++)
+      *(double*)(ptr0+i*step) = in[i];
+    return N*itemsize;
+  }
+  return -1;
+}
+
+/*
+  A float64 view into a base array: shape and steps are in items,
+  offset is the index of the first item.
+ */
+typedef struct {
+  const char* name;
+  int ndim;
+  int64_t shape[3];
+  int64_t steps[3];
+  int64_t offset;
+  bool fortran;
+} bench_case_t;
+
+static xnd_t make_view(const bench_case_t* c, char* base, ndt_context_t* ctx) {
+  xnd_t x;
+  ndt_t* t = ndt_primitive(Float64, 0, ctx);
+  for (int i=c->ndim-1; i>=0; i--)
+    t = ndt_fixed_dim(t, c->shape[i], c->steps[i], ctx);
+  x.bitmap = xnd_bitmap_empty;
+  x.index = c->offset;
+  x.type = t;
+  x.ptr = base;
+  return x;
+}
+
+/* Element-wise reference copy, item of buffer index n. */
+static void reference_cpy(double* dest, const double* base, const bench_case_t* c) {
+  int64_t idx[3] = {0, 0, 0};
+  int64_t nitems = 1;
+  for (int i=0; i<c->ndim; i++)
+    nitems *= c->shape[i];
+  for (int64_t n=0; n<nitems; n++) {
+    int64_t r = n;
+    for (int k=0; k<c->ndim; k++) {
+      int i = (c->fortran ? k : c->ndim - 1 - k);
+      idx[i] = r % c->shape[i];
+      r /= c->shape[i];
+    }
+    int64_t pos = c->offset;
+    for (int i=0; i<c->ndim; i++)
+      pos += idx[i] * c->steps[i];
+    dest[n] = base[pos];
+  }
+}
+
+static double now(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + 1e-9 * ts.tv_nsec;
+}
+
+#define N1 (1 << 20)
+#define N2 1024
+
+int main(void) {
+  bench_case_t cases[] = {
+    {"1d contiguous", 1, {N1}, {1}, 0, false},
+    {"1d step 2", 1, {N1 / 2}, {2}, 0, false},
+    {"1d step -1", 1, {N1}, {-1}, N1 - 1, false},
+    {"2d C contiguous", 2, {N2, N2}, {N2, 1}, 0, false},
+    {"2d row slice [:, 1:-1]", 2, {N2, N2 - 2}, {N2, 1}, 1, false},
+    {"2d column step [:, ::2]", 2, {N2, N2 / 2}, {N2, 2}, 0, false},
+    {"2d reversed rows [::-1]", 2, {N2, N2}, {-N2, 1}, N2 * (N2 - 1), false},
+    {"2d C to Fortran", 2, {N2, N2}, {N2, 1}, 0, true},
+    {"2d transposed to C", 2, {N2, N2}, {1, N2}, 0, false},
+    {"3d inner slice", 3, {64, 128, 126}, {128 * 128, 128, 1}, 1, false},
+    {"3d C to Fortran", 3, {64, 128, 128}, {128 * 128, 128, 1}, 0, true},
+  };
+  int ncases = sizeof(cases) / sizeof(cases[0]);
+  int repeat = 20;
+  int64_t nbase = 2 * N1;
+  ndt_context_t* ctx = ndt_context_new();
+  double* base = (double*)malloc(nbase * sizeof(double));
+  double* buf = (double*)malloc(nbase * sizeof(double));
+  double* ref = (double*)malloc(nbase * sizeof(double));
+  int status = 0;
+  if (ctx == NULL || base == NULL || buf == NULL || ref == NULL) {
+    fprintf(stderr, "bench_copy: failed to allocate memory\n");
+    return 1;
+  }
+  for (int64_t i=0; i<nbase; i++)
+    base[i] = (double)i;
+
+  printf("%-26s %12s %12s %8s %8s\n", "case", "legacy [ms]", "new [ms]", "speedup", "check");
+  for (int c=0; c<ncases; c++) {
+    xnd_t x = make_view(&cases[c], (char*)base, ctx);
+    if (x.type == NULL) {
+      fprintf(stderr, "bench_copy: %s: %s\n", cases[c].name, ndt_context_msg(ctx));
+      return 1;
+    }
+    int64_t nbytes = xndtools_fixed_nbytes(&x);
+
+    /* correctness of copy and inverse copy */
+    reference_cpy(ref, base, &cases[c]);
+    memset(buf, 0, nbytes);
+    xndtools_cpy((char*)buf, &x, cases[c].fortran);
+    bool ok = (memcmp(buf, ref, nbytes) == 0);
+    for (int64_t i=0; i<nbytes / 8; i++)
+      buf[i] = -buf[i];
+    xndtools_invcpy((const char*)buf, &x, cases[c].fortran);
+    reference_cpy(ref, base, &cases[c]);
+    for (int64_t i=0; i<nbytes / 8 && ok; i++)
+      ok = (ref[i] == buf[i]);
+    for (int64_t i=0; i<nbase; i++)
+      base[i] = (double)i;
+    status |= !ok;
+
+    double t0 = now();
+    for (int r=0; r<repeat; r++) {
+      legacy_cpy((char*)buf, &x, cases[c].fortran);
+      legacy_invcpy((const char*)buf, &x, cases[c].fortran);
+    }
+    double t1 = now();
+    for (int r=0; r<repeat; r++) {
+      xndtools_cpy((char*)buf, &x, cases[c].fortran);
+      xndtools_invcpy((const char*)buf, &x, cases[c].fortran);
+    }
+    double t2 = now();
+    printf("%-26s %12.3f %12.3f %7.2fx %8s\n", cases[c].name,
+	   1e3 * (t1 - t0) / repeat, 1e3 * (t2 - t1) / repeat,
+	   (t1 - t0) / (t2 - t1), (ok ? "ok" : "FAILED"));
+    ndt_del((ndt_t*)x.type);
+  }
+  free(base);
+  free(buf);
+  free(ref);
+  ndt_context_del(ctx);
+  return status;
+}
@@ -0,0 +1,237 @@
+"""
+  Import-time benchmark of generated extension modules.
+
+  Generates synthetic kernel configurations with 10, 100, 1000 and
+  10000 kernels, builds the extension modules with eager (default)
+  and lazy (`lazy: true`) kernel registration, and reports:
+
+    generate_time    - generation of the kernels and module C sources
+                       (what `xnd_tools module` does)
+    build_time       - compilation of the extension module
+    import_time      - `import <module>` after ndtypes, xnd and gumath
+                       are imported (median over repeats)
+    table_time       - gmk_init_<module>_kernels: typemap checks and
+                       gm_add_kernel of all kernels
+    gufuncs_time     - gufunc objects creation, estimated as eager
+                       import_time - lazy import_time - table_time
+    typemaps_time    - typemap checks (lazy modules only)
+    first_call_time  - first access of a kernel (lazy modules only)
+
+  The results are written in JSON for regression tracking.
+
+  Run (from the repository root):
+
+    python benchmarks/bench_import.py -o bench_import.json
+    python benchmarks/bench_import.py --sizes 10 100 --repeat 3
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+from setuptools import Distribution, Extension
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+import xndtools  # noqa: E402
+from xndtools.kernel_generator.generate_kernel import generate_kernel  # noqa: E402
+from xndtools.kernel_generator.generate_module import generate_module  # noqa: E402
+
+header_source = '''\
+extern double bench_scale(double x);
+'''
+
+c_source = '''\
+double bench_scale(double x) { return 2.0 * x; }
+'''
+
+module_config = '''\
+[MODULE {module}]
+includes:
+\tbench_import.h
+include_dirs:
+\t.
+sources:
+\tbench_import.c
+kinds: Xnd
+ellipses: none
+build: lean
+shards: {shards}
+lazy: {lazy}
+'''
+
+kernel_config = '''
+[KERNEL {kernel}]
+prototypes:
+\tdouble bench_scale(double x);
+description: scale x by 2
+input: x
+'''
+
+# Executed in a fresh process, prints JSON of timings.
+import_code = '''
+import sys, time, json, ctypes
+import ndtypes, xnd, gumath
+sys.path.insert(0, {build_dir!r})
+start = time.perf_counter()
+import {module} as m
+result = dict(import_time=time.perf_counter() - start)
+
+lib = ctypes.CDLL(m.__file__)
+lib.ndt_context_new.restype = ctypes.c_void_p
+lib.gm_tbl_new.restype = ctypes.c_void_p
+lib.gm_tbl_new.argtypes = [ctypes.c_void_p]
+init = lib.gmk_init_{module}_kernels
+init.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+ctx = lib.ndt_context_new()
+tbl = lib.gm_tbl_new(ctx)
+start = time.perf_counter()
+assert init(tbl, ctx) == 0
+result['table_time'] = time.perf_counter() - start
+
+if {lazy}:
+    add = lib.gmk_add_{module}_kernel
+    add.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p]
+    tbl = lib.gm_tbl_new(ctx)
+    # the first call runs the typemap checks
+    times = []
+    for i in range(2):
+        start = time.perf_counter()
+        assert add(tbl, b'', ctx) == 0
+        times.append(time.perf_counter() - start)
+    result['typemaps_time'] = times[0] - times[1]
+    start = time.perf_counter()
+    m.bench_0
+    result['first_call_time'] = time.perf_counter() - start
+print(json.dumps(result))
+'''
+
+
+def write_config(work_dir, module, nkernels, lazy, shards):
+    for filename, source in [('bench_import.h', header_source),
+                             ('bench_import.c', c_source)]:
+        with open(os.path.join(work_dir, filename), 'w') as f:
+            f.write(source)
+    config_file = os.path.join(work_dir, module + '-kernels.cfg')
+    with open(config_file, 'w') as f:
+        f.write(module_config.format(module=module, shards=shards,
+                                     lazy=str(lazy).lower()))
+        for i in range(nkernels):
+            f.write(kernel_config.format(kernel='bench_{}'.format(i)))
+    return config_file
+
+
+def generate(config_file, source_dir, jobs):
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        r = generate_kernel(config_file, source_dir=source_dir, cache=False,
+                            jobs=jobs)
+        return generate_module(config_file, source_dir=source_dir,
+                               sources=r['sources'], cache=False)
+
+
+def build(m, build_dir, jobs):
+    ext = Extension(m['extname'],
+                    include_dirs=m['include_dirs'],
+                    library_dirs=m['library_dirs'],
+                    libraries=m['libraries'],
+                    sources=m['sources'],
+                    extra_compile_args=['-std=c11'])
+    dist = Distribution(dict(ext_modules=[ext]))
+    cmd = dist.get_command_obj('build_ext')
+    cmd.build_lib = build_dir
+    cmd.build_temp = os.path.join(build_dir, 'temp')
+    cmd.parallel = jobs
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        dist.run_command('build_ext')
+
+
+def measure_import(build_dir, module, lazy, repeat):
+    code = import_code.format(build_dir=build_dir, module=module, lazy=lazy)
+    results = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code])
+        results.append(json.loads(output.decode().splitlines()[-1]))
+    return {key: statistics.median(r[key] for r in results)
+            for key in results[0]}
+
+
+def bench(nkernels, lazy, args):
+    module = 'bench_import_{}{}'.format(nkernels, '_lazy' if lazy else '')
+    work_dir = os.path.join(args.work_dir, module)
+    build_dir = os.path.join(work_dir, 'build')
+    os.makedirs(build_dir, exist_ok=True)
+    config_file = write_config(work_dir, module, nkernels, lazy, args.shards)
+    print('{}: generating'.format(module), flush=True)
+    start = time.perf_counter()
+    m = generate(config_file, work_dir, args.jobs)
+    generate_time = time.perf_counter() - start
+    print('{}: building'.format(module), flush=True)
+    start = time.perf_counter()
+    build(m, build_dir, args.jobs)
+    build_time = time.perf_counter() - start
+    print('{}: importing'.format(module), flush=True)
+    result = dict(kernels=nkernels, lazy=lazy, generate_time=generate_time,
+                  build_time=build_time)
+    result.update(measure_import(build_dir, module, lazy, args.repeat))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 1000, 10000],
+                        help='Numbers of kernels. Default is 10 100 1000'
+                        ' 10000.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of imports (in fresh processes) per'
+                        ' module. Default is 5.')
+    parser.add_argument('--shards', type=int, default=os.cpu_count() or 1,
+                        help='Number of kernels C sources. Default is the'
+                        ' number of processors.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of generator processes and parallel'
+                        ' compilations. Default is the number of processors.')
+    parser.add_argument('--work-dir', default=None,
+                        help='Directory of generated and built files.'
+                        ' Default is a new temporary directory.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Path to JSON output. Default is stdout.')
+    args = parser.parse_args()
+    if args.work_dir is None:
+        args.work_dir = tempfile.mkdtemp(prefix='bench_import-')
+    args.work_dir = os.path.abspath(args.work_dir)
+    print('work directory is {}'.format(args.work_dir), flush=True)
+
+    results = []
+    for nkernels in args.sizes:
+        eager = bench(nkernels, False, args)
+        lazy = bench(nkernels, True, args)
+        eager['gufuncs_time'] = (eager['import_time'] - lazy['import_time']
+                                 - eager['table_time'])
+        results.extend([eager, lazy])
+
+    report = dict(xndtools=xndtools.__version__,
+                  python=platform.python_version(),
+                  platform=platform.platform(),
+                  repeat=args.repeat,
+                  shards=args.shards,
+                  results=results)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('results are written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
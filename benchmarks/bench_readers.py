@@ -0,0 +1,167 @@
+"""
+  Benchmark of PrototypeReader on large vendor headers.
+
+  Reads the C function prototypes of the headers that
+  `xndtools/kernel_generator/readers.py` is tested on (MKL headers
+  under $MKLROOT/include and sqlite3.h) with the same reader options
+  and exclude patterns, and reports the number of prototypes and the
+  best read time per header.
+
+  With --reference, the headers are also read with the PrototypeReader
+  of another xndtools source tree (for instance, a checkout of an
+  earlier version) and the prototypes are required to be identical.
+
+  Run (from the repository root):
+
+    python benchmarks/bench_readers.py
+    python benchmarks/bench_readers.py --reference ../xndtools-old \\
+                                       /usr/include/*.h
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import platform
+import importlib.util
+from glob import glob
+from contextlib import redirect_stdout
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+import xndtools  # noqa: E402
+from xndtools.kernel_generator.readers import PrototypeReader  # noqa: E402
+
+# see readers._main
+reader_options = dict(
+    extra_specifiers=['DEPRECATED', 'LAPACK_DECL', 'MKL_DECLSPEC',
+                      'DFTI_EXTERN', 'SQLITE_API', 'SQLITE_DEPRECATED',
+                      'SQLITE_EXPERIMENTAL', 'MODULE_SCOPE'],
+    extra_conventions=['MKL_CALL_CONV', 'SQLITE_STDCALL'],
+)
+exclude_patterns = [r'.*_work\Z', r'.*_\Z', r'\A[A-Z0-9_]+\Z']
+
+
+def default_headers():
+    include_dirs = [os.path.join(sys.prefix, 'include'), '/usr/include']
+    mklroot = os.environ.get('MKLROOT')
+    if mklroot:
+        include_dirs.insert(0, os.path.join(mklroot, 'include'))
+    headers = []
+    for name in ['mkl_lapacke.h', 'mkl_cblas.h', 'mkl_blas.h', 'mkl_vml.h',
+                 'mkl_dfti.h', 'sqlite3.h']:
+        for d in include_dirs:
+            filename = os.path.join(d, name)
+            if os.path.isfile(filename):
+                headers.append(filename)
+                break
+    return headers
+
+
+def load_reader(source_tree):
+    """Return PrototypeReader class of xndtools source tree.
+    """
+    # readers.py imports .utils relatively, so load the package
+    path = os.path.join(source_tree, 'xndtools', 'kernel_generator')
+    spec = importlib.util.spec_from_file_location(
+        '_reference_kernel_generator', os.path.join(path, '__init__.py'),
+        submodule_search_locations=[path])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = package
+    spec.loader.exec_module(package)
+    return __import__(spec.name + '.readers',
+                      fromlist=['PrototypeReader']).PrototypeReader
+
+
+def read(reader_class, source, repeat):
+    """Return prototypes of source and the best read time.
+    """
+    times = []
+    for i in range(repeat):
+        # a fresh reader as the readers collect type names
+        reader = reader_class(**reader_options)
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            start = time.perf_counter()
+            prototypes = reader(source, exclude_patterns=exclude_patterns)
+            times.append(time.perf_counter() - start)
+    return prototypes, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('headers', nargs='*',
+                        help='Header files. Default is MKL headers and'
+                        ' sqlite3.h, when found.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of reads per header. Default is 5.')
+    parser.add_argument('--reference', default=None,
+                        help='Path to xndtools source tree of the reference'
+                        ' PrototypeReader.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Path to JSON output.')
+    args = parser.parse_args()
+    headers = [h for pattern in args.headers for h in glob(pattern)]
+    if not args.headers:
+        headers = default_headers()
+    if not headers:
+        parser.error('no header files found, specify these in arguments')
+    reference = load_reader(args.reference) if args.reference else None
+
+    results = []
+    for filename in headers:
+        with open(filename, errors='replace') as f:
+            source = f.read()
+        result = dict(header=filename, size=len(source))
+        try:
+            prototypes, result['time'] = read(PrototypeReader, source,
+                                              args.repeat)
+        except Exception as msg:
+            result['error'] = '{}: {}'.format(type(msg).__name__, msg)
+            prototypes = msg
+        else:
+            result['prototypes'] = len(prototypes)
+        if reference is not None:
+            try:
+                ref_prototypes, result['reference_time'] = read(
+                    reference, source, args.repeat)
+            except Exception as msg:
+                ref_prototypes = msg
+            if isinstance(prototypes, Exception):
+                same = repr(prototypes) == repr(ref_prototypes)
+            else:
+                same = (not isinstance(ref_prototypes, Exception)
+                        and list(map(dict, prototypes))
+                        == list(map(dict, ref_prototypes)))
+            if not same:
+                sys.exit('{}: prototypes differ from reference'
+                         .format(filename))
+        results.append(result)
+        if 'error' in result:
+            message = result['error']
+        else:
+            message = '{prototypes} prototypes in {time:.4f} s'.format(
+                **result)
+        if 'reference_time' in result:
+            message += ' (reference: {:.4f} s)'.format(
+                result['reference_time'])
+        print('{}: {}'.format(filename, message), flush=True)
+
+    total = sum(r.get('time', 0) for r in results)
+    print('total: {:.4f} s'.format(total))
+    if reference is not None:
+        print('total reference: {:.4f} s'.format(
+            sum(r.get('reference_time', 0) for r in results)))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(dict(xndtools=xndtools.__version__,
+                           python=platform.python_version(),
+                           platform=platform.platform(),
+                           repeat=args.repeat,
+                           results=results), f, indent=1)
+        print('results are written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
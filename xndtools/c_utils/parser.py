@@ -1,8 +1,22 @@
 import re
 
 
-def get_c_blocks(source, _wdir=dict(counter=0, blocks={})):
-    """ Recursively replace all {}-blocks with generated keys.
+# `{`, `}`, or a token that may contain braces: a string or character
+# literal, or a comment
+_block_tokens = re.compile(r'[{}]'
+                           r'|"(?:[^"\\\n]|\\.)*"'
+                           r"|'(?:[^'\\\n]|\\.)*'"
+                           r'|//[^\n]*|/[*].*?[*]/', re.DOTALL).finditer
+
+
+def get_c_blocks(source):
+    """ Replace all {}-blocks with generated keys.
+
+    The blocks are found in one pass over the source. Braces in string
+    and character literals and in comments are not block delimiters,
+    and an unmatched `}` is left in the source. The keys are numbered
+    in the order of closing braces, so that a block is replaced with a
+    key after the blocks that it contains.
 
     Parameters
     ----------
@@ -14,29 +28,42 @@ def get_c_blocks(source, _wdir=dict(counter=0, blocks={})):
     new_source : str
       Source with elimanted {}-blocks
     blocks : dict
-      Mapping of keys and {}-blocks.
+      Mapping of keys and {}-blocks, the {}-blocks contain the keys
+      of nested {}-blocks.
     """
-    block_re = r'{[^{}]*}'
+    blocks = {}
+    stack = [[]]  # parts of the source and of the open blocks
+    pos = 0
+    for m in _block_tokens(source):
+        token = m.group(0)
+        if token == '{':
+            stack[-1].append(source[pos:m.start()])
+            stack.append(['{'])
+        elif token == '}' and len(stack) > 1:
+            stack[-1].append(source[pos:m.end()])
+            key = '@@@{}@@@'.format(len(blocks) + 1)
+            blocks[key] = ''.join(stack.pop())
+            stack[-1].append(key)
+        else:
+            continue
+        pos = m.end()
+    if len(stack) > 1:
+        raise ValueError('get_c_blocks: {} unclosed {{-block(s)'
+                         .format(len(stack) - 1))
+    stack[-1].append(source[pos:])
+    return ''.join(stack[-1]), blocks
+
 
-    def block_repl(m):
-        block = source[slice(*m.span())]
-        _wdir['counter'] += 1
-        key = '@@@{counter}@@@'.format_map(_wdir)
-        _wdir['blocks'][key] = block
-        return key
-    new_source = re.sub(block_re, block_repl, source, re.MULTILINE | re.DOTALL)
-    if '{' in new_source:
-        return get_c_blocks(new_source, _wdir=_wdir)
-    return new_source, _wdir['blocks']
+_enum_findall = re.compile(r'enum\s+([a-zA-Z_]\w*)\s*(@@@\d+@@@)\s*;',
+                           re.MULTILINE | re.DOTALL).findall
 
 
 def get_enums(source):
     """ Return a dictionary of C enum definitions.
     """
     source, blocks = get_c_blocks(source)
-    enum_re = r'enum\s+([a-zA-Z_]\w*)\s*(@@@\d+@@@)\s*;'
     enums = {}
-    for name, key in re.findall(enum_re, source, re.MULTILINE | re.DOTALL):
+    for name, key in _enum_findall(source):
         block = blocks[key]
         enums[name] = list(map(str.strip, block[1:-1].split(',')))
     return enums
@@ -53,25 +80,26 @@ def _normalize_typespec(typespec):
     return r
 
 
+_union_match = re.compile(r'union\s*(@@@\d+@@@)').match
+_rname_match = re.compile(r'\w*[a-zA-Z_]').match  # reversed name
+_struct_match = re.compile(r'struct\s*(@@@\d+@@@)\s*([a-zA-Z_]\w*)').match
+
+
 def _get_block_items(block, blocks):  # helper function for get_structs
-    union_match = re.compile(r'union\s*(@@@\d+@@@)').match
-    rname_re = r'\w*[a-zA-Z_]'  # reversed name
-    rname_match = re.compile(rname_re).match
-    struct_match = re.compile(r'struct\s*(@@@\d+@@@)\s*([a-zA-Z_]\w*)').match
     items = []
     for stmt in block[1:-1].split(';')[:-1]:
         stmt = stmt.strip()
         if stmt.startswith('PyObject_HEAD'):
             items.append('PyObject_HEAD')
             stmt = stmt.split(None, 1)[1]
-        m = union_match(stmt)
+        m = _union_match(stmt)
         if m is not None:
             print('found union!')
             key,  = m.groups()
             items.append(('union',
                           _get_block_items(blocks[key], blocks)))
             continue
-        m = struct_match(stmt)
+        m = _struct_match(stmt)
         if m is not None:
             key, name = m.groups()
             items.append(('struct',
@@ -83,7 +111,7 @@ def _get_block_items(block, blocks):  # helper function for get_structs
             size = stmt[i+1:-1].strip()
             stmt = stmt[:i]
         print('=======', stmt)
-        name = rname_match(stmt[::-1]).group(0)[::-1].strip()
+        name = _rname_match(stmt[::-1]).group(0)[::-1].strip()
         assert name is not None, repr(stmt)
         typespec = stmt[:-len(name)].strip()
         if typespec.startswith('alignas'):
@@ -93,14 +121,34 @@ def _get_block_items(block, blocks):  # helper function for get_structs
     return items
 
 
+_extern_C_sub = re.compile(r'extern\s+["]C["]\s*(@@@\d+@@@)',
+                           re.MULTILINE | re.DOTALL).sub
+
+
 def expand_extern_C(source, blocks):
-    extern_C_re = r'extern\s+["]C["]\s*(@@@\d+@@@)'
 
     def repl(m):
         key, = m.groups()
         return 'extern "C" ' + blocks[key]
 
-    return re.sub(extern_C_re, repl, source, flags=re.MULTILINE | re.DOTALL)
+    return _extern_C_sub(repl, source)
+
+
+_struct_patterns = [
+    # `typedef struct word1 word2;`   key=word1, name=word2;
+    #                                 word1 will be replaced with word2
+    r'typedef\s+struct\s*([a-zA-Z_]\w*)\s+([a-zA-Z_]\w*)\s*;',
+    # `typedef struct {...} word2;`   key={...}, name=word2
+    r'typedef\s+struct\s*(@@@\d+@@@)\s*([a-zA-Z_]\w*)\s*;',
+    # `typedef struct word1 {...} word2;`  key={...}, name=word2;
+    #                                      word1 is unused
+    r'typedef\s+struct\s*[a-zA-Z_]\w*\s*(@@@\d+@@@)\s*([a-zA-Z_]\w*)\s*;',
+    # `struct word1 {...}`            key=word1, name={...};
+    #                                 needs a key-name swap
+    r'struct\s+([a-zA-Z_]\w*)\s*(@@@\d+@@@)\s*;'
+]
+_struct_findall = re.compile('|'.join(_struct_patterns),
+                             re.MULTILINE | re.DOTALL).findall
 
 
 def get_structs(source):
@@ -109,19 +157,8 @@ def get_structs(source):
     source, blocks = get_c_blocks(source)
     source = expand_extern_C(source, blocks)
 
-    struct_patterns = [
-        # `typedef struct word1 word2;`   key=word1, name=word2; word1 will be replaced with word2
-        r'typedef\s+struct\s*([a-zA-Z_]\w*)\s+([a-zA-Z_]\w*)\s*;',
-        # `typedef struct {...} word2;`   key={...}, name=word2
-        r'typedef\s+struct\s*(@@@\d+@@@)\s*([a-zA-Z_]\w*)\s*;',
-        # `typedef struct word1 {...} word2;`  key={...}, name=word2; word1 is unused
-        r'typedef\s+struct\s*[a-zA-Z_]\w*\s*(@@@\d+@@@)\s*([a-zA-Z_]\w*)\s*;',
-        # `struct word1 {...}`            key=word1, name={...}; needs a key-name swap
-        r'struct\s+([a-zA-Z_]\w*)\s*(@@@\d+@@@)\s*;'
-    ]
     structs = {}
-    for r in re.findall('|'.join(struct_patterns), source,
-                        re.MULTILINE | re.DOTALL):
+    for r in _struct_findall(source):
         key, name = filter(bool, r)
         if name[0] == '@':                         # swap
             key, name = name, key
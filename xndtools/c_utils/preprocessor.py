@@ -1,30 +1,129 @@
 import os
 import re
+import json
+import shlex
+import hashlib
+import tempfile
 import subprocess
 import shutil
 
 
-def preprocess(source, include_dirs=[], skip_includes=[], use_compiler=False):
+def preprocess(source, include_dirs=[], skip_includes=[], use_compiler=False,
+               macros={}, cache_dir=None):
     """ Preprocess c source files naively or with compiler
 
+    When use_compiler is true, the source is preprocessed with the
+    system C preprocessor (see find_cpp, use_compiler can also be a
+    preprocessor command such as 'clang -E') using include_dirs and
+    macros, a dict of macro names and values (None for macros without
+    value). When cache_dir is specified, the preprocessed source is
+    cached in cache_dir and reused until some of the (transitively)
+    included files is modified, see run_cpp.
+
+    Otherwise, or when no preprocessor is found, includes and #ifdef
+    blocks are resolved naively.
     """
-    compiler_commands = {
-        'gcc': ['gcc', '-E', '-']
-    }
-    for compiler in compiler_commands:
-        if use_compiler and shutil.which(compiler):
-            p = subprocess.run(compiler_commands[compiler], input=source,
-                               encoding='ascii', stdout=subprocess.PIPE)
-            source = re.sub(r'^#.*\n', '', p.stdout, flags=re.MULTILINE)
-            break
-    else:  # naive c preprocessor
-        source = _resolve_includes(source, include_dirs=include_dirs,
-                                   skip_includes=skip_includes)
-        source = _remove_comments(source)
-        source = _resolve_macros(source, identifiers={})
+    command = None
+    if isinstance(use_compiler, str):
+        command = shlex.split(use_compiler)
+    elif use_compiler:
+        command = find_cpp()
+    if command is not None:
+        return run_cpp(source, command, include_dirs=include_dirs,
+                       macros=macros, cache_dir=cache_dir)
+    # naive c preprocessor
+    source = _resolve_includes(source, include_dirs=include_dirs,
+                               skip_includes=skip_includes)
+    source = _remove_comments(source)
+    source = _resolve_macros(source, identifiers={})
     return source
 
 
+def find_cpp():
+    """ Return the command of system C preprocessor or None.
+    """
+    for command in [['cpp'], ['gcc', '-E'], ['clang', '-E']]:
+        if shutil.which(command[0]):
+            return command
+
+
+def run_cpp(source, command, include_dirs=[], macros={}, cache_dir=None):
+    """ Return source preprocessed with command, without line markers.
+
+    The preprocessed sources are cached in cache_dir (when specified)
+    by the hash of the source, command, include_dirs, macros and the
+    current working directory. A cached source is valid while the
+    modification times and sizes of the included files (as reported
+    by the preprocessor) are unchanged.
+    """
+    args = list(command)
+    args += ['-I' + d for d in include_dirs]
+    for name, value in sorted(macros.items()):
+        args.append('-D' + name if value is None
+                    else '-D{}={}'.format(name, value))
+    key = hashlib.sha256(json.dumps(dict(
+        source=source, args=args, cwd=os.getcwd(),
+        include_dirs=list(map(os.path.abspath, include_dirs)))
+    ).encode(errors='surrogateescape')).hexdigest()
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, key + '.json')
+        output = _load_cpp_cache(cache_file)
+        if output is not None:
+            return output
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        depends_file = os.path.join(tmp_dir, 'depends')
+        p = subprocess.run(args + ['-MD', '-MF', depends_file, '-'],
+                           input=source, encoding='utf-8',
+                           errors='surrogateescape',
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise RuntimeError('{} failed:\n{}'.format(' '.join(args),
+                                                       p.stderr))
+        with open(depends_file) as f:
+            depends = _parse_depends(f.read())
+    output = re.sub(r'^#.*\n', '', p.stdout, flags=re.MULTILINE)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(dict(depends={d: _file_stat(d) for d in depends},
+                           output=output), f)
+        os.replace(tmp_file, cache_file)
+    return output
+
+
+def _file_stat(filename):
+    st = os.stat(filename)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _load_cpp_cache(cache_file):
+    """ Return cached output or None when cache is missing or stale.
+    """
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+        for filename, stat in cache['depends'].items():
+            if _file_stat(filename) != stat:
+                return
+    except (OSError, ValueError, KeyError):
+        return
+    return cache['output']
+
+
+def _parse_depends(content):
+    """ Return absolute paths of the dependencies in a make rule.
+    """
+    content = content.replace('\\\n', ' ')
+    prerequisites = content.split(':', 1)[1]
+    # spaces in file names are escaped
+    names = re.findall(r'(?:[^\s\\]|\\.)+', prerequisites)
+    return [os.path.abspath(re.sub(r'\\(.)', r'\1', name)) for name in names]
+
+
 def _remove_comments(source):
     """ Return source without comments.
     """
@@ -1,3 +1,4 @@
+import pytest
 from xndtools.c_utils import parser
 
 
@@ -11,3 +12,36 @@ struct foobar {
         '\nstruct foobar @@@1@@@ foobar_t\n',
         {'@@@1@@@': '{\n  int a;\n}'}
     )
+    # a fresh block table per call
+    assert parser.get_c_blocks(source)[1] == {'@@@1@@@': '{\n  int a;\n}'}
+
+
+def test_get_c_blocks_nested():
+    source = '''
+void f(void) { if (a) { s = "}{"; c = '{'; } /* } */ }
+} // {
+'''
+    new_source, blocks = parser.get_c_blocks(source)
+    assert new_source == '\nvoid f(void) @@@2@@@\n} // {\n'
+    assert blocks == {
+        '@@@1@@@': '''{ s = "}{"; c = '{'; }''',
+        '@@@2@@@': '{ if (a) @@@1@@@ /* } */ }',
+    }
+    with pytest.raises(ValueError, match='unclosed'):
+        parser.get_c_blocks('struct a { struct b { int c; };')
+
+
+def test_get_structs_enums():
+    source = '''
+enum color { RED, GREEN };
+typedef struct {
+  int a;
+  struct { double x; } b;
+  char s[10];
+} foo_t;
+'''
+    assert parser.get_enums(source) == {'color': ['RED', 'GREEN']}
+    assert parser.get_structs(source) == {
+        'foo_t': [('int', 'a', None),
+                  ('struct', [('double', 'x', None)], 'b'),
+                  ('char', 's', '10')]}
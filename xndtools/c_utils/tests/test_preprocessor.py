@@ -1,3 +1,6 @@
+import os
+import json
+import pytest
 from xndtools.c_utils import preprocessor
 
 
@@ -44,3 +47,52 @@ def test_preprocessor():
 
 int a = 1;
     ''')
+
+
+@pytest.mark.skipif(preprocessor.find_cpp() is None,
+                    reason='C preprocessor not found')
+def test_preprocessor_cpp(tmp_path):
+    include_dir = tmp_path / 'include'
+    include_dir.mkdir()
+    header = include_dir / 'foo.h'
+    header.write_text('''
+#ifdef FOO
+typedef struct { int a; } foo_t;
+#else
+typedef struct { int b; } foo_t;
+#endif
+int foo(int SIZE);
+''')
+    cache_dir = str(tmp_path / 'cache')
+    source = '#include "foo.h"\n'
+    options = dict(include_dirs=[str(include_dir)], use_compiler=True,
+                   macros=dict(FOO=None, SIZE=10), cache_dir=cache_dir)
+    result = preprocessor.preprocess(source, **options)
+    assert 'int a;' in result and 'int b;' not in result
+    assert 'int foo(int 10);' in result
+    assert '#' not in result
+    cache_files = os.listdir(cache_dir)
+    assert len(cache_files) == 1
+
+    # cached, the preprocessor is not run
+    cache_file = os.path.join(cache_dir, cache_files[0])
+    with open(cache_file) as f:
+        cache = json.load(f)
+    assert os.path.abspath(str(header)) in cache['depends']
+    cache['output'] = 'cached'
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f)
+    assert preprocessor.preprocess(source, **options) == 'cached'
+
+    # modified header
+    header.write_text(header.read_text() + 'int bar(void);\n')
+    result = preprocessor.preprocess(source, **options)
+    assert 'int bar(void);' in result
+
+    # other macros
+    options['macros'] = {}
+    assert 'int b;' in preprocessor.preprocess(source, **options)
+    assert len(os.listdir(cache_dir)) == 2
+
+    with pytest.raises(RuntimeError, match='bar.h'):
+        preprocessor.preprocess('#include "bar.h"\n', **options)
@@ -39,7 +39,9 @@ def generate_config(args):
                             match_patterns=match_patterns,
                             includes=includes,
                             include_dirs=include_dirs,
-                            target_file=args.config_file)
+                            target_file=args.config_file,
+                            jobs=getattr(args, 'jobs', 1),
+                            index_file=getattr(args, 'index', None))
     print('\nHINT: After editing the configuration file, run:\n\n  {}'
           ' kernel {}\n'.format(xnd_tools_script, args.config_file))
     return r
@@ -52,7 +54,9 @@ def generate_kernel(args):
     ----------
     args : argparse.Namespace
       Specify `xnd_tools kernel` arguments: Namespace(config_file=...,
-                                            target_file=..., source_dir=...)
+                                            target_file=..., source_dir=...,
+                                            build=None, force=False,
+                                            jobs=1, shards=None)
 
     Returns
     -------
@@ -71,7 +75,11 @@ def generate_kernel(args):
 
     from xndtools.kernel_generator.generate_kernel import generate_kernel
     r = generate_kernel(config_file=args.config_file,
-                        target_file=args.target_file)
+                        target_file=args.target_file,
+                        build=getattr(args, 'build', None),
+                        cache=not getattr(args, 'force', False),
+                        jobs=getattr(args, 'jobs', 1),
+                        shards=getattr(args, 'shards', None))
     print('HINT: To create extension module, run:\n\n  {} module {}\n'
           .format(xnd_tools_script, args.config_file))
     return r
@@ -86,7 +94,8 @@ def generate_module(args):
       Specify `xnd_tools kernel` arguments:
 
         Namespace(config_file=..., target_file=..., target_language=None,
-                  package=None, kernel_source_file=None, source_dir=...)
+                  package=None, kernel_source_file=None, source_dir=...,
+                  build=None, force=False, jobs=1, shards=None)
 
     Returns
     -------
@@ -106,11 +115,21 @@ def generate_module(args):
     if source_dir and not os.path.isdir(source_dir):
         os.makedirs(source_dir)
     sources = []
+    from xndtools.kernel_generator.generate_kernel import ModuleData
+    # the configuration file is processed once for both generators
+    module_data = ModuleData(args.config_file,
+                             build=getattr(args, 'build', None),
+                             shards=getattr(args, 'shards', None))
     if args.kernels_source_file is None:
         from xndtools.kernel_generator.generate_kernel import generate_kernel
         r = generate_kernel(config_file=args.config_file,
                             target_file=args.target_file,
-                            source_dir=source_dir)
+                            source_dir=source_dir,
+                            build=module_data.build,
+                            cache=not getattr(args, 'force', False),
+                            jobs=getattr(args, 'jobs', 1),
+                            shards=module_data.shards,
+                            module_data=module_data)
         args.kernels_source_file = r['sources'][0]
         sources.extend(r['sources'])
     if not os.path.isfile(args.kernels_source_file):
@@ -124,5 +143,8 @@ def generate_module(args):
                         target_language=args.target_language,
                         package=args.package,
                         sources=sources,
-                        source_dir=source_dir)
+                        source_dir=source_dir,
+                        build=module_data.build,
+                        cache=not getattr(args, 'force', False),
+                        module_data=module_data)
     return r
@@ -0,0 +1,121 @@
+"""Provides: generation_key, load_cache, save_cache, write_source.
+
+Generated kernel and module sources are recorded in a cache file
+`<target file>.cache` (JSON) next to the generated file. The cache
+file holds a hash of all generator inputs (configuration file, xndtools
+version, generator and template sources, generator options, and the
+environment variables used in the configuration file), a hash of the
+generated source, and the result of the generator. When the hashes
+match, the generation is skipped and the generated file is left
+untouched so that its modification time does not trigger
+recompilation.
+"""
+
+import os
+import re
+import sys
+import json
+import hashlib
+from glob import glob
+from .utils import write_lines
+
+_generator_hash = None
+
+
+def _get_generator_hash():
+    """Return hash of xndtools version and generator sources.
+    """
+    global _generator_hash
+    if _generator_hash is None:
+        from xndtools import __version__
+        h = hashlib.sha256(__version__.encode())
+        d = os.path.dirname(__file__)
+        for fn in sorted(glob(os.path.join(d, '*.py'))):
+            with open(fn, 'rb') as f:
+                h.update(os.path.basename(fn).encode())
+                h.update(f.read())
+        _generator_hash = h.hexdigest()
+    return _generator_hash
+
+
+def generation_key(config_file, **options):
+    """Return hash of generator inputs.
+    """
+    with open(config_file, 'rb') as f:
+        config = f.read()
+    env = {}
+    for name in re.findall(r'\$\{(\w+)', config.decode(errors='replace')):
+        env[name] = os.environ.get(name)
+    h = hashlib.sha256(_get_generator_hash().encode())
+    h.update(config)
+    h.update(json.dumps(dict(options=options, env=env,
+                             executable=sys.executable,
+                             config_file=os.path.abspath(config_file)),
+                        sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def _source_hash(filename):
+    if not os.path.isfile(filename):
+        return
+    with open(filename, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_cache(target_file, key):
+    """Return cached result of generating target_file with key, or None
+    when the cache is missing, stale or target_file has been modified.
+    """
+    cache_file = target_file + '.cache'
+    if not os.path.isfile(cache_file):
+        return
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return
+    if cache.get('key') != key:
+        return
+    if cache.get('source_hash') != _source_hash(target_file):
+        return
+    return cache.get('result')
+
+
+def save_cache(target_file, key, result):
+    """Record result of generating target_file with key.
+    """
+    cache = dict(key=key, source_hash=_source_hash(target_file),
+                 result=result)
+    with open(target_file + '.cache', 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+
+
+def _same_content(filename1, filename2, bufsize=1 << 16):
+    with open(filename1, 'rb') as f1, open(filename2, 'rb') as f2:
+        while True:
+            b1 = f1.read(bufsize)
+            if b1 != f2.read(bufsize):
+                return False
+            if not b1:
+                return True
+
+
+def write_source(target_file, source):
+    """Write source to target_file unless it has the same content.
+    The source is a string or an iterable of lines that are written
+    one by one. Return True when the file is written.
+    """
+    if isinstance(source, str):
+        source = [source]
+    tmp_file = target_file + '.tmp'
+    try:
+        with open(tmp_file, 'w') as f:
+            write_lines(f, source)
+        if (os.path.isfile(target_file)
+                and _same_content(tmp_file, target_file)):
+            return False
+        os.replace(tmp_file, target_file)
+        return True
+    finally:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
@@ -30,7 +30,8 @@ import sys
 from collections import defaultdict
 import configparser
 from xndtools.kernel_generator.readers import (PrototypeReader,
-                                               load_kernel_config)
+                                               load_kernel_config,
+                                               compile_patterns)
 from xndtools.kernel_generator.utils import NormalizedTypeMap
 
 
@@ -153,7 +154,9 @@ def generate_config(modulename,
                     exclude_patterns=[],
                     libraries=[], library_dirs=[],
                     reader_options={},
-                    typemap_options={}):
+                    typemap_options={},
+                    jobs=1,
+                    index_file=None):
     """Generate kernel configuration using C function prototypes from
     header files.
 
@@ -194,11 +197,22 @@ def generate_config(modulename,
     strip_left, strip_right : list
       Specify ctype stripping rules for NormalizedTypeMap
 
+    jobs : {int, None}
+      Specify the number of processes that read the header files, all
+      processors when None or 0.
+
+    index_file : {str, None}
+      Specify the path to a prototype index file that records the
+      prototypes of header files, so that only the modified header
+      files are read, see `prototype_index.py`.
+
+    With multiple jobs or index file, each header file is read
+    independently of other header files.
     """
     own_target_file = False
     if target_file is None:
         target_file = 'kernels-{}.cfg'.format(modulename)
-    existing_names = []
+    existing_names = set()
     original_content = ''
     if target_file == 'stdout':
         target_file = sys.stdout
@@ -211,7 +225,7 @@ def generate_config(modulename,
                 if section.startswith('KERNEL'):
                     f = config[section]
                     for prototype in reader(f['prototypes']):
-                        existing_names.append(prototype['name'])
+                        existing_names.add(prototype['name'])
             original_content = open(target_file).read()
             # print ('generate_config: target file {!r} exists!'
             #  ' SKIPPING'.format(target_file))
@@ -249,12 +263,27 @@ def generate_config(modulename,
 
     groups = defaultdict(list)
 
+    if jobs == 1 and index_file is None:
+        header_prototypes = (
+            reader(open(filename).read(), match_patterns=match_patterns,
+                   exclude_patterns=exclude_patterns,
+                   exclude_names=existing_names)
+            for filename in header_files)
+    else:
+        from xndtools.kernel_generator.prototype_index import read_headers
+        match_patterns = compile_patterns(match_patterns)
+        exclude_patterns = compile_patterns(exclude_patterns)
+        header_prototypes = (
+            [prototype for prototype in prototypes
+             if reader.select(prototype['name'], match_patterns,
+                              exclude_patterns, existing_names)]
+            for prototypes in read_headers(header_files,
+                                           reader_options=reader_options,
+                                           jobs=jobs, index_file=index_file))
+
     functions = []
-    for filename in header_files:
-        source = open(filename).read()
-        for prototype in reader(
-                source, match_patterns=match_patterns,
-                exclude_patterns=exclude_patterns + existing_names):
+    for prototypes in header_prototypes:
+        for prototype in prototypes:
             print('generate_config: included: {}'.format(prototype['name']))
             prototype.update_typemap(typemap)
             s = prototype.signature(typemap=typemap, kind='match')
@@ -1,4 +1,4 @@
-""" Provides: generate_kernel, get_module_data.
+""" Provides: generate_kernel, get_module_data, ModuleData.
 """
 # Author: Pearu Peterson
 # Created: April 2018
@@ -9,13 +9,13 @@ import sys
 import re
 import warnings
 from glob import glob
-from copy import deepcopy
 from collections import defaultdict
-import pprint
-from .readers import PrototypeReader, load_kernel_config
+from .readers import PrototypeReader, load_kernel_config, get_module_name
+from .cache import generation_key, load_cache, save_cache, write_source
 from .utils import (NormalizedTypeMap, split_expression, intent_names,
-                    prettify, resolve_path)
-from .kernel_source_template import source_template
+                    prettify_lines, iter_lines, write_lines,
+                    resolve_path)
+from .kernel_source_template import stream_source
 
 
 def update_argument_maps(expr, depends_map, values_map, shapes_map, arguments):
@@ -71,36 +71,166 @@ def apply_typemap(prototype, typemap, typemap_tests):
             typemap_tests.add((orig_type, c_type))
 
 
+def _shard_files(target_file, sources):
+    """Return the kernels sources and the header that are generated
+    together with the kernels table target_file.
+    """
+    root = os.path.splitext(target_file)[0]
+    files = [f for f in sources if f.startswith(root + '-')]
+    return files + [root + '.h'] if files else files
+
+
 def generate_kernel(config_file,
                     target_file=None,
-                    source_dir=''):
-    data = get_module_data(config_file)
-    source = source_template(data)
-    own_target_file = False
+                    source_dir='',
+                    build=None,
+                    cache=True,
+                    jobs=1,
+                    shards=None,
+                    module_data=None):
+    """Generate kernels C source file from kernel configuration file.
+
+    When `cache` is true and the target file was generated from the
+    same inputs, the generation is skipped, see `cache.py`. Kernels
+    are rendered using `jobs` processes (all processors when `jobs` is
+    None or 0).
+
+    When `shards` (or the `shards:` key of the `[MODULE]` section) is
+    greater than 1, the kernels are split between `<target>-<i>.c`
+    files that include a shared header `<target>.h`, and the target
+    file contains the kernels table. All C files are listed in the
+    returned sources.
+
+    The `module_data` is `ModuleData(config_file, build, shards)` that
+    can be shared with `generate_module`, see `ModuleData`.
+    """
+    if module_data is None:
+        module_data = ModuleData(config_file, build=build, shards=shards)
+    module_data.check(config_file, build=build, shards=shards)
+    if target_file is None:
+        target_file = os.path.join(source_dir, '{}-kernels.c'
+                                   .format(get_module_name(config_file)))
+    key = None
+    if cache and isinstance(target_file, str) and target_file != 'stdout':
+        key = generation_key(config_file, target='kernel', build=build,
+                             shards=shards)
+        r = load_cache(target_file, key)
+        if r is not None and not all(
+                map(os.path.isfile, _shard_files(target_file, r['sources']))):
+            r = None
+        if r is not None:
+            print('generate_kernel: target source file {} is up to date'
+                  .format(target_file))
+            return r
+
+    data = module_data.data
+    to_file = isinstance(target_file, str) and target_file != 'stdout'
+    if data['shards'] > 1 and not to_file:
+        print('generate_kernel: splitting kernels to {} shards requires'
+              ' target file path, ignoring shards'.format(data['shards']))
+        data['shards'] = 1
+    target_root = os.path.splitext(target_file)[0] if to_file else None
+    if data['shards'] > 1:
+        data['kernels_header'] = os.path.basename(target_root) + '.h'
+    sources = stream_source(data, jobs=jobs)
+    # the prettified source is written line by line as it is rendered
+    lines = prettify_lines(iter_lines(sources['c_source']))
+    shard_files = []
     if target_file == 'stdout':
-        target_file = sys.stdout
-        own_target_file = False
+        write_lines(sys.stdout, lines)
+        target_name = sys.stdout.name
+    elif to_file:
+        print('generate_kernel: target source file is {}'
+              .format(target_file))
+        if not write_source(target_file, lines):
+            print('generate_kernel: {} is unchanged'.format(target_file))
+        target_name = target_file
+        if data['shards'] > 1:
+            header_file = target_root + '.h'
+            if not write_source(header_file, prettify_lines(
+                    iter_lines(sources['c_header']))):
+                print('generate_kernel: {} is unchanged'.format(header_file))
+            for i, parts in enumerate(sources['c_shards']):
+                shard_file = '{}-{}.c'.format(target_root, i)
+                if not write_source(shard_file,
+                                    prettify_lines(iter_lines(parts))):
+                    print('generate_kernel: {} is unchanged'
+                          .format(shard_file))
+                shard_files.append(shard_file)
+            print('generate_kernel: kernels are split between {}-[0-{}].c'
+                  .format(target_root, data['shards'] - 1))
     else:
-        if target_file is None:
-            target_file = os.path.join(source_dir,
-                                       '{module_name}-kernels.c'.format(**data))
-        if isinstance(target_file, str):
-            print('generate_kernel: target source file is {}'
-                  .format(target_file))
-            target_file = open(target_file, 'w')
-            own_target_file = True
-        else:
-            own_target_file = False
+        write_lines(target_file, lines)
+        target_name = target_file.name
+    r = dict(config_file=config_file,
+             sources=[target_name] + shard_files + data['sources'])
+    if key is not None:
+        save_cache(target_file, key, r)
+    return r
+
+
+class ModuleData(object):
+    """Module data of kernel configuration file that is computed once
+    and shared between the kernel and module generators.
+
+    The data is computed by `get_module_data` on first access of the
+    `data` attribute, so that it is not computed at all when the
+    generated sources are up to date, see `cache.py`. Note that kernel
+    generation updates the kernels data in place: the kernels can be
+    rendered only once while the module data (name, include
+    directories, libraries, etc) remains valid.
+    """
 
-    target_file.write(prettify(source['c_source'], target='c'))
-    if own_target_file:
-        target_file.close()
-    return dict(config_file=config_file,
-                sources=[target_file.name] + data['sources'])
+    def __init__(self, config_file, build=None, shards=None):
+        self.config_file = config_file
+        self.build = build
+        self.shards = shards
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = get_module_data(self.config_file, build=self.build,
+                                         shards=self.shards)
+        return self._data
+
+    def check(self, config_file, **options):
+        """Raise ValueError when module data is not of config_file with
+        given options.
+        """
+        if config_file != self.config_file:
+            raise ValueError('module data of {!r} used for {!r}'
+                             .format(self.config_file, config_file))
+        for name, value in options.items():
+            if value != getattr(self, name):
+                raise ValueError('module data with {}={!r} used for {}={!r}'
+                                 .format(name, getattr(self, name),
+                                         name, value))
+
+
+# Found XND packages, see update_config_xnd
+_xnd_config = None
 
 
 def update_config_xnd(**config):
     """ Update configuration variables for XND packages.
+
+    The packages are looked up once per process.
+    """
+    global _xnd_config
+    if _xnd_config is None:
+        xnd_config = dict(include_dirs=[], library_dirs=[], libraries=[])
+        has_xnd = _find_config_xnd(**xnd_config)
+        _xnd_config = has_xnd, xnd_config
+    has_xnd, xnd_config = _xnd_config
+    for key, values in xnd_config.items():
+        config[key].extend(values)
+    return has_xnd
+
+
+def _find_config_xnd(**config):
+    """ Find XND packages and update configuration variables, see
+    update_config_xnd.
     """
     sys_include_dir = os.path.join(sys.prefix, 'include')
     sys_lib_dir = os.path.join(sys.prefix, 'lib')
@@ -147,7 +277,16 @@ def update_config_xnd(**config):
     return has_xnd
 
 
-def get_module_data(config_file):
+build_modes = ('default', 'lean', 'instrumented')
+parallel_modes = ('none', 'threads')
+
+
+def get_module_data(config_file, build=None, shards=None):
+    """Return module data of kernel configuration file.
+
+    When specified, `build` and `shards` override the `build:` and
+    `shards:` keys of the `[MODULE]` section, see `build_modes`.
+    """
     config = load_kernel_config(config_file)
     if config is None:
         return
@@ -202,6 +341,25 @@ def get_module_data(config_file):
                 sources.append(resolve_path(line, prefix=config_dir))
 
             default_debug = bool(current_module.get('debug', default_debug_value))  # TODO: debug should be command line flag
+            stats = current_module.getboolean('stats', False)
+            if build is None:
+                build = current_module.get('build', 'default').strip()
+            if build not in build_modes:
+                raise ValueError('unknown build mode {!r}, expected one of {}'
+                                 .format(build, ', '.join(build_modes)))
+            if build == 'lean':
+                # no counters, statistics, nor debug messages
+                default_debug = stats = False
+            elif build == 'instrumented':
+                stats = True
+            if shards is None:
+                shards = current_module.getint('shards', 1)
+            if shards < 1:
+                raise ValueError('number of shards must be positive, got {}'
+                                 .format(shards))
+            lazy = current_module.getboolean('lazy', False)
+            default_parallel = current_module.get('parallel', 'none').strip()
+            default_parallel_chunk = current_module.getint('parallel_chunk', 1)
             default_kinds = split_expression(current_module.get('kinds', default_kinds_value))
             default_ellipses = split_expression(current_module.get('ellipses', default_ellipses_value))
             default_arraytypes = split_expression(current_module.get('arraytypes', default_arraytypes_value))
@@ -242,7 +400,7 @@ def get_module_data(config_file):
                 print('get_module_data: no prototypes|prototypes[C]|prototypes[Fortran] defined in [KERNEL {}]'.format(kernel_name))
                 continue
 
-            debug = bool(f.get('debug', default_debug))
+            debug = bool(f.get('debug', default_debug)) and build != 'lean'
             kinds = split_expression(f.get('kinds', ''))
             ellipses = f.get('ellipses')
             if ellipses is None:
@@ -250,6 +408,12 @@ def get_module_data(config_file):
             else:
                 ellipses = split_expression(ellipses)
             arraytypes = split_expression(f.get('arraytypes', '')) or default_arraytypes
+            parallel = f.get('parallel', default_parallel).strip()
+            if parallel not in parallel_modes:
+                raise ValueError('unknown parallel mode {!r}, expected one of {} [KERNEL {}]'
+                                 .format(parallel, ', '.join(parallel_modes), kernel_name))
+            parallel_chunk = max(1, f.getint('parallel_chunk', default_parallel_chunk))
+            fuse = f.get('fuse', '').strip()
 
             assert set(arraytypes).issubset(['symbolic', 'variable']), repr(arraytypes)
 
@@ -309,13 +473,13 @@ def get_module_data(config_file):
                     # note that `has_?_tensors` include also output arguments.
                     allowed_kinds = []
                     if has_F_tensors and has_C_tensors:
-                        allowed_kinds = ['Xnd']
+                        allowed_kinds = ['Xnd', 'Strided']
                     elif has_F_tensors:
-                        allowed_kinds = ['Xnd', 'Fortran']
+                        allowed_kinds = ['Xnd', 'Fortran', 'Strided']
                     elif has_C_tensors:
-                        allowed_kinds = ['Xnd', 'C']
+                        allowed_kinds = ['Xnd', 'C', 'Strided']
                     else:
-                        allowed_kinds = ['Xnd', 'C']
+                        allowed_kinds = ['Xnd', 'C', 'Strided']
                     prototype['max_rank'] = max_rank
 
                     if max_rank > 1:
@@ -341,6 +505,29 @@ def get_module_data(config_file):
 
                     input_args, output_args = prototype.get_input_output_arguments()
 
+                    # Strided kernels have no access to xnd containers:
+                    # optional inputs and in-situ contiguity checks cannot
+                    # be supported.
+                    strided_unsupported = []
+                    for arg in input_args:
+                        if 'value' in arg:
+                            strided_unsupported.append('optional argument `{}`'.format(arg['name']))
+                        if arg.is_array and (arg.is_intent_inout or arg.is_intent_inout_output):
+                            strided_unsupported.append('inout array argument `{}`'.format(arg['name']))
+                    has_stack_arrays = any(arg.is_array for arg in input_args + output_args)
+                    # the outer dimension can be fused with dimension
+                    # `fuse` when it is the only dimension of all stack
+                    # arguments
+                    fusable = (fuse and input_args and prototype['type'] == 'void'
+                               and all(arg.is_array and [dim['value'] for dim in arg['shape']] == [fuse]
+                                       for arg in input_args + output_args))
+                    if fuse and not fusable:
+                        print('get_module_data: `fuse: {}` requires void function with all array arguments of shape ({}), ignoring [KERNEL {}]'
+                              .format(fuse, fuse, kernel_name))
+                    if has_stack_arrays and (prototype['type'] != 'void' or not all(arg.is_array for arg in input_args + output_args)):
+                        # gumath selects Strided kernels only when all arguments are ndarrays or all are scalars
+                        strided_unsupported.append('mixing scalar and array arguments')
+
                     for arraytype in arraytypes:
                         for kind in kinds_:
                             if arraytype == 'variable' and kind != 'Xnd':
@@ -348,14 +535,15 @@ def get_module_data(config_file):
                             if kind not in allowed_kinds:
                                 print('get_module_data: `kinds: {}` not in allowed set `kinds: {}` [KERNEL {}]`'.format(kind, '|'.join(allowed_kinds), kernel_name))
                                 continue
+                            if kind == 'Strided' and strided_unsupported:
+                                print('get_module_data: `kinds: Strided` does not support {}, skipping [KERNEL {}]'.format(', '.join(strided_unsupported), kernel_name))
+                                continue
 
                             # if max_rank < 2 and kind == 'Fortran':
                             #    print('get_module_data: Fortran {}-rank kernel is equivalent to C kernel, skipping. [KERNEL {}]'.format(max_rank, kernel_name))
                             #    continue
                             for ellipses_ in ellipses:
-                                kernel = deepcopy(prototype)
-                                kernel['kind'] = kind
-                                kernel['arraytype'] = arraytype
+                                kernel = prototype.variant(kind=kind, arraytype=arraytype)
                                 if ellipses_ and ellipses_.lower() != 'none':
                                     if not input_args:  # `void -> ... * T` not allowed
                                         continue
@@ -365,8 +553,30 @@ def get_module_data(config_file):
                                         kernel['ellipses'] = ellipses_ + ' * '
                                 else:
                                     kernel['ellipses'] = ''
+                                if kind == 'Strided' and kernel['ellipses'] and (has_stack_arrays or kernel['ellipses'] != '... * '):
+                                    print('get_module_data: `kinds: Strided` supports `ellipses: {}` only for scalar arguments, skipping [KERNEL {}]'.format(ellipses_, kernel_name))
+                                    continue
+                                if kind != 'Xnd':
+                                    # values of intrinsic functions depend on kernel kind
+                                    for name, value in values_map.items():
+                                        kernel.get_argument(name).pop('value', None)
+                                        kernel.set_argument_value(name, value, kind=kind)
                                 kernel['ellipses_name'] = kernel['ellipses'].replace('...', '_DOTS_').replace('.', '_DOT_').replace('*', '_STAR_').replace(' ', '')
-                                kernel['kernel_repr'] = pprint.pformat(kernel, indent=4, compact=True)
+                                if parallel != 'none':
+                                    if kind != 'Strided' and arraytype == 'symbolic' and kernel['ellipses'] == '... * ':
+                                        # outer dimension is split between threads, see xndtools_parallel_map
+                                        kernel['parallel'] = parallel
+                                        kernel['parallel_chunk'] = parallel_chunk
+                                    elif 'parallel' in f:
+                                        print('get_module_data: `parallel: {}` requires `ellipses: ...` and non-Strided kind, ignoring for {} kernel of [KERNEL {}]'
+                                              .format(parallel, kind, kernel_name))
+                                if fusable:
+                                    if kind != 'Strided' and arraytype == 'symbolic' and kernel['ellipses'] == '... * ':
+                                        # contiguous `m * n` arguments are passed as `m*n` arrays, see xndtools_fuse_outer
+                                        kernel['fuse'] = fuse
+                                    elif kernel['ellipses']:
+                                        print('get_module_data: `fuse: {}` requires `ellipses: ...` and non-Strided kind, ignoring for {} kernel of [KERNEL {}]'
+                                              .format(fuse, kind, kernel_name))
                                 kernels.append(kernel)
 
     lst = []
@@ -375,6 +585,9 @@ def get_module_data(config_file):
         if h:
             lst.append('#include "{}"'.format(h))
 
+    if sys.platform != 'win32' and any(kernel.get('parallel') == 'threads' for kernel in kernels):
+        libraries.append('pthread')
+
     module_data = dict(
         module_name=module_name,
         includes='\n'.join(lst),
@@ -386,6 +599,10 @@ def get_module_data(config_file):
         kernels=kernels,
         typemap_tests=list([dict(orig_type=o[0], normal_type=o[1])
                             for o in typemap_tests]),
+        stats=stats,
+        build=build,
+        shards=shards,
+        lazy=lazy,
         has_xnd=has_xnd
     )
 
@@ -4,7 +4,9 @@
 # Created: April 2018
 
 import os
-from .generate_kernel import get_module_data
+from .generate_kernel import ModuleData
+from .readers import get_module_name
+from .cache import generation_key, load_cache, save_cache, write_source
 
 
 def generate_module(config_file,
@@ -12,33 +14,60 @@ def generate_module(config_file,
                     target_language='python',
                     source_dir='',
                     package=None,
-                    sources=[]):
-    module_data = get_module_data(config_file)
-    module_data['language'] = target_language
+                    sources=[],
+                    build=None,
+                    cache=True,
+                    module_data=None):
+    """Generate extension module C source file from kernel configuration
+    file.
+
+    The `module_data` is `ModuleData(config_file, build)` that can be
+    shared with `generate_kernel`, see `ModuleData`.
+    """
+    if module_data is None:
+        module_data = ModuleData(config_file, build=build)
+    module_data.check(config_file, build=build)
+    if target_language != 'python':
+        raise NotImplementedError(repr(target_language))
     if target_file is None:
-        target_file = os.path.join(source_dir, '{module_name}-{language}.c'
-                                   .format(**module_data))
-    if target_language == 'python':
-        module_source = pymodule_template.format(**module_data)
+        target_file = os.path.join(source_dir, '{}-{}.c'.format(
+            get_module_name(config_file), target_language))
+    key = None
+    if cache:
+        key = generation_key(config_file, target='module', build=build,
+                             language=target_language, package=package,
+                             sources=list(sources))
+        r = load_cache(target_file, key)
+        if r is not None:
+            print('generate_module: {!r} is up to date'.format(target_file))
+            return r
+
+    module_data = module_data.data
+    module_data['language'] = target_language
+    for name, (lazy_part, part) in pymodule_parts.items():
+        module_data[name] = (lazy_part if module_data['lazy'] else part
+                             ).format(**module_data)
+    module_source = pymodule_template.format(**module_data)
+    if write_source(target_file, module_source):
+        print('Created {!r}'.format(target_file))
     else:
-        raise NotImplementedError(repr(target_language))
-    f = open(target_file, 'w')
-    f.write(module_source)
-    f.close()
-    print('Created {!r}'.format(target_file))
+        print('generate_module: {!r} is unchanged'.format(target_file))
 
     extname = module_data['module_name']
     if package is not None:
         extname = package + '.' + extname
 
-    return dict(config_file=config_file,
-                sources=[target_file] + sources,
-                include_dirs=module_data['include_dirs'],
-                library_dirs=module_data['library_dirs'],
-                libraries=module_data['libraries'],
-                extname=extname,
-                language=target_language,
-                has_xnd=module_data['has_xnd'])
+    r = dict(config_file=config_file,
+             sources=[target_file] + sources,
+             include_dirs=module_data['include_dirs'],
+             library_dirs=module_data['library_dirs'],
+             libraries=module_data['libraries'],
+             extname=extname,
+             language=target_language,
+             has_xnd=module_data['has_xnd'])
+    if key is not None and r['has_xnd']:
+        save_cache(target_file, key, r)
+    return r
 
 
 pymodule_template = '''
@@ -47,14 +76,109 @@ pymodule_template = '''
 #include "pyndtypes.h"
 #include "gumath.h"
 #include "pygumath.h"
+#include "xndtools.h"
 
 
 /****************************************************************************/
 /*                              Module globals                              */
 /****************************************************************************/
 
-/* Function table */
-static gm_tbl_t *gmk_{module_name}_table = NULL;
+{module_globals}
+
+/****************************************************************************/
+/*                              Module methods                              */
+/****************************************************************************/
+
+static PyObject *
+gmk_{module_name}_release_scratch(PyObject *self, PyObject *args)
+{{
+    (void)self;
+    (void)args;
+    return PyLong_FromLongLong(xndtools_scratch_release());
+}}
+
+static PyObject *
+gmk_{module_name}_set_scratch_limit(PyObject *self, PyObject *arg)
+{{
+    long long nbytes = PyLong_AsLongLong(arg);
+    (void)self;
+    if (nbytes == -1 && PyErr_Occurred()) {{
+        return NULL;
+    }}
+    return PyLong_FromLongLong(xndtools_scratch_set_limit(nbytes));
+}}
+
+static PyObject *
+gmk_{module_name}_scratch_cached(PyObject *self, PyObject *args)
+{{
+    (void)self;
+    (void)args;
+    return PyLong_FromLongLong(xndtools_scratch_cached());
+}}
+
+static PyObject *
+gmk_{module_name}_set_num_threads(PyObject *self, PyObject *arg)
+{{
+    long nthreads = PyLong_AsLong(arg);
+    (void)self;
+    if (nthreads == -1 && PyErr_Occurred()) {{
+        return NULL;
+    }}
+    return PyLong_FromLong(xndtools_set_num_threads((int)nthreads));
+}}
+
+xndtools_kernel_stats_t **gmk_{module_name}_kernel_stats(void);
+
+static PyObject *
+gmk_{module_name}_get_kernel_stats(PyObject *self, PyObject *args)
+{{
+    xndtools_kernel_stats_t **stats = gmk_{module_name}_kernel_stats();
+    PyObject *result = PyDict_New();
+    (void)self;
+    (void)args;
+    if (result == NULL) {{
+        return NULL;
+    }}
+    for (; *stats != NULL; stats++) {{
+        PyObject *item = Py_BuildValue("{{sLsdsLsL}}",
+                                       "calls", (long long)(*stats)->calls,
+                                       "time", (*stats)->time * 1e-9,
+                                       "copied_in", (long long)(*stats)->copied_in,
+                                       "copied_out", (long long)(*stats)->copied_out);
+        if (item == NULL || PyDict_SetItemString(result, (*stats)->name, item) < 0) {{
+            Py_XDECREF(item);
+            Py_DECREF(result);
+            return NULL;
+        }}
+        Py_DECREF(item);
+    }}
+    return result;
+}}
+
+static PyObject *
+gmk_{module_name}_reset_kernel_stats(PyObject *self, PyObject *args)
+{{
+    (void)self;
+    (void)args;
+    xndtools_kernel_stats_reset(gmk_{module_name}_kernel_stats());
+    Py_RETURN_NONE;
+}}
+{lazy_functions}
+static PyMethodDef {module_name}_methods[] = {{
+    {{"_release_scratch", gmk_{module_name}_release_scratch, METH_NOARGS,
+     "Release cached scratch buffers of the calling thread and of parallel kernel workers, return the number of released bytes."}},
+    {{"_set_scratch_limit", gmk_{module_name}_set_scratch_limit, METH_O,
+     "Set the high-water mark (in bytes) of cached scratch buffers per thread, return the previous mark."}},
+    {{"_scratch_cached", gmk_{module_name}_scratch_cached, METH_NOARGS,
+     "Return the number of bytes of scratch buffers cached by all threads."}},
+    {{"_set_num_threads", gmk_{module_name}_set_num_threads, METH_O,
+     "Set the number of threads of `parallel: threads` kernels, return the previous number."}},
+    {{"_kernel_stats", gmk_{module_name}_get_kernel_stats, METH_NOARGS,
+     "Return a dict of kernel statistics (calls, time in seconds, copied_in and copied_out bytes), requires `stats: true`."}},
+    {{"_reset_kernel_stats", gmk_{module_name}_reset_kernel_stats, METH_NOARGS,
+     "Reset kernel statistics."}},{lazy_methods}
+    {{NULL, NULL, 0, NULL}}
+}};
 
 /****************************************************************************/
 /*                                  Module                                  */
@@ -65,7 +189,7 @@ static struct PyModuleDef {module_name}_module = {{
     "{module_name}",              /* m_name */
     NULL,                         /* m_doc */
     -1,                           /* m_size */
-    NULL,                         /* m_methods */
+    {module_name}_methods,        /* m_methods */
     NULL,                         /* m_slots */
     NULL,                         /* m_traverse */
     NULL,                         /* m_clear */
@@ -88,16 +212,7 @@ PyInit_{module_name}(void)
        if (import_gumath() < 0) {{
             return NULL;
        }}
-
-       gmk_{module_name}_table = gm_tbl_new(&ctx);
-       if (gmk_{module_name}_table == NULL) {{
-           return Ndt_SetError(&ctx);
-       }}
-
-       if (gmk_init_{module_name}_kernels(gmk_{module_name}_table, &ctx) < 0) {{
-           return Ndt_SetError(&ctx);
-       }}
-
+{init_kernels}
        initialized = 1;
     }}
 
@@ -105,11 +220,7 @@ PyInit_{module_name}(void)
     if (m == NULL) {{
         goto error;
     }}
-
-    if (Gumath_AddFunctions(m, gmk_{module_name}_table) < 0) {{
-        goto error;
-    }}
-
+{add_functions}
     return m;
 
 error:
@@ -117,3 +228,101 @@ error:
     return NULL;
 }}
 '''
+
+# With `lazy: true`, kernels are added to gumath table and the module
+# on first attribute access instead of module initialization.
+
+pymodule_parts = dict(
+    module_globals=('''\
+/* Kernels are added to the module on first access, see
+   gmk_{module_name}_getattr */''', '''\
+/* Function table */
+static gm_tbl_t *gmk_{module_name}_table = NULL;'''),
+    lazy_functions=('''
+const gm_kernel_init_t *gmk_{module_name}_kernels(void);
+int gmk_add_{module_name}_kernel(gm_tbl_t *tbl, const char *name, ndt_context_t *ctx);
+
+static PyObject *
+gmk_{module_name}_getattr(PyObject *self, PyObject *arg)
+{{
+    NDT_STATIC_CONTEXT(ctx);
+    const char *name = PyUnicode_AsUTF8(arg);
+    const gm_kernel_init_t *k;
+    gm_tbl_t *tbl;
+
+    if (name == NULL) {{
+        return NULL;
+    }}
+    for (k = gmk_{module_name}_kernels(); k->name != NULL; k++) {{
+        if (strcmp(k->name, name) == 0) {{
+            break;
+        }}
+    }}
+    if (k->name == NULL) {{
+        return PyErr_Format(PyExc_AttributeError,
+                            "module '{module_name}' has no attribute '%s'", name);
+    }}
+
+    /* The table holds the kernels of one gufunc and lives as long
+       as the process, like the table of all kernels in eager mode. */
+    tbl = gm_tbl_new(&ctx);
+    if (tbl == NULL) {{
+        return Ndt_SetError(&ctx);
+    }}
+    if (gmk_add_{module_name}_kernel(tbl, name, &ctx) < 0) {{
+        return Ndt_SetError(&ctx);
+    }}
+
+    if (Gumath_AddFunctions(self, tbl) < 0) {{
+        return NULL;
+    }}
+    return PyObject_GenericGetAttr(self, arg);
+}}
+
+static PyObject *
+gmk_{module_name}_dir(PyObject *self, PyObject *args)
+{{
+    const gm_kernel_init_t *k;
+    PyObject *names = PySet_New(PyModule_GetDict(self));
+    PyObject *result;
+    (void)args;
+    if (names == NULL) {{
+        return NULL;
+    }}
+    for (k = gmk_{module_name}_kernels(); k->name != NULL; k++) {{
+        PyObject *name = PyUnicode_FromString(k->name);
+        if (name == NULL || PySet_Add(names, name) < 0) {{
+            Py_XDECREF(name);
+            Py_DECREF(names);
+            return NULL;
+        }}
+        Py_DECREF(name);
+    }}
+    result = PySequence_List(names);
+    Py_DECREF(names);
+    return result;
+}}
+''', ''),
+    lazy_methods=('''
+    {{"__getattr__", gmk_{module_name}_getattr, METH_O,
+     "Add kernel to the module on first access."}},
+    {{"__dir__", gmk_{module_name}_dir, METH_NOARGS,
+     "Return the names of module attributes and kernels."}},''', ''),
+    init_kernels=('''\
+       (void)ctx;
+''', '''
+       gmk_{module_name}_table = gm_tbl_new(&ctx);
+       if (gmk_{module_name}_table == NULL) {{
+           return Ndt_SetError(&ctx);
+       }}
+
+       if (gmk_init_{module_name}_kernels(gmk_{module_name}_table, &ctx) < 0) {{
+           return Ndt_SetError(&ctx);
+       }}
+'''),
+    add_functions=('', '''
+    if (Gumath_AddFunctions(m, gmk_{module_name}_table) < 0) {{
+        goto error;
+    }}
+'''),
+)
@@ -3,8 +3,17 @@
 # Author: Pearu Peterson
 # Created: May 2018
 
+import os
+import re
+import zlib
+import pprint
+import hashlib
+from copy import deepcopy
+import tempfile
+import multiprocessing
 from collections import defaultdict
-from .templating import Template, Predicate, flatten
+from .templating import (Template, Predicate, flatten, dependency_order,
+                         dependency_cycle)
 from . import utils
 #
 # Predicate functions
@@ -34,6 +43,13 @@ def arraytype_is(arraytype):
 is_symbolic = arraytype_is('symbolic')
 is_variable = arraytype_is('variable')
 debug = Predicate(lambda data: data.get('debug', False))
+stats = Predicate(lambda data: data.get('stats', False))
+is_lean = Predicate(lambda data: data.get('build') == 'lean')
+is_instrumented = Predicate(lambda data: data.get('build') == 'instrumented')
+is_parallel = Predicate(lambda data: data.get('parallel') == 'threads')
+is_fused = Predicate(lambda data: bool(data.get('fuse')))
+is_sharded = Predicate(lambda data: data.get('shards', 1) > 1)
+is_lazy = Predicate(lambda data: bool(data.get('lazy')))
 is_scalar = Predicate(lambda data: not (data.get('left_modifier') or data.get('right_modifier')))
 is_scalar_ptr = Predicate(lambda data: data.get('left_modifier') == '*' and not data.get('right_modifier') and data.get('shape') is None)
 is_array = Predicate(lambda data: (data.get('left_modifier') == '*' or data.get('right_modifier') == '[]') and data.get('shape') is not None)
@@ -77,6 +93,20 @@ def join_constraints_list(lst):
     return ''.join(sorted(set(lst)))
 
 
+def join_kernel_stats_list(lst):
+    """
+    Eliminates dublicated entries
+    """
+    return ''.join(item + '\n  ' for item in sorted(set(flatten(lst))) if item)
+
+
+def join_kernel_declarations_list(lst):
+    """
+    Eliminates dublicated declarations
+    """
+    return '\n'.join(item for item in sorted(set(flatten(lst))) if item)
+
+
 def sorted_list(lst):
     """
     Sorts list of statements taking into account dependencies.
@@ -102,19 +132,10 @@ def sorted_list(lst):
     for n in all_deps:
         if n not in d:
             d[n] = set()
-    lst = [n for n in d if not d[n]]
-    n_ = None
-    while len(lst) < len(d):
-        if len(lst) == n_:
-            print('sorted_list:WARNING:circular dependence detected!: {!r}'.format(d))
-            break
-        n_ = len(lst)
-        for n, deps in d.items():
-            if n in lst:
-                continue
-            if not deps.difference(lst):
-                lst.append(n)
-                continue
+    lst, unresolved = dependency_order(d)
+    if unresolved:
+        print('sorted_list:WARNING:circular dependence detected!: {}'
+              .format(' -> '.join(dependency_cycle(d, unresolved))))
     res = flatten([stmts[n] for n in lst if n in stmts])
     return res
 
@@ -126,11 +147,17 @@ def join_signatures_list(lst):
     sig_kindmap = defaultdict(list)
 
     for signature in lst:
-        name, sig, nout, kind_value = signature.split('|')
-        sig_kindmap[name, sig, int(nout)].append(kind_value)
+        name, sig, nout, *kind_values = signature.split('|')
+        sig_kindmap[name, sig, int(nout)].extend(kind_values)
 
     lst = []
     for (name, sig, nout), kind_values in sig_kindmap.items():
+        kinds = [s.split('=')[0].strip()[1:] for s in kind_values
+                 if s != 'vectorize']
+        if 'vectorize' in kind_values:
+            # kernels handle one outer dimension, see xndtools_parallel_map
+            kind_values = [s for s in kind_values if s != 'vectorize']
+            kind_values.append('.vectorize = true')
         if nout > 0:
             lst.append(
                 '{{ .name = "{}", .sig = "{}", .constraint'
@@ -139,7 +166,6 @@ def join_signatures_list(lst):
         else:
             lst.append('{{ .name = "{}", .sig = "{}", {} }}'
                        .format(name, sig, ', '.join(kind_values)))
-        kinds = [s.split('=')[0].strip()[1:] for s in kind_values]
         print('  {}(sig="{}", {}) [nout={}]'.format(name, sig,
                                                     ', '.join(kinds), nout))
 
@@ -195,6 +221,24 @@ def initialize_source(data):
     """
 
 
+class _LazyRepr(object):
+    """Formats as pprint.pformat(obj) that is computed on first use.
+    """
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.value = None
+
+    def __str__(self):
+        if self.value is None:
+            self.value = pprint.pformat(self.obj, indent=4, compact=True)
+            self.obj = None
+        return self.value
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+
 def initialize_kernels(data):
     """
     1. Sets argument shape dimension key (fixed and symbolic dimensons)
@@ -202,7 +246,17 @@ def initialize_kernels(data):
     3. Extends arguments with function return value.
     4. Initialize various lists.
     5. Computes nin, nout, symbols for constraint function.
+
+    Also sets kernel_repr, the representation of the kernel
+    configuration prior initialization. The representation is computed
+    only when a template uses it, from a copy of the configuration.
     """
+    if 'kernel_repr' not in data:
+        if isinstance(data, utils.Prototype):
+            config = data.variant()
+        else:
+            config = deepcopy(data)
+        data['kernel_repr'] = _LazyRepr(config)
     dimension_symbols = 'NMLKPQRSVWXYZBCDFGHJAEIOU'
     dims_map = {}
     input_index = 0
@@ -258,6 +312,30 @@ def initialize_kernels(data):
         output_args.append(arg)
     for arg in output_args:
         arg['output_index'] += input_index
+    data['nstack'] = input_index + len(output_args)
+    data['stack_rank'] = 0  # rank of the first stack argument
+    for arg in data['arguments']:
+        if (is_inany)(arg):
+            data['stack_rank'] = len(arg.get('shape') or [])
+            break
+
+    # Offsets of arguments dimensions and steps in Strided kernels
+    # arguments, see gm_np_convert_xnd. Scalars are treated as 1-D
+    # arrays with length 1.
+    strided_index = 0
+    for arg in data['arguments']:
+        if (is_inany)(arg):
+            arg['input_strided_index'] = strided_index
+            strided_index += len(arg.get('shape') or [None])
+    for arg in output_args:
+        arg['output_strided_index'] = strided_index
+        strided_index += len(arg.get('shape') or [None])
+    if strided_index and not [arg for arg in data['arguments']
+                              if (is_array * (is_inany + is_outany))(arg)]:
+        # elementwise loop over ellipses dimension
+        data['strided_length'] = 'gmk_dimensions[0]'
+    else:
+        data['strided_length'] = '1'
 
     # To suppress warnings when no input or no output, must be empty
     # lists:
@@ -274,13 +352,35 @@ def initialize_argument(data):
                             float32='%f', float64='%f')[data['type']]
     else:
         data['cfmt'] = '%p'
+    data['rank'] = len(data.get('shape') or ())
 
 
 #
 # Template strings
 #
 
-c_source_template = '''\
+debug_macros_template = '''\
+#define DEBUGMSG(MSG) printf("debug: " MSG);
+#define DEBUGMSG1(MSG, VALUE) printf("debug: " MSG, VALUE);
+#define DEBUGMSG2(MSG, VALUE1, VALUE2) printf("debug: " MSG, VALUE1, VALUE2);'''
+
+wrapper_stats_template = '''\
+/****************************************************************************/
+/*                       Report wrapper call statistics                     */
+/****************************************************************************/
+
+static void
+gmk_wrapper_stats_{module_name}(void) {{
+    printf("----------------------------------------------------------------\\n");
+    printf("Module: {module_name}\\n");
+    printf("------+---------------------------------------------------------\\n");
+    printf("Calls | Wrapper name\\n");
+    printf("------+---------------------------------------------------------\\n");
+    {report_wrapper_counter-list}
+    printf("------+---------------------------------------------------------\\n");
+}}'''
+
+source_doc_template = '''\
 /*
   This file is auto-generated.
 
@@ -290,6 +390,9 @@ c_source_template = '''\
 {short_doc-list}
 
  */
+'''
+
+source_includes_template = '''\
 #include <stdlib.h>
 #include <stdint.h>
 #include <string.h>
@@ -306,22 +409,27 @@ c_source_template = '''\
 
 #define GMK_FIXED_ARRAY_DATA(CTYPE, NAME) ((CTYPE *)(NAME.ptr + NAME.index * NAME.type->Concrete.FixedDim.itemsize))
 #define GMK_SCALAR_DATA(CTYPE, NAME) ((CTYPE *)(NAME.ptr))
+#define GMK_STRIDED_DATA(CTYPE, INDEX) ((CTYPE *)(gmk_args[INDEX] + gmk_i * gmk_steps[INDEX]))
 
-#define DEBUGMSG(MSG) printf("debug: " MSG);
-#define DEBUGMSG1(MSG, VALUE) printf("debug: " MSG, VALUE);
-#define DEBUGMSG2(MSG, VALUE1, VALUE2) printf("debug: " MSG, VALUE1, VALUE2);
+{debug_macros}
 
+'''
 
+source_constraints_template = '''
 /****************************************************************************/
 /*                       Generated constraints                              */
 /****************************************************************************/
 {constraints-list}
+'''
 
+source_kernels_template = '''
 /****************************************************************************/
 /*                       Generated kernels                                  */
 /****************************************************************************/
 {kernels-list}
+'''
 
+source_tables_template = '''
 /****************************************************************************/
 /*                       Test typemaps correctness                          */
 /****************************************************************************/
@@ -334,21 +442,20 @@ gmk_test_{module_name}_typemaps(ndt_context_t *ctx) {{
     return 0;
 }}
 
+{wrapper_stats}
+
 /****************************************************************************/
-/*                       Report wrapper call statistics                     */
+/*                       Kernel statistics                                  */
 /****************************************************************************/
 
-static void
-gmk_wrapper_stats_{module_name}(void) {{
-    printf("----------------------------------------------------------------\\n");
-    printf("Module: {module_name}\\n");
-    printf("------+---------------------------------------------------------\\n");
-    printf("Calls | Wrapper name\\n");
-    printf("------+---------------------------------------------------------\\n");
-    {report_wrapper_counter-list}
-    printf("------+---------------------------------------------------------\\n");
-}}
+static xndtools_kernel_stats_t *{module_name}_kernel_stats[] = {{
+  {kernel_stats-list}NULL
+}};
 
+xndtools_kernel_stats_t **
+gmk_{module_name}_kernel_stats(void) {{
+    return {module_name}_kernel_stats;
+}}
 
 static const gm_kernel_init_t {module_name}_kernels[] = {{
   {signatures-list}
@@ -372,13 +479,89 @@ gmk_init_{module_name}_kernels(gm_tbl_t *tbl, ndt_context_t *ctx)
             return -1;
         }}
     }}
-    atexit(gmk_wrapper_stats_{module_name});
+    {register_wrapper_stats}
     return 0;
 }}
 
+{lazy_registration}
+'''
+
+lazy_registration_template = '''\
+/****************************************************************************/
+/*                       Register kernels on demand                         */
+/****************************************************************************/
+
+const gm_kernel_init_t *
+gmk_{module_name}_kernels(void) {{
+    return {module_name}_kernels;
+}}
+
+/* Add kernels with given name to tbl. Return 1 on success, 0 when
+   there are no such kernels, and -1 on error. */
+int
+gmk_add_{module_name}_kernel(gm_tbl_t *tbl, const char *name, ndt_context_t *ctx)
+{{
+    static int initialized = 0;
+    const gm_kernel_init_t *k;
+    int found = 0;
+
+    if (!initialized) {{
+        if (gmk_test_{module_name}_typemaps(ctx) < 0) {{
+            return -1;
+        }}
+        {register_wrapper_stats}
+        initialized = 1;
+    }}
 
+    for (k = {module_name}_kernels; k->name != NULL; k++) {{
+        if (strcmp(k->name, name) == 0) {{
+            if (gm_add_kernel(tbl, k, ctx) < 0) {{
+                return -1;
+            }}
+            found = 1;
+        }}
+    }}
+    return found;
+}}
 '''
 
+c_source_template = (source_doc_template + source_includes_template
+                     + source_constraints_template + source_kernels_template
+                     + source_tables_template)
+
+# With `shards: N`, the kernels are split between N C sources that
+# include a shared header, see stream_source.
+
+c_header_template = '''\
+/*
+  This file is auto-generated.
+
+  Module: {module_name}
+ */
+#ifndef GMK_{module_name}_KERNELS_H
+#define GMK_{module_name}_KERNELS_H
+''' + source_includes_template + '''
+#endif
+'''
+
+c_shard_template = '''\
+/*
+  This file is auto-generated.
+
+  Module: {module_name}
+ */
+#include "{kernels_header}"
+''' + source_kernels_template
+
+c_table_template = (source_doc_template + '''\
+#include "{kernels_header}"
+''' + source_constraints_template + '''
+/****************************************************************************/
+/*                       Kernels declarations                               */
+/****************************************************************************/
+{kernel_declarations-list}
+''' + source_tables_template)
+
 typemap_tests_template = '''
     orig_size = sizeof({orig_type});
     normal_size = sizeof({normal_type});
@@ -390,8 +573,8 @@ typemap_tests_template = '''
 '''
 
 report_wrapper_counter_template = '''\
-if (!{wrapper_name}_counter)
-  printf("%5d | {wrapper_name}\\n", {wrapper_name}_counter);
+if ({wrapper_name}_counter)
+  printf("%5lld | {wrapper_name}\\n", (long long){wrapper_name}_counter);
 '''
 
 constraints_template = '''
@@ -418,12 +601,12 @@ kernel_template = '''
   Configuration:
 {kernel_repr}
 */
-static int {wrapper_name}_counter = 0;
-static int
-{wrapper_name}(xnd_t gmk_stack[], ndt_context_t *gmk_ctx) {{
+{stats_declaration}{counter_declaration}{wrapper_function_storage}int
+{wrapper_function_name}(xnd_t gmk_stack[], ndt_context_t *gmk_ctx) {{
   (void)gmk_stack;
   (void)gmk_ctx;
-  {wrapper_name}_counter += 1;
+  {counter_increment}
+  {stats_enter}
   {entering}
   int gmk_success = 0;
   {declarations-list}
@@ -431,17 +614,61 @@ static int
   {return_value}{function_name}({arguments-list});
   {body-end-list}
   {leaving}
+  {stats_leave}
   return gmk_success;
 }}
+{outer_wrapper}'''
+
+parallel_wrapper_template = '''
+{storage}int
+{wrapper_name}(xnd_t gmk_stack[], ndt_context_t *gmk_ctx) {{
+  return {outer_map};
+}}
+'''
+
+fused_wrapper_template = '''
+{storage}int
+{wrapper_name}(xnd_t gmk_stack[], ndt_context_t *gmk_ctx) {{
+  xnd_t gmk_fused[{nstack}];
+  int gmk_status = xndtools_fuse_outer(gmk_fused, gmk_stack, {nstack}, gmk_ctx);
+  if (gmk_status == 1) {{
+    gmk_status = {wrapper_name}_element(gmk_fused, gmk_ctx);
+    xndtools_fused_del(gmk_fused, {nstack});
+    return gmk_status;
+  }}
+  if (gmk_status < 0) {{
+    return gmk_status;
+  }}
+  return {outer_map};
+}}
 '''
 
 strided_kernel_template = '''
-static int
-{wrapper_name}(char **args, intptr_t *dimensions, intptr_t *steps, void *data) {{
+/*
+  Kernel: {kernel_name}
+  Signature: "{sig}"
+  External function: {function_name}
+  Configuration:
+{kernel_repr}
+*/
+{stats_declaration}{counter_declaration}{storage}int
+{wrapper_name}(char **gmk_args, intptr_t *gmk_dimensions, intptr_t *gmk_steps, void *gmk_data) {{
+  (void)gmk_args;
+  (void)gmk_dimensions;
+  (void)gmk_steps;
+  (void)gmk_data;
+  {counter_increment}
+  {stats_enter}
   {entering}
   int gmk_success = 0;
-  NOT_IMPLEMENTED_KIND_{kind}_for_{function_name};
+  {declarations-list}
+  for (intptr_t gmk_i = 0; gmk_i < {strided_length} && gmk_success == 0; gmk_i++) {{
+    {body-start-list}
+    {return_value}{function_name}({arguments-list});
+    {body-end-list}
+  }}
   {leaving}
+  {stats_leave}
   return gmk_success;
 }}
 '''
@@ -452,7 +679,15 @@ static int
 
 source_template = Template(
     dict(
-        c_source=c_source_template
+        c_source=(c_table_template, c_source_template) * is_sharded,
+        c_header=c_header_template * is_sharded,
+        c_shard=c_shard_template * is_sharded,
+    ),
+    variables=dict(
+        debug_macros=('', debug_macros_template) * is_lean,
+        wrapper_stats=('', wrapper_stats_template) * is_lean,
+        register_wrapper_stats=('', 'atexit(gmk_wrapper_stats_{module_name});') * is_lean,
+        lazy_registration=(lazy_registration_template, '') * is_lazy,
     ),
     initialize=initialize_source,
     join={
@@ -461,6 +696,8 @@ source_template = Template(
         'signatures-list': join_signatures_list,
         'typemap_tests-list': '',
         'report_wrapper_counter-list': '',
+        'kernel_stats-list': join_kernel_stats_list,
+        'kernel_declarations-list': join_kernel_declarations_list,
         'short_doc-list': join_short_doc_list,
         'constraint_entering-list': '\n',  # not used, to suppress warnigns
         'constraint_leaving-list': '\n',   # not used, to suppress warnigns
@@ -485,14 +722,25 @@ source_template['kernels'] = Template(
          constraints=[
              constraints_template * need_constraint,
              ],
-         signatures='{kernel_name}|{sig}|{nout_symbols}|.{kind}={wrapper_name}',
-         report_wrapper_counter=report_wrapper_counter_template,
+         signatures='{kernel_name}|{sig}|{nout_symbols}|.{kind}={wrapper_name}{vectorize}',
+         report_wrapper_counter=report_wrapper_counter_template * -is_lean,
+         kernel_declarations=[
+             ('int {wrapper_name}(char **, intptr_t *, intptr_t *, void *);',
+              'int {wrapper_name}(xnd_t [], ndt_context_t *);') * kind_is('Strided'),
+             'extern xndtools_kernel_stats_t {wrapper_name}_stats;' * stats,
+             ('extern int64_t {wrapper_name}_counter;',
+              'extern int {wrapper_name}_counter;') * (is_instrumented + is_parallel) * -is_lean,
+         ] * is_sharded,
+         kernel_stats=('&{wrapper_name}_stats,', '') * stats,
          short_doc='{kernel_name} - "{oneline_description}" @:@ {sig} @:@ {kind}',
          entering='DEBUGMSG("Entering {wrapper_name}\\n");' * debug,
          leaving='DEBUGMSG("Leaving {wrapper_name}\\n");' * debug,
          all_warnings='{warnings-list}',
     ),
     variables=dict(
+        # wrappers, their call counters and statistics are accessed
+        # from the kernels table
+        storage=('', 'static ') * is_sharded,
         constraint_entering=('DEBUGMSG("Entering {constraint_name}\\n");', '') * debug,
         constraint_leaving=('DEBUGMSG("Leaving {constraint_name}\\n");', '') * debug,
         wrapper_name=wrapper_name,
@@ -503,6 +751,19 @@ source_template['kernels'] = Template(
         return_value=('{function_name}_return_value_ = ', '') * -type_is('void'),
         entering=('DEBUGMSG("entering {}\\n");'.format(wrapper_name), '') * debug,
         leaving=('DEBUGMSG("leaving {}\\n");'.format(wrapper_name), '') * debug,
+        counter_declaration=('', ('{storage}int64_t {wrapper_name}_counter = 0;\n',
+                                  '{storage}int {wrapper_name}_counter = 0;\n') * (is_instrumented + is_parallel)) * is_lean,
+        counter_increment=('', ('xndtools_atomic_add(&{wrapper_name}_counter, 1);',
+                                '{wrapper_name}_counter += 1;') * (is_instrumented + is_parallel)) * is_lean,
+        stats_declaration=('{storage}xndtools_kernel_stats_t {wrapper_name}_stats = {{"{wrapper_name}", 0, 0, 0, 0}};\n', '') * stats,
+        stats_enter=('int64_t gmk_stats_mark[3];\n  xndtools_kernel_stats_enter(gmk_stats_mark);', '') * stats,
+        stats_leave=('xndtools_kernel_stats_leave(&{wrapper_name}_stats, gmk_stats_mark);', '') * stats,
+        wrapper_function_name=('{wrapper_name}_element', '{wrapper_name}') * (is_parallel + is_fused),
+        wrapper_function_storage=('static ', '{storage}') * (is_parallel + is_fused),
+        outer_map=('xndtools_parallel_map({wrapper_name}_element, gmk_stack, {nstack}, {stack_rank}, {parallel_chunk}, gmk_ctx)',
+                   'xndtools_outer_map({wrapper_name}_element, gmk_stack, {nstack}, {stack_rank}, gmk_ctx)') * is_parallel,
+        outer_wrapper=(fused_wrapper_template, (parallel_wrapper_template, '') * is_parallel) * is_fused,
+        vectorize=('|vectorize', '') * (is_parallel + is_fused),
     ),
     initialize=initialize_kernels,
     join={'declarations-list': '\n  ',
@@ -531,8 +792,17 @@ source_template['kernels']['arguments'] = Template(
 
             [('xnd_t gmk_input_{name} = gmk_stack[{input_index}];',
               'const xnd_t gmk_input_{name} = gmk_stack[{input_index}];')*(has('value')*(is_inplace+is_inout+is_inplace_output+is_inout_output)),
-             'DEBUGMSG1("gmk_input_{name}.type=%s\\n", ndt_as_string(gmk_input_{name}.type, gmk_ctx));'*debug] * (is_inany),
-            'const xnd_t gmk_output_{name} = gmk_stack[{output_index}];' * (is_outany),
+             'DEBUGMSG1("gmk_input_{name}.type=%s\\n", ndt_as_string(gmk_input_{name}.type, gmk_ctx));'*debug] * (is_inany) * -kind_is('Strided'),
+            'const xnd_t gmk_output_{name} = gmk_stack[{output_index}];' * (is_outany) * -kind_is('Strided'),
+
+            [
+                ['char *gmk_input_{name} = gmk_args[{input_index}];',
+                 'const intptr_t *gmk_input_{name}_dims = gmk_dimensions + {input_strided_index};',
+                 'const intptr_t *gmk_input_{name}_steps = gmk_steps + {input_strided_index};'] * (is_inany),
+                ['char *gmk_output_{name} = gmk_args[{output_index}];',
+                 'const intptr_t *gmk_output_{name}_dims = gmk_dimensions + {output_strided_index};',
+                 'const intptr_t *gmk_output_{name}_steps = gmk_steps + {output_strided_index};'] * (is_outany),
+            ] * is_array * kind_is('Strided'),
         ],
         constraint_declarations=[
             # constraints can use scalar arguments to initialize shapes of output arrays
@@ -577,7 +847,13 @@ else
                     '...*GMK_SCALAR_DATA({ctype}, gmk_input_{name}) = {name};' * (is_inplace+is_inout+is_inplace_output+is_inout_output)*is_scalar_ptr,
                     '...*GMK_SCALAR_DATA({ctype}, gmk_output_{name}) = {name};' * is_outany,
                 ]
-            ] * (is_scalar+is_scalar_ptr),
+            ] * (is_scalar+is_scalar_ptr) * -kind_is('Strided'),
+            [
+                '{name} = {value};...' * has('value') * (is_hide+is_output),
+                '{name} = *GMK_STRIDED_DATA({ctype}, {input_index});...' * (is_inany),
+                '...*GMK_STRIDED_DATA({ctype}, {input_index}) = {name};' * (is_inplace+is_inout+is_inplace_output+is_inout_output)*is_scalar_ptr,
+                '...*GMK_STRIDED_DATA({ctype}, {output_index}) = {name};' * is_outany,
+            ] * (is_scalar+is_scalar_ptr) * kind_is('Strided'),
             # ==================================================
             #                   Array arguments
             # ==================================================
@@ -585,7 +861,7 @@ else
                 [
                     [
                         '''\
-bool gmk_{name}_new = !ndt_{is_contiguous}(gmk_input_{name}.type);
+bool gmk_{name}_new = {xnd_new};
 if (gmk_{name}_new)
   {name} = ({ctype}*){xndtools_copy}(&gmk_input_{name}, gmk_ctx);
 else
@@ -593,11 +869,11 @@ else
 if ({name} != NULL) {{
 ...
   if (gmk_{name}_new)
-    free({name});
+    xndtools_scratch_free({name});
 }} else gmk_success = -1; /* if ({name} != NULL) */
 '''*(is_input),
                         '''\
-bool gmk_{name}_new = !ndt_{is_contiguous}(gmk_input_{name}.type);
+bool gmk_{name}_new = {xnd_new};
 if (gmk_{name}_new)
   {name} = ({ctype}*){xndtools_copy}(&gmk_input_{name}, gmk_ctx);
 else
@@ -606,13 +882,13 @@ if ({name} != NULL) {{
 ...
   if (gmk_{name}_new) {{
     {xndtools_inv_copy}((const char*){name}, &gmk_input_{name});
-    free({name});
+    xndtools_scratch_free({name});
   }}
 }} else gmk_success = -1; /* if ({name} != NULL) */
 '''*(is_inplace),
 
                         '''\
-bool gmk_{name}_new = !ndt_{is_contiguous}(gmk_input_{name}.type);
+bool gmk_{name}_new = {xnd_new};
 if (!gmk_{name}_new) {{
   {name} = GMK_FIXED_ARRAY_DATA({ctype}, gmk_input_{name});
 ...
@@ -622,34 +898,42 @@ if (!gmk_{name}_new) {{
 }}
 '''*(is_inout),
                         '''\
-{name} = malloc(xndtools_fixed_nbytes(&gmk_output_{name}));
+bool gmk_{name}_new = !ndt_{is_contiguous}(gmk_output_{name}.type);
+if (gmk_{name}_new)
+  {name} = ({ctype}*)xndtools_scratch_alloc(xndtools_fixed_nbytes(&gmk_output_{name}));
+else
+  {name} = GMK_FIXED_ARRAY_DATA({ctype}, gmk_output_{name});
 if ({name} != NULL) {{
 ...
-  {xndtools_inv_copy}((const char*){name}, &gmk_output_{name});
-  free({name});
+  if (gmk_{name}_new) {{
+    {xndtools_inv_copy}((const char*){name}, &gmk_output_{name});
+    xndtools_scratch_free({name});
+  }}
 }} else gmk_success = -1; /* if ({name} != NULL) */
 ''' * (is_output),
 
                         '''\
 size_t gmk_{name}_size = {shape_product};
-{name} = ({ctype}*)malloc(sizeof({ctype})*gmk_{name}_size);
+{name} = ({ctype}*)xndtools_scratch_alloc(sizeof({ctype})*gmk_{name}_size);
 if ({name} != NULL) {{
 ...
-free({name});
+xndtools_scratch_free({name});
 }} else gmk_success = -1; /* if ({name} != NULL) */
 ''' * is_hide,
 
                         '''\
-bool gmk_{name}_new = !ndt_{is_contiguous}(gmk_input_{name}.type);
+bool gmk_{name}_new = !ndt_{is_contiguous}(gmk_output_{name}.type);
 if (gmk_{name}_new)
   {name} = ({ctype}*){xndtools_copy}(&gmk_input_{name}, gmk_ctx);
-else
-  {name} = GMK_FIXED_ARRAY_DATA({ctype}, gmk_input_{name});
+else {{
+  {name} = GMK_FIXED_ARRAY_DATA({ctype}, gmk_output_{name});
+  xndtools_cpy((char*){name}, &gmk_input_{name}, {fortran_flag});
+}}
 if ({name} != NULL) {{
 ...
-  {xndtools_inv_copy}((const char*){name}, &gmk_output_{name});
   if (gmk_{name}_new) {{
-    free({name});
+    {xndtools_inv_copy}((const char*){name}, &gmk_output_{name});
+    xndtools_scratch_free({name});
   }}
 }} else gmk_success = -1; /* if ({name} != NULL) */
 '''*(is_input_output),
@@ -665,7 +949,7 @@ if ({name} != NULL) {{
   {xndtools_inv_copy}((const char*){name}, &gmk_output_{name});
   if (gmk_{name}_new) {{
     {xndtools_inv_copy}((const char*){name}, &gmk_input_{name});
-    free({name});
+    xndtools_scratch_free({name});
   }}
 }} else gmk_success = -1; /* if ({name} != NULL) */
 '''*(is_inplace_output),
@@ -691,10 +975,10 @@ if (!gmk_{name}_new) {{
 ''' * (is_input + is_inplace + is_inout),
                         '''\
 size_t gmk_{name}_size = {shape_product};
-{name} = ({ctype}*)malloc(sizeof({ctype})*gmk_{name}_size);
+{name} = ({ctype}*)xndtools_scratch_alloc(sizeof({ctype})*gmk_{name}_size);
 if ({name} != NULL) {{
 ...
-free({name});
+xndtools_scratch_free({name});
 }} else gmk_success = -1; /* if ({name} != NULL) */
 ''' * (is_hide),
                         '''\
@@ -712,7 +996,90 @@ xndtools_cpy((char*){name}, &gmk_input_{name}, ndt_{is_contiguous}(gmk_input_{na
 {xndtools_inv_copy}((const char*){name}, &gmk_output_{name});
 ''' * (is_inplace_output + is_inout_output),
 
-                    ] * (kind_is('C') + kind_is('Fortran'))
+                    ] * (kind_is('C') + kind_is('Fortran')),
+
+                    [
+                        '''\
+bool gmk_{name}_new = {strided_new};
+if (gmk_{name}_new)
+  {name} = ({ctype}*)xndtools_strided_copy(gmk_input_{name}, {strided_input});
+else
+  {name} = ({ctype}*)gmk_input_{name};
+if ({name} != NULL) {{
+...
+  if (gmk_{name}_new)
+    xndtools_scratch_free({name});
+}} else gmk_success = -1; /* if ({name} != NULL) */
+'''*(is_input),
+                        '''\
+bool gmk_{name}_new = {strided_new};
+if (gmk_{name}_new)
+  {name} = ({ctype}*)xndtools_strided_copy(gmk_input_{name}, {strided_input});
+else
+  {name} = ({ctype}*)gmk_input_{name};
+if ({name} != NULL) {{
+...
+  if (gmk_{name}_new) {{
+    xndtools_strided_invcpy((const char*){name}, gmk_input_{name}, {strided_input});
+    xndtools_scratch_free({name});
+  }}
+}} else gmk_success = -1; /* if ({name} != NULL) */
+'''*(is_inplace),
+                        '''\
+bool gmk_{name}_new = !xndtools_strided_is_contiguous({strided_output});
+if (gmk_{name}_new)
+  {name} = ({ctype}*)xndtools_scratch_alloc(xndtools_strided_nbytes({rank}, gmk_output_{name}_dims, sizeof({ctype})));
+else
+  {name} = ({ctype}*)gmk_output_{name};
+if ({name} != NULL) {{
+...
+  if (gmk_{name}_new) {{
+    xndtools_strided_invcpy((const char*){name}, gmk_output_{name}, {strided_output});
+    xndtools_scratch_free({name});
+  }}
+}} else gmk_success = -1; /* if ({name} != NULL) */
+''' * (is_output),
+                        '''\
+size_t gmk_{name}_size = {shape_product};
+{name} = ({ctype}*)xndtools_scratch_alloc(sizeof({ctype})*gmk_{name}_size);
+if ({name} != NULL) {{
+...
+xndtools_scratch_free({name});
+}} else gmk_success = -1; /* if ({name} != NULL) */
+''' * is_hide,
+                        '''\
+bool gmk_{name}_new = !xndtools_strided_is_contiguous({strided_output});
+if (gmk_{name}_new)
+  {name} = ({ctype}*)xndtools_strided_copy(gmk_input_{name}, {strided_input});
+else {{
+  {name} = ({ctype}*)gmk_output_{name};
+  xndtools_strided_cpy((char*){name}, gmk_input_{name}, {strided_input});
+}}
+if ({name} != NULL) {{
+...
+  if (gmk_{name}_new) {{
+    xndtools_strided_invcpy((const char*){name}, gmk_output_{name}, {strided_output});
+    xndtools_scratch_free({name});
+  }}
+}} else gmk_success = -1; /* if ({name} != NULL) */
+'''*(is_input_output),
+                        '''\
+bool gmk_{name}_new = !xndtools_strided_is_contiguous({strided_input});
+if (gmk_{name}_new)
+  {name} = ({ctype}*)xndtools_strided_copy(gmk_input_{name}, {strided_input});
+else
+  {name} = ({ctype}*)gmk_input_{name};
+if ({name} != NULL) {{
+...
+  xndtools_strided_invcpy((const char*){name}, gmk_output_{name}, {strided_output});
+  if (gmk_{name}_new) {{
+    xndtools_strided_invcpy((const char*){name}, gmk_input_{name}, {strided_input});
+    xndtools_scratch_free({name});
+  }}
+}} else gmk_success = -1; /* if ({name} != NULL) */
+'''*(is_inplace_output),
+
+                    ] * kind_is('Strided'),
                 ]
             ] * is_array * -has('value'),
         ],
@@ -732,6 +1099,15 @@ xndtools_cpy((char*){name}, &gmk_input_{name}, ndt_{is_contiguous}(gmk_input_{na
         xndtools_copy=('xndtools_fcopy', 'xndtools_copy') * is_fortran,
         xndtools_inv_copy=('xndtools_inv_fcopy',
                            'xndtools_inv_copy') * is_fortran,
+        fortran_flag=('true', 'false') * is_fortran,
+        strided_input=('{rank}, gmk_input_{name}_dims, gmk_input_{name}_steps, sizeof({ctype}), {fortran_flag}', '') * is_array,
+        strided_output=('{rank}, gmk_output_{name}_dims, gmk_output_{name}_steps, sizeof({ctype}), {fortran_flag}', '') * is_array,
+        # arrays with stride() value are copied only when their
+        # leading stride cannot be passed to the function
+        xnd_new=('(xndtools_fixed_stride(&gmk_input_{name}, {fortran_flag}, false) == 0)',
+                 '!ndt_{is_contiguous}(gmk_input_{name}.type)') * has('stride'),
+        strided_new=('(xndtools_strided_stride({strided_input}, false) == 0)',
+                     '!xndtools_strided_is_contiguous({strided_input})') * has('stride'),
         # xndtools_fcopy=('xndtools_copy', 'xndtools_fcopy') * is_fortran,
         sigdims=('{ellipses}{dimension-list} * ',
                  '{ellipses}') * has('dimension-list'),
@@ -752,6 +1128,175 @@ source_template['kernels']['arguments']['shape'] = Template(
     name='source-template/kernels/arguments/shape',
 )
 
+#
+# Parallel rendering of kernels
+#
+
+_parent_data = None
+
+
+def _set_parent_data(parent_data):
+    global _parent_data
+    _parent_data = parent_data
+
+
+def _render_kernel(index):
+    return source_template['kernels'](_parent_data['kernels'][index],
+                                      _parent_data)
+
+
+def iter_kernels(kernels, parent_data, jobs=1):
+    """Generate the results of source_template['kernels'] applied to
+    kernels, in order. Kernels are rendered using `jobs` processes
+    (all processors when `jobs` is None).
+    """
+    if jobs == 1 or len(kernels) < 2:
+        for kernel in kernels:
+            yield source_template['kernels'](kernel, parent_data)
+        return
+    processes = jobs or os.cpu_count() or 1
+    chunksize = max(1, len(kernels) // (4 * processes))
+    # forked workers share the hash seed, and so the order of sets
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    with context.Pool(processes, initializer=_set_parent_data,
+                      initargs=(parent_data,)) as pool:
+        yield from pool.imap(_render_kernel, range(len(kernels)),
+                             chunksize=chunksize)
+
+
+def render_source(data, jobs=1, template=source_template):
+    """Return template(data) where kernels are rendered using
+    `jobs` processes (all processors when `jobs` is None). The result
+    is identical to serial rendering.
+    """
+    if jobs == 1 or len(data.get('kernels', [])) < 2:
+        return template(data)
+
+    def map_kernels(kernels, parent_data):
+        return list(iter_kernels(kernels, parent_data, jobs=jobs))
+
+    return template(data, maps=dict(kernels=map_kernels))
+
+
+class _FragmentSpool(object):
+    """Temporary file of the distinct rendered C functions (constraints
+    and kernels). Fragments are read in the order of their contents,
+    see join_kernels_list and join_constraints_list.
+    """
+
+    prefix_size = 128
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        # list key: [(prefix, offset, size, crc)]
+        self.entries = defaultdict(list)
+        self.digests = set()
+
+    def add(self, key, fragments):
+        for fragment in flatten(fragments):
+            content = fragment.encode()
+            digest = hashlib.sha1(content).digest()
+            if not content or (key, digest) in self.digests:
+                continue
+            self.digests.add((key, digest))
+            self.file.seek(0, os.SEEK_END)
+            self.entries[key].append((content[:self.prefix_size],
+                                      self.file.tell(), len(content),
+                                      zlib.crc32(content)))
+            self.file.write(content)
+
+    def _content(self, entry):
+        self.file.seek(entry[1])
+        return self.file.read(entry[2])
+
+    def _sorted(self, key):
+        """Sort the entries of list key by contents. Only the entries
+        with equal prefixes are compared by reading their contents.
+        """
+        entries = sorted(self.entries[key])
+        i = 0
+        while i < len(entries):
+            j = i + 1
+            while j < len(entries) and entries[j][0] == entries[i][0]:
+                j += 1
+            if j - i > 1:
+                entries[i:j] = sorted(entries[i:j], key=self._content)
+            i = j
+        self.entries[key] = entries
+        return entries
+
+    def read(self, key, shard=None, shards=1):
+        """Generate the fragments of list key (of the given shard).
+        """
+        for entry in self._sorted(key):
+            if shard is None or entry[3] % shards == shard:
+                yield self._content(entry).decode()
+
+
+def stream_source(data, jobs=1):
+    """Return a dict of generators of the parts of rendered sources:
+    'c_source' generates render_source(data, jobs)['c_source'] and,
+    when the kernels are split between data['shards'] sources,
+    'c_header' generates the shared header and 'c_shards' is a list
+    of generators of the kernels sources.
+
+    Kernels are rendered one at a time: the C functions of a kernel
+    (constraints and kernels lists) are written to a temporary file
+    and the remaining results (signatures, declarations, etc) are kept
+    for rendering the source skeletons with markers in place of the
+    constraints and kernels lists. The generators read the C functions
+    from the temporary file one by one, so that, apart from the
+    skeletons (the module doc, the signatures and statistics tables,
+    one line or so per kernel), the memory use is bounded by the
+    largest kernel rather than the size of sources.
+    """
+    spool = _FragmentSpool()
+    deferred = ['constraints', 'kernels']
+
+    def map_kernels(kernels, parent_data):
+        results = []
+        for result in iter_kernels(kernels, parent_data, jobs=jobs):
+            for key in deferred:
+                spool.add(key + '-list', result.get(key, []))
+                result[key] = []
+            results.append(result)
+        return results
+
+    def marker(key):
+        return lambda lst: '\0{}\0'.format(key)
+
+    template = Template(source_template.template,
+                        variables=source_template.variables,
+                        initialize=source_template.initialize,
+                        join=dict(source_template.join,
+                                  **{key + '-list': marker(key + '-list')
+                                     for key in deferred}),
+                        name=source_template.name)
+    template.subtemplates = source_template.subtemplates
+    result = template(data, maps=dict(kernels=map_kernels))
+
+    def parts(skeleton, shard=None, shards=1):
+        for i, part in enumerate(re.split(r'\0([\w-]+)\0', skeleton)):
+            if i % 2 == 0:
+                yield part
+            elif part == 'kernels-list':
+                yield from spool.read(part, shard=shard, shards=shards)
+            else:
+                yield from spool.read(part)
+
+    shards = data.get('shards', 1)
+    if shards == 1:
+        return dict(c_source=parts(result['c_source']))
+    # kernels are assigned to shards by their content so that adding
+    # or removing a kernel changes one shard only
+    return dict(c_source=parts(result['c_source']),
+                c_header=parts(result['c_header']),
+                c_shards=[parts(result['c_shard'], shard=i, shards=shards)
+                          for i in range(shards)])
+
 #
 #
 #
@@ -0,0 +1,149 @@
+"""Provides: read_headers, load_index, save_index.
+
+C function prototypes of header files are read by worker processes
+and can be recorded in a prototype index file, so that re-running
+`xnd_tools config` on a large SDK reads only the header files that
+have been modified since.
+
+The index file is gzip-compressed JSON that holds a hash of the reader
+(xndtools version, generator sources and reader options, see
+`cache.py`) and, per header file path, the modification time and size
+of the header file and the prototypes read from it, in the order of
+reading. The prototypes are grouped by their signatures in
+`generate_config` because the groups depend on the typemap options.
+
+Each header file is read by a new PrototypeReader without match and
+exclude patterns: unlike reading header files one after another by
+the same reader, names of types from one header file do not affect
+reading another header file.
+"""
+
+import os
+import json
+import gzip
+import hashlib
+import multiprocessing
+from .readers import PrototypeReader
+from .utils import Prototype, ArgumentDeclaration
+from .cache import _get_generator_hash
+
+
+def index_key(reader_options):
+    """Return hash of reader and its options.
+    """
+    h = hashlib.sha256(_get_generator_hash().encode())
+    h.update(json.dumps(reader_options, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def load_index(index_file, key):
+    """Return header entries of index_file, or an empty dict when the
+    index is missing or has been recorded with a different key.
+    """
+    if not os.path.isfile(index_file):
+        return {}
+    try:
+        with gzip.open(index_file, 'rt') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if index.get('key') != key:
+        return {}
+    return index['headers']
+
+
+def save_index(index_file, key, headers):
+    """Record header entries in index_file.
+    """
+    tmp_file = index_file + '.tmp'
+    with gzip.open(tmp_file, 'wt') as f:
+        json.dump(dict(key=key, headers=headers), f, separators=(',', ':'))
+    os.replace(tmp_file, index_file)
+
+
+def _header_stat(filename):
+    st = os.stat(filename)
+    return dict(mtime=st.st_mtime_ns, size=st.st_size)
+
+
+def _to_items(prototypes):
+    items = []
+    for prototype in prototypes:
+        item = dict(prototype)
+        item['arguments'] = [dict(a) for a in prototype['arguments']]
+        items.append(item)
+    return items
+
+
+def _from_items(items):
+    prototypes = []
+    for item in items:
+        prototype = Prototype(item)
+        prototype['arguments'] = [ArgumentDeclaration(a)
+                                  for a in item['arguments']]
+        prototypes.append(prototype)
+    return prototypes
+
+
+_reader_options = None
+
+
+def _set_reader_options(reader_options):
+    global _reader_options
+    _reader_options = reader_options
+
+
+def _read_header(filename):
+    """Return index entry of header file.
+    """
+    entry = _header_stat(filename)
+    with open(filename) as f:
+        source = f.read()
+    reader = PrototypeReader(**_reader_options)
+    entry['prototypes'] = _to_items(reader(source))
+    return entry
+
+
+def read_headers(header_files, reader_options={}, jobs=1, index_file=None):
+    """Return a list of prototype lists of header files. Header files
+    are read using `jobs` processes (all processors when `jobs` is
+    None or 0). When `index_file` is specified, only the header files
+    that are not recorded in the index or have been modified are read,
+    and the index is updated.
+    """
+    key = index_key(reader_options)
+    headers = {}
+    if index_file is not None:
+        headers = load_index(index_file, key)
+    paths = [os.path.abspath(filename) for filename in header_files]
+    modified = []
+    for path in paths:
+        entry = headers.get(path)
+        if entry is None or any(entry[k] != v for k, v
+                                in _header_stat(path).items()):
+            modified.append(path)
+    # duplicates are read once
+    modified = list(dict.fromkeys(modified))
+
+    if modified:
+        print('read_headers: reading {} of {} header files'
+              .format(len(modified), len(paths)))
+        processes = min(jobs or os.cpu_count() or 1, len(modified))
+        if processes == 1:
+            _set_reader_options(reader_options)
+            entries = list(map(_read_header, modified))
+        else:
+            if 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+            else:
+                context = multiprocessing.get_context()
+            with context.Pool(processes, initializer=_set_reader_options,
+                              initargs=(reader_options,)) as pool:
+                entries = pool.map(_read_header, modified)
+        headers.update(zip(modified, entries))
+        if index_file is not None:
+            save_index(index_file, key, headers)
+    elif index_file is not None:
+        print('read_headers: {} header files are up to date in {}'
+              .format(len(paths), index_file))
+    return [_from_items(headers[path]['prototypes']) for path in paths]
@@ -29,6 +29,67 @@ def load_kernel_config(filename):
     return config
 
 
+def get_module_name(filename):
+    """ Return module name of kernel configuration file.
+    """
+    config = load_kernel_config(filename)
+    if config is None:
+        return
+    for section in config.sections():
+        if section.startswith('MODULE'):
+            return section.split(None, 1)[1]
+
+
+# Patterns of PrototypeReader, compiled once
+
+_comment_sub = re.compile(r'/[*].*?[*]/', re.MULTILINE | re.DOTALL).sub
+_white_sub = re.compile(r'\s+', re.MULTILINE | re.DOTALL).sub
+# word or left modifier (`[&]` or `[*]+`) or right modifier (`[]`),
+# or an unexpected character
+_typespec_tokens = re.compile(
+    r'(?:([a-zA-Z_]\w*)|([*][*\s]*|[&]|[\[]\s*[\]])|(.))\s*',
+    re.DOTALL).findall
+_typespec_words_match = re.compile(
+    r'(?:(?:[a-zA-Z_]\w*|[*][*\s]*|[&]|[\[]\s*[\]])\s*)*').match
+# C function prototype `<typespec name>(<arguments>);` that starts a
+# line, split in two parts
+_prototype_head_match = re.compile(r'\s*([A-Za-z_][\w\s*]*)?').match
+_prototype_tail_match = re.compile(r'\(([\w,\s*&\\\[\]]*)\)\s*;').match
+
+
+def scan_prototypes(source):
+    """Generate (typespec name, arguments) pairs of C function
+    prototypes in source, a source without comments and CPP
+    directives, in one pass.
+
+    A prototype starts at a line and has the form
+
+      <typespec name>(<arguments>);
+
+    where <typespec name> consists of words, `*` and white space, and
+    <arguments> consists of words, `,`, `*`, `&`, `[`, `]`, `\\` and
+    white space.
+    """
+    start = 0
+    while start != -1:
+        m = _prototype_head_match(source, start)
+        end = m.end()
+        if m.group(1) is not None:
+            t = _prototype_tail_match(source, end)
+            if t is not None:
+                end = t.end()
+                yield m.group(1), t.group(1)
+        # the lines that start within the scanned text would end at
+        # the same position, so continue from the next line
+        start = source.find('\n', end)
+
+
+def compile_patterns(patterns):
+    """Return a list of compiled re patterns.
+    """
+    return [re.compile(p) if isinstance(p, str) else p for p in patterns]
+
+
 class PrototypeReader(object):
     """ Reader of C function prototypes.
 
@@ -38,6 +99,11 @@ class PrototypeReader(object):
       source = open(<header filename>).read()
       prototypes = reader(source, include_patterns = [], exclude_patterns = [])
 
+    or, to process the prototypes as these are read:
+
+      for prototype in reader.iter_prototypes(source):
+          ...
+
     """
     def __init__(self,
                  extra_specifiers=[],
@@ -70,36 +136,16 @@ class PrototypeReader(object):
 
         """
         s = source.strip()
-        word_match = re.compile(r'\A[a-zA-Z_]\w*', re.MULTILINE).match
-        left_modifier_match = re.compile(r'\A([*][*\s]*|[&])',
-                                         re.MULTILINE).match
-        right_modifier_match = re.compile(r'\A[\[]\s*[\]]',
-                                          re.MULTILINE).match
-
-        remove_white = (lambda s: re.sub(r'\s+', '', s,
-                                         flags=re.MULTILINE | re.DOTALL))
         default_name = None
         if index is not None:
             default_name = 'arg{}'.format(index)
         # split source to words
         words = []
-        while s:
-            m = word_match(s)
-            if m is not None:
-                word, s = s[:m.end()], s[m.end():].lstrip()
-                words.append(word)
-                continue
-            m = left_modifier_match(s)
-            if m is not None:
-                word, s = remove_white(s[:m.end()]), s[m.end():].lstrip()
-                words.append(word)
-                continue
-            m = right_modifier_match(s)
-            if m is not None:
-                word, s = remove_white(s[:m.end()]), s[m.end():].lstrip()
-                words.append(word)
-                continue
-            raise NotImplementedError(repr((s, source)))
+        for word, modifier, other in _typespec_tokens(s):
+            if other:
+                rest = s[_typespec_words_match(s).end():]
+                raise NotImplementedError(repr((rest, source)))
+            words.append(word or _white_sub('', modifier))
 
         # extract typespec data and name
         attrs = {}
@@ -151,7 +197,24 @@ class PrototypeReader(object):
         self._type_specs.update(attrs['type'].split())
         return attrs
 
-    def __call__(self, source, match_patterns=[], exclude_patterns=[]):
+    def select(self, name, match_patterns, exclude_patterns,
+               exclude_names=frozenset()):
+        """Return True when function name matches some of match_patterns
+        (or these are empty), is not in exclude_names, and matches none
+        of exclude_patterns, see compile_patterns.
+        """
+        if match_patterns and not any(p.match(name)
+                                      for p in match_patterns):
+            print('{}: no match: {}'.format(type(self).__name__, name))
+            return False
+        if name in exclude_names or any(p.match(name)
+                                        for p in exclude_patterns):
+            print('{}: excluded: {}'.format(type(self).__name__, name))
+            return False
+        return True
+
+    def __call__(self, source, match_patterns=[], exclude_patterns=[],
+                 exclude_names=frozenset()):
         """Extract C function prototypes from a text source.
 
         Returns a list of Prototype instances.  The Prototype instance is
@@ -165,59 +228,40 @@ class PrototypeReader(object):
         exclude pattern, the corresponding prototype will be skipped
         (even when function name matches some include pattern).
 
-        """
-        comment_re = r'/[*].*?[*]/'
-        cfuncproto_re = (
-            r'(?=\n|\A)\s*([A-Za-z_][\w\s*]*)\(([\w,\s*&\\\[\]]*?)\)\s*;')
+        Exclude names is a set of function names that are skipped,
+        for instance, the names of existing kernels. Unlike patterns,
+        the names are looked up in constant time.
 
+        """
+        return list(self.iter_prototypes(source,
+                                         match_patterns=match_patterns,
+                                         exclude_patterns=exclude_patterns,
+                                         exclude_names=exclude_names))
+
+    def iter_prototypes(self, source, match_patterns=[], exclude_patterns=[],
+                        exclude_names=frozenset()):
+        """Generate C function prototypes of a text source, see __call__.
+        """
         # remove /* */ comments:
-        source = re.sub(comment_re, '', source,
-                        flags=re.MULTILINE | re.DOTALL)
+        source = _comment_sub('', source)
         # resolve line continuations:
         source = source.replace('\\\n', '')
         # remove CPP directive lines:
         source = '\n'.join(line for line in source.split('\n')
                            if not line.startswith('#'))
 
-        _match_patterns = []
-        for p in match_patterns:
-            if isinstance(p, str):
-                p = re.compile(p)
-            _match_patterns.append(p)
-        _exclude_patterns = []
-        for p in exclude_patterns:
-            if isinstance(p, str):
-                p = re.compile(p)
-            _exclude_patterns.append(p)
-
-        prototypes = []
-        for typespec_name, arguments in re.findall(cfuncproto_re, source,
-                                                   re.MULTILINE | re.DOTALL):
+        match_patterns = compile_patterns(match_patterns)
+        exclude_patterns = compile_patterns(exclude_patterns)
+
+        for typespec_name, arguments in scan_prototypes(source):
             typespec_name = typespec_name.strip()
             arguments = arguments.strip()
             func_attrs = self.resolve_typespec_name(typespec_name)
             func_name = func_attrs.get('name')
             if not func_name:  # a function must have a name
                 continue
-
-            skip = True and _match_patterns
-            for p in _match_patterns:
-                if p.match(func_name):
-                    skip = False
-                    break
-            if skip:
-                print('{}: no match: {}'.format(type(self).__name__,
-                                                func_name))
-                continue
-
-            skip = False
-            for p in _exclude_patterns:
-                if p.match(func_name):
-                    skip = True
-                    break
-            if skip:
-                print('{}: excluded: {}'.format(type(self).__name__,
-                                                func_name))
+            if not self.select(func_name, match_patterns, exclude_patterns,
+                               exclude_names):
                 continue
 
             # extract function specifiers
@@ -255,10 +299,7 @@ class PrototypeReader(object):
                     arg_attrs = self.resolve_typespec_name(arg, index=i)
                     args.append(ArgumentDeclaration(arg_attrs))
                     arg_map[args[-1]['name']] = i
-            prototype = Prototype(func_attrs)
-            prototypes.append(prototype)
-
-        return prototypes
+            yield Prototype(func_attrs)
 
 
 def _main():
@@ -275,7 +316,7 @@ def _main():
     for filename in sys.argv[1:]:
         print(filename)
         source = open(filename).read()
-        for p in reader(source, exclude_patterns=[
+        for p in reader.iter_prototypes(source, exclude_patterns=[
                 r'.*_work\Z', r'.*_\Z', r'\A[A-Z0-9_]+\Z']):
             print(p['name'])
             counter += 1
@@ -5,6 +5,11 @@ Template - base class for templates.
 Predicate - predicate function that implements boolean operations
   (not, or, and) using arithmetic operations (-, +, *).
 
+Templates are compiled on first use (see Template.compile): format
+strings are parsed once and the conditional constructs are turned
+into closures, so that applying a template to many data items (e.g.
+kernels) does not re-walk the template target.
+
 Basic usage
 -----------
 
@@ -22,7 +27,8 @@ See test() function for an example.
 # Author: Pearu Peterson
 # Created: May 2018
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from string import Formatter
 
 
 def flatten(lst_of_lst):
@@ -37,6 +43,81 @@ def flatten(lst_of_lst):
     return lst
 
 
+def dependency_order(dependencies):
+    """ Order names by their dependencies.
+
+    Parameters
+    ----------
+    dependencies : dict
+      Specify a mapping of names and the sets of names they depend
+      on. Dependencies that are not keys of the mapping are never
+      satisfied.
+
+    Returns
+    -------
+    order : list
+      Names with satisfied dependencies. The order is the same as the
+      one of repeated scans of `dependencies` that append the names
+      whose dependencies are already in `order`, but it is computed in
+      linear time (up to sorting).
+    unresolved : list
+      Names with circular or unsatisfied dependencies.
+    """
+    index = {}
+    count = {}
+    dependents = defaultdict(list)
+    for name, deps in dependencies.items():
+        index[name] = len(index)
+        count[name] = len(deps)
+        for dep in deps:
+            dependents[dep].append(name)
+    ready = deque(name for name in dependencies if not count[name])
+    topo = []
+    while ready:  # Kahn's algorithm
+        name = ready.popleft()
+        topo.append(name)
+        for dependent in dependents[name]:
+            count[dependent] -= 1
+            if not count[dependent]:
+                ready.append(dependent)
+    # Scan number of names: 0 for independent names, otherwise the
+    # first scan after the dependencies are appended.
+    scan = {}
+    for name in topo:
+        scan[name] = 0
+        for dep in dependencies[name]:
+            if not scan[dep]:  # independent names precede the first scan
+                s = 1
+            elif index[dep] < index[name]:  # appended earlier in same scan
+                s = scan[dep]
+            else:
+                s = scan[dep] + 1
+            scan[name] = max(scan[name], s)
+    order = sorted(topo, key=lambda name: (scan[name], index[name]))
+    unresolved = [name for name in dependencies if name not in scan]
+    return order, unresolved
+
+
+def dependency_cycle(dependencies, unresolved):
+    """ Return a path of circular or unsatisfied dependencies
+    starting from the first unresolved name, see dependency_order.
+    """
+    unresolved_set = set(unresolved)
+    path = [unresolved[0]]
+    position = {unresolved[0]: 0}
+    while True:
+        deps = dependencies.get(path[-1])
+        if deps is None:
+            return path  # unknown dependency
+        name = min((dep for dep in deps
+                    if dep in unresolved_set or dep not in dependencies),
+                   key=str)
+        if name in position:
+            return path[position[name]:] + [name]
+        position[name] = len(path)
+        path.append(name)
+
+
 class verbosedefaultdict(defaultdict):
     """ When activated, report missing keys as not implemented features.
     """
@@ -127,6 +208,116 @@ def apply_format_map(obj, data, inplace=False):
     raise NotImplementedError(repr(type(obj)))
 
 
+def _compile_str(obj):
+    """ Compile `obj.format_map` to a function of data with
+    pre-parsed format fields.
+    """
+    def format_map(data):
+        try:
+            return obj.format_map(data)
+        except Exception:
+            print('apply_format_map:\n{}\n{}\n-----------------'
+                  .format(obj, data.keys()))
+            raise
+
+    try:
+        fields = list(Formatter().parse(obj))
+    except ValueError:
+        return format_map  # raises when applied
+    parts = []
+    for literal, name, spec, conversion in fields:
+        if literal:
+            parts.append((literal, None))
+        if name is None:
+            continue
+        if (not name or name.isdigit() or '.' in name or '[' in name
+                or spec or conversion):
+            return format_map
+        parts.append((None, name))
+    if not parts:
+        return lambda data: ''
+    if len(parts) == 1 and parts[0][1] is None:
+        literal = parts[0][0]
+        return lambda data: literal
+
+    def compiled(data):
+        lst = []
+        for literal, name in parts:
+            if name is None:
+                lst.append(literal)
+                continue
+            try:
+                value = data[name]
+            except Exception:
+                print('apply_format_map:\n{}\n{}\n-----------------'
+                      .format(obj, data.keys()))
+                raise
+            lst.append(value if type(value) is str else format(value))
+        return ''.join(lst)
+    return compiled
+
+
+def compile_format_map(obj, inplace=False):
+    """ Compile Python objects containing strings.
+
+    Returns
+    -------
+    func : callable
+      A function `func(data)` that is equivalent to
+      `apply_format_map(obj, data, inplace)`.
+    """
+    if obj is None:
+        return lambda data: None
+    if isinstance(obj, str):
+        return _compile_str(obj)
+    if isinstance(obj, list):
+        funcs = [compile_format_map(o) for o in obj]
+
+        def compiled(data):
+            lst = []
+            for f in funcs:
+                v = f(data)
+                if v is not None:
+                    lst.append(v)
+            return lst
+        return compiled
+    if isinstance(obj, tuple):
+        if len(obj) == 2:
+            predicate, ifobj = obj
+            elseobj = None
+        elif len(obj) == 3:
+            predicate, ifobj, elseobj = obj
+        else:
+            def compiled(data):
+                raise NotImplementedError(repr((type(obj), len(obj))))
+            return compiled
+        iffunc = compile_format_map(ifobj)
+        elsefunc = compile_format_map(elseobj)
+        return lambda data: (iffunc(data) if predicate(data)
+                             else elsefunc(data))
+    if isinstance(obj, dict):
+        items = [(k, compile_format_map(o)) for k, o in obj.items()]
+
+        def compiled(data):
+            dct = {}
+            for k, f in items:
+                v = f(data)
+                if v is not None:
+                    dct[k] = v
+                    if inplace:
+                        data[k] = v
+            return dct
+        return compiled
+    if isinstance(obj, Block):
+        startfunc = compile_format_map(obj.start)
+        endfunc = compile_format_map(obj.end)
+        return lambda data: type(obj)(startfunc(data), endfunc(data))
+
+    def compiled(data):
+        raise NotImplementedError(repr(type(obj)))
+    return compiled
+
+
 def apply_join(obj, data):
     """Apply data to Python object containing str.join functions.
 
@@ -254,6 +445,17 @@ class Template(object):
         self.name = name
         self.join = join
         self.sort = sort
+        self._compiled = None
+
+    def compile(self):
+        """ Return compiled template target and variables, see
+        compile_format_map. The result is cached.
+        """
+        if self._compiled is None:
+            self._compiled = (compile_format_map(self.template),
+                              compile_format_map(self.variables,
+                                                 inplace=True))
+        return self._compiled
 
     def __setitem__(self, key, value):
         self.subtemplates[key] = value
@@ -263,7 +465,7 @@ class Template(object):
     def __getitem__(self, key):
         return self.subtemplates[key]
 
-    def __call__(self, data, parent_data={}):
+    def __call__(self, data, parent_data={}, maps={}):
         """Apply data to template target and return result.
 
         Parameters
@@ -275,6 +477,11 @@ class Template(object):
         parent_data : dict
           Contains parents data. [INTERNAL]
 
+        maps : dict
+          Specify `key`-`map` pairs where `map(items, parent_data)`
+          returns the list of results of applying sub-template `key`
+          to the items of data `key` value, for instance, in parallel.
+
         Notes
         -----
 
@@ -299,10 +506,12 @@ class Template(object):
         concatenated together using `join` functions. The `join`
         functions may post-process the list, e.g. by sorting it.
         """
+        apply_template, apply_variables = self.compile()
         tmp_data = verbosedefaultdict(list)
         tmp_data['<data-keys>'] = '<'+'|'.join(data)+'>'
         if self.initialize is not None:
             self.initialize(data)
+        subtemplate_parent_data = None
         for k, v in data.items():
             if isinstance(v, list):
                 tmp_data[k] += v
@@ -320,10 +529,19 @@ class Template(object):
                           ' callable'.format(type(self).__name__,
                                              self.name, k))
                 else:
-                    for v_ in v:
-                        v__ = parent_data.copy()
-                        v__.update(data)
-                        r = subtemplate(v_, v__)
+                    if subtemplate_parent_data is None:
+                        # sub-templates do not modify parent data
+                        subtemplate_parent_data = parent_data.copy()
+                        subtemplate_parent_data.update(data)
+                    if k in maps:
+                        results = maps[k](v, subtemplate_parent_data)
+                    else:
+                        results = None
+                    for i, v_ in enumerate(v):
+                        if results is not None:
+                            r = results[i]
+                        else:
+                            r = subtemplate(v_, subtemplate_parent_data)
                         if r is None:
                             pass
                         elif isinstance(r, str):
@@ -380,7 +598,7 @@ class Template(object):
 
         tmp_data.activate(self.name)
 
-        variables = apply_format_map(self.variables, tmp_data, inplace=True)
+        variables = apply_variables(tmp_data)
 
         for k, v in variables.items():
             if k in tmp_data:
@@ -392,7 +610,7 @@ class Template(object):
             else:
                 tmp_data[k] = v
 
-        return apply_format_map(self.template, tmp_data)
+        return apply_template(tmp_data)
 
     def _get_join(self, k, data):
         j = apply_join(self.join.get(k), data)
@@ -503,20 +721,10 @@ def test():
             else:
                 deps = set()
             d[name] = deps
-        lst = [n for n in d if not d[n]]
-        n_ = None
-        while len(lst) < len(d):
-            if len(lst) == n_:
-                print('join_initialize:WARNING:circular dependence detected!:'
-                      ' {!r}'.format(d))
-                break
-            n_ = len(lst)
-            for n, deps in d.items():
-                if n in lst:
-                    continue
-                if not deps.difference(lst):
-                    lst.append(n)
-                    continue
+        lst, unresolved = dependency_order(d)
+        if unresolved:
+            print('join_initialize:WARNING:circular dependence detected!:'
+                  ' {}'.format(' -> '.join(dependency_cycle(d, unresolved))))
         return '\n  '.join([stmts[n] for n in lst])
 
     template['kernels'] = Template(
@@ -30,3 +30,32 @@ long test_array_ranges(long n, long*x)
   }
   return s;
 }
+
+void test_array_cumsum(long n, long*x)
+{
+  int i;
+  for (i=1; i<n; i++)
+    x[i] += x[i-1];
+}
+
+void test_array_cumsum_incx(long n, long*x, long incx)
+{
+  int i;
+  for (i=1; i<n; i++)
+    x[i*incx] += x[(i-1)*incx];
+}
+
+void test_array_ranges_lda(long m, long n, long*x, long lda)
+{
+  int i, j;
+  for (i=0; i<m; i++)
+    for (j=0; j<n; j++)
+      x[i*lda+j] = i*10+j;
+}
+
+void test_array_square(long n, long*x, long*r)
+{
+  int i;
+  for (i=0; i<n; i++)
+    r[i] = x[i]*x[i];
+}
@@ -1,2 +1,6 @@
 extern long test_array_range(long n, long*x);
 extern long test_array_ranges(long n, long*x);
+extern void test_array_cumsum(long n, long*x);
+extern void test_array_cumsum_incx(long n, long*x, long incx);
+extern void test_array_ranges_lda(long m, long n, long*x, long lda);
+extern void test_array_square(long n, long*x, long*r);
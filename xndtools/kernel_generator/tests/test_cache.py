@@ -0,0 +1,88 @@
+import os
+import shutil
+import pytest
+from xndtools.kernel_generator.generate_kernel import generate_kernel
+from xndtools.kernel_generator.generate_module import generate_module
+
+
+def generate(config_file, source_dir, **options):
+    r = generate_kernel(config_file, source_dir=source_dir, **options)
+    return generate_module(config_file, source_dir=source_dir,
+                           sources=r['sources'], **options)
+
+
+def test_generation_cache(tmp_path, capsys):
+    config_file = str(tmp_path / 'test_scalar-kernels.cfg')
+    shutil.copy(os.path.join(os.path.dirname(__file__),
+                             'test_scalar-kernels.cfg'), config_file)
+    source_dir = str(tmp_path)
+    kernels_file = str(tmp_path / 'test_scalar-kernels.c')
+    module_file = str(tmp_path / 'test_scalar-python.c')
+
+    r = generate(config_file, source_dir)
+    assert r['sources'][:2] == [module_file, kernels_file]
+    os.utime(kernels_file, (0, 0))
+    os.utime(module_file, (0, 0))
+
+    # up to date, files are not touched
+    capsys.readouterr()
+    assert generate(config_file, source_dir) == r
+    assert capsys.readouterr().out.count('is up to date') == 2
+    assert os.path.getmtime(kernels_file) == 0
+    assert os.path.getmtime(module_file) == 0
+
+    # cache disabled, unchanged files are not rewritten
+    assert generate(config_file, source_dir, cache=False) == r
+    assert os.path.getmtime(kernels_file) == 0
+    assert os.path.getmtime(module_file) == 0
+
+    # changed generator options
+    generate(config_file, source_dir, build='instrumented')
+    assert os.path.getmtime(kernels_file) > 0
+    assert os.path.getmtime(module_file) == 0  # same content
+
+    # modified generated file
+    with open(kernels_file, 'a') as f:
+        f.write('/* modified */\n')
+    generate(config_file, source_dir, build='instrumented')
+    with open(kernels_file) as f:
+        assert 'modified' not in f.read()
+
+    # changed configuration file
+    os.utime(kernels_file, (0, 0))
+    with open(config_file, 'a') as f:
+        f.write('\n# comment\n')
+    capsys.readouterr()
+    generate(config_file, source_dir, build='instrumented')
+    assert capsys.readouterr().out.count('is unchanged') == 2
+    assert os.path.getmtime(kernels_file) == 0  # same content
+
+
+def test_shared_module_data(tmp_path, monkeypatch):
+    from xndtools.kernel_generator import generate_kernel as gk
+    config_file = os.path.join(os.path.dirname(__file__),
+                               'test_scalar-kernels.cfg')
+    source_dir = str(tmp_path)
+    calls = []
+
+    def get_module_data(*args, **kwargs):
+        calls.append(args)
+        return orig_get_module_data(*args, **kwargs)
+    orig_get_module_data = gk.get_module_data
+    monkeypatch.setattr(gk, 'get_module_data', get_module_data)
+
+    module_data = gk.ModuleData(config_file)
+    r = generate(config_file, source_dir, module_data=module_data)
+    assert len(calls) == 1
+    assert r['extname'] == 'test_scalar'
+
+    # up to date, module data is not computed
+    module_data = gk.ModuleData(config_file)
+    generate(config_file, source_dir, module_data=module_data)
+    assert len(calls) == 1
+    assert module_data._data is None
+
+    # module data of other options
+    with pytest.raises(ValueError, match='build'):
+        generate(config_file, source_dir, build='lean',
+                 module_data=module_data)
@@ -0,0 +1,81 @@
+import os
+from xndtools.kernel_generator.generate_config import generate_config
+
+
+headers = dict(
+    a='''
+double foo(double x);
+float foo_f(float x);
+int bar(int n, double *a);
+''',
+    b='''
+long car(long n, long *a);
+void dar(void);
+''')
+
+
+def write_headers(tmp_path):
+    for name, source in headers.items():
+        with open(str(tmp_path / (name + '.h')), 'w') as f:
+            f.write(source)
+    return [name + '.h' for name in headers]
+
+
+def read(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+def test_prototype_index(tmp_path, capsys):
+    includes = write_headers(tmp_path)
+    options = dict(includes=includes, include_dirs=[str(tmp_path)],
+                   exclude_patterns=[r'\Adar\Z'])
+    target = str(tmp_path / 'serial.cfg')
+    generate_config('test', target_file=target, **options)
+    expected = read(target)
+    assert 'KERNEL foo' in expected and 'KERNEL car' in expected
+    assert 'dar' not in expected
+
+    index_file = str(tmp_path / 'test.index')
+    target = str(tmp_path / 'parallel.cfg')
+    capsys.readouterr()
+    generate_config('test', target_file=target, jobs=2,
+                    index_file=index_file, **options)
+    assert 'reading 2 of 2 header files' in capsys.readouterr().out
+    assert read(target) == expected
+
+    # headers are up to date
+    os.remove(target)
+    generate_config('test', target_file=target, index_file=index_file,
+                    **options)
+    assert 'are up to date' in capsys.readouterr().out
+    assert read(target) == expected
+
+    # modified header
+    os.remove(target)
+    with open(str(tmp_path / 'b.h'), 'a') as f:
+        f.write('long ear(long n);\n')
+    generate_config('test', target_file=target, index_file=index_file,
+                    **options)
+    assert 'reading 1 of 2 header files' in capsys.readouterr().out
+    assert 'KERNEL ear' in read(target)
+
+
+def test_append_config(tmp_path, capsys):
+    includes = write_headers(tmp_path)
+    target = str(tmp_path / 'test.cfg')
+    generate_config('test', target_file=target, includes=includes[:1],
+                    include_dirs=[str(tmp_path)], exclude_patterns=['foo_f'])
+    content = read(target)
+    assert 'KERNEL foo' in content and 'foo_f' not in content
+
+    # existing kernels are excluded by exact names
+    capsys.readouterr()
+    generate_config('test', target_file=target, includes=includes,
+                    include_dirs=[str(tmp_path)])
+    out = capsys.readouterr().out
+    assert 'excluded: foo\n' in out and 'excluded: bar\n' in out
+    content = read(target)
+    assert content.count('[KERNEL foo]') == 1
+    for name in ['foo_f', 'car', 'dar']:
+        assert 'KERNEL {}'.format(name) in content
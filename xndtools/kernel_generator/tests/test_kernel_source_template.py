@@ -0,0 +1,88 @@
+import os
+import re
+import pprint
+import pytest
+from xndtools.kernel_generator.generate_kernel import (get_module_data,
+                                                         generate_kernel)
+from xndtools.kernel_generator.kernel_source_template import (
+    render_source, stream_source, initialize_kernels)
+from xndtools.kernel_generator.utils import (prettify, prettify_lines,
+                                             iter_lines)
+
+
+@pytest.mark.parametrize('module', ['test_scalar', 'test_array', 'test_mixed'])
+def test_parallel_rendering(module):
+    config_file = os.path.join(os.path.dirname(__file__),
+                               module + '-kernels.cfg')
+    source = render_source(get_module_data(config_file))
+    assert render_source(get_module_data(config_file), jobs=3) == source
+
+
+@pytest.mark.parametrize('module', ['test_scalar', 'test_array', 'test_mixed'])
+def test_stream_source(module):
+    config_file = os.path.join(os.path.dirname(__file__),
+                               module + '-kernels.cfg')
+    source = render_source(get_module_data(config_file,
+                                           shards=1))['c_source']
+    sources = stream_source(get_module_data(config_file, shards=1))
+    assert list(sources) == ['c_source']
+    parts = list(sources['c_source'])
+    assert len(parts) > 3
+    assert ''.join(parts) == source
+    lines = prettify_lines(iter_lines(parts))
+    assert '\n'.join(lines) == prettify(source)
+    sources = stream_source(get_module_data(config_file, shards=1), jobs=2)
+    assert ''.join(sources['c_source']) == source
+
+
+def test_lazy_kernel_repr(monkeypatch):
+    config_file = os.path.join(os.path.dirname(__file__),
+                               'test_array-kernels.cfg')
+    kernel = get_module_data(config_file)['kernels'][0]
+    expected = pprint.pformat(kernel, indent=4, compact=True)
+    calls = []
+    pformat = pprint.pformat
+    monkeypatch.setattr(pprint, 'pformat',
+                        lambda *args, **kws: calls.append(args) or
+                        pformat(*args, **kws))
+    initialize_kernels(kernel)
+    assert not calls  # not computed when unused
+    assert '{kernel_repr}'.format_map(kernel) == expected
+    assert '{kernel_repr}'.format_map(kernel) == expected
+    assert len(calls) == 1
+
+
+def test_sharded_source(tmp_path):
+    config_file = os.path.join(os.path.dirname(__file__),
+                               'test_array-kernels.cfg')
+    source = ''.join(stream_source(get_module_data(config_file))['c_source'])
+    data = get_module_data(config_file, shards=3)
+    data['kernels_header'] = 'test_array-kernels.h'
+    sources = stream_source(data)
+    table = ''.join(sources['c_source'])
+    header = ''.join(sources['c_header'])
+    shards = [''.join(parts) for parts in sources['c_shards']]
+    assert len(shards) == 3
+    assert '#include "test_array-kernels.h"' in table
+    assert '#include "test_array.h"' in header
+    assert 'Generated kernels' not in table
+    assert 'gm_kernel_init_t' not in ''.join(shards)
+    for shard in shards:
+        assert shard.startswith(shards[0][:shards[0].index('Generated')])
+    kernels = source[source.index('Generated kernels'):
+                     source.index('Test typemaps')]
+    wrappers = re.findall(r'\nstatic int\n(gmk_\w+)[(]', kernels)
+    assert len(wrappers) > 3
+    for wrapper in wrappers:
+        if wrapper.endswith('_element'):
+            continue
+        assert 'int {}('.format(wrapper) in table
+        assert sum('\nint\n{}('.format(wrapper) in shard
+                   for shard in shards) == 1
+
+    r = generate_kernel(config_file, source_dir=str(tmp_path), shards=3)
+    assert r['sources'][:4] == [str(tmp_path / 'test_array-kernels.c')] + [
+        str(tmp_path / 'test_array-kernels-{}.c'.format(i)) for i in range(3)]
+    assert os.path.isfile(str(tmp_path / 'test_array-kernels.h'))
+    with open(r['sources'][2]) as f:
+        assert f.read() == prettify(shards[1])
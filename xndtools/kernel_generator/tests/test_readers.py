@@ -1,3 +1,4 @@
+import pytest
 from xndtools.kernel_generator.readers import PrototypeReader
 
 
@@ -62,3 +63,35 @@ def test_PrototypeReader():
             assert p['left_modifier'] == '**'
 
     assert counter == source.count(';'), repr(counter)
+
+
+def test_PrototypeReader_scan():
+    source = '''int a, b
+    int f1(int a); int f2(void);
+/* int c1(int); */ double *
+  f3 (double x[], char *
+    s)
+    ;
+#define f4(x) x;
+#define G \\
+  int c2(int);
+int c3(int, (int));
+long f5(
+   const int n);
+int c4(int)
+'''
+    reader = PrototypeReader()
+    prototypes = reader.iter_prototypes(source)
+    assert not isinstance(prototypes, list)
+    prototypes = list(prototypes)
+    assert [p['name'] for p in prototypes] == ['f1', 'f3', 'f5']
+    # a prototype starts a line, f2 is not read
+    assert prototypes[0]['type'] == 'int'
+    assert prototypes[1]['left_modifier'] == '*'
+    assert [a['name'] for a in prototypes[1]['arguments']] == ['x', 's']
+    assert prototypes[2]['arguments'][0]['type_modifier'] == 'const'
+    assert [p['name'] for p in reader(source, exclude_patterns=['f3'])] == [
+        'f1', 'f5']
+
+    with pytest.raises(NotImplementedError, match=r"'\[2]', 'int x \[2]'"):
+        reader('int f(int x [2]);')
@@ -0,0 +1,90 @@
+import pytest
+from xndtools.kernel_generator.templating import (
+    Block, Predicate, verbosedefaultdict, apply_format_map,
+    compile_format_map, dependency_order, dependency_cycle)
+
+
+def test_compile_format_map():
+    is_a = Predicate(lambda data: data.get('a') == 'A')
+    objects = [
+        None,
+        '',
+        'text',
+        '{a}',
+        '{{{a}}} and {b-list}',
+        '{a:>4}|{n!r}|{n:03d}',
+        '{missing|a}',
+        ['{a}', None, ('{b-list}', ) * is_a, ('x', 'y') * -is_a],
+        ('{a}', None) * is_a,
+        dict(x='{a}', y=('{n}', None) * -is_a, z='{x}{x}'),
+        Block('/* {a} */...{n}'),
+        Block('{c}', ''),
+    ]
+    for obj in objects:
+        for inplace in [False, True]:
+            data1 = verbosedefaultdict(list, a='A', n=5, c='...')
+            data1['b-list'] = 'B'
+            data1.activate('test')
+            data2 = data1.copy()
+            data2.activate('test')
+            r1 = apply_format_map(obj, data1, inplace=inplace)
+            r2 = compile_format_map(obj, inplace=inplace)(data2)
+            if isinstance(r1, Block):
+                assert (r1.start, r1.end) == (r2.start, r2.end)
+            else:
+                assert r1 == r2
+            assert data1 == data2
+
+    with pytest.raises(KeyError):
+        compile_format_map('{a}')({})
+    with pytest.raises(ValueError):
+        compile_format_map('{a')({'a': 1})
+    with pytest.raises(NotImplementedError):
+        compile_format_map(1)({})
+
+
+def scan_order(d):
+    # the original quadratic ordering of join_initialize
+    lst = [n for n in d if not d[n]]
+    n_ = None
+    while len(lst) < len(d):
+        if len(lst) == n_:
+            break
+        n_ = len(lst)
+        for n, deps in d.items():
+            if n in lst:
+                continue
+            if not deps.difference(lst):
+                lst.append(n)
+    return lst
+
+
+def test_dependency_order():
+    import random
+    random.seed(2)
+    for n in range(1, 40):
+        names = ['a{}'.format(i) for i in range(n)]
+        random.shuffle(names)
+        d = {}
+        for name in names:
+            d[name] = set(random.sample(names, random.randint(0, min(3, n))))
+            if random.random() < 0.7:
+                # mostly acyclic
+                d[name] = set(dep for dep in d[name]
+                              if int(dep[1:]) < int(name[1:]))
+        order, unresolved = dependency_order(d)
+        assert order == scan_order(d)
+        assert set(order) | set(unresolved) == set(d)
+        if unresolved:
+            path = dependency_cycle(d, unresolved)
+            assert path[0] in unresolved
+            for a, b in zip(path, path[1:]):
+                assert b in d[a]
+            assert path[-1] in path[:-1]
+
+    d = dict(a={'b'}, b={'c'}, c={'a'}, d=set(), e={'d', 'f'})
+    order, unresolved = dependency_order(d)
+    assert order == ['d']
+    assert unresolved == ['a', 'b', 'c', 'e']
+    assert dependency_cycle(d, unresolved) == ['a', 'b', 'c', 'a']
+    assert dependency_cycle(d, ['e']) == ['e', 'f']
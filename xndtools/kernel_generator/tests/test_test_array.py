@@ -31,7 +31,16 @@ def test_array_range_input():
     assert_equal(a, xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t))
 
     # Strided kernel
-    # TODO
+    a = xnd([1, 2, 3], dtype=long_t)
+    r = m.test_array_cumsum_input_strided(a)
+    assert r is None
+    assert_equal(a, xnd([1, 3, 6], dtype=long_t))  # because `a` matches exactly
+
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    x = a[1::2]
+    r = m.test_array_cumsum_input_strided(x)
+    assert_equal(x, xnd([2, 4, 6], dtype=long_t))
+    assert_equal(a, xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t))
 
 
 def test_array_range_inplace():
@@ -54,7 +63,12 @@ def test_array_range_inplace():
     assert_equal(a, xnd([1, 0, 3, 1, 5, 2, 7], dtype=long_t))
 
     # Strided kernel
-    # TODO
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    x = a[1::2]
+    r = m.test_array_cumsum_inplace_strided(x)
+    assert r is None
+    assert_equal(x, xnd([2, 6, 12], dtype=long_t))
+    assert_equal(a, xnd([1, 2, 3, 6, 5, 12, 7], dtype=long_t))
 
 
 def test_array_range_inout():
@@ -74,8 +88,12 @@ def test_array_range_inout():
     with pytest.raises(ValueError, match=r'.* must be C-contiguous .*'):
         r = m.test_array_range_inout(x)
 
-    # Strided kernel
-    # TODO
+    # Strided kernel is not generated for inout arguments, Xnd
+    # kernel is used instead
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    x = a[1::2]
+    with pytest.raises(ValueError, match=r'.* must be C-contiguous .*'):
+        r = m.test_array_cumsum_inout_strided(x)
 
 
 def test_array_range_input_output():
@@ -100,7 +118,12 @@ def test_array_range_input_output():
     assert_equal(a, xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t))
 
     # Strided kernel
-    # TODO
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    x = a[1::2]
+    o = m.test_array_cumsum_input_output_strided(x)
+    assert_equal(o, xnd([2, 6, 12], dtype=long_t))
+    assert_equal(x, xnd([2, 4, 6], dtype=long_t))
+    assert_equal(a, xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t))
 
 
 def test_array_range_inplace_output():
@@ -125,7 +148,12 @@ def test_array_range_inplace_output():
     assert_equal(a, xnd([1, 0, 3, 1, 5, 2, 7], dtype=long_t))
 
     # Strided kernel
-    # TODO
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    x = a[1::2]
+    o = m.test_array_cumsum_inplace_output_strided(x)
+    assert_equal(o, xnd([2, 6, 12], dtype=long_t))
+    assert_equal(x, xnd([2, 6, 12], dtype=long_t))
+    assert_equal(a, xnd([1, 2, 3, 6, 5, 12, 7], dtype=long_t))
 
 
 def test_array_range_inout_output():
@@ -146,8 +174,7 @@ def test_array_range_inout_output():
     with pytest.raises(ValueError, match=r'.* must be C-contiguous .*'):
         o, r = m.test_array_range_inout_output(x)
 
-    # Strided kernel
-    # TODO
+    # Strided kernel is not generated for inout arguments
 
 
 def test_array_range_output():
@@ -162,3 +189,184 @@ def test_array_range_hide():
     r = m.test_array_range_hide(xnd(3, type=long_t))
     assert r.type == xnd(0, type=long_t).type
     # r value is random
+
+
+def test_array_cumsum_incx_input():
+    # contiguous input is passed directly
+    a = xnd([1, 2, 3], dtype=long_t)
+    m.test_array_cumsum_incx_input(a)
+    assert_equal(a, xnd([1, 3, 6], dtype=long_t))
+
+    # sliced input with positive step is passed directly
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    m.test_array_cumsum_incx_input(a[1::2])
+    assert_equal(a, xnd([1, 2, 3, 6, 5, 12, 7], dtype=long_t))
+
+    # sliced input with negative step is copied
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    m.test_array_cumsum_incx_input(a[::-2])
+    assert_equal(a, xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t))
+
+    # Strided kernel
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    m.test_array_cumsum_incx_input_strided(a[1::2])
+    assert_equal(a, xnd([1, 2, 3, 6, 5, 12, 7], dtype=long_t))
+
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    m.test_array_cumsum_incx_input_strided(a[::-2])
+    assert_equal(a, xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t))
+
+
+def test_array_cumsum_incx_input_output():
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    o = m.test_array_cumsum_incx_input_output(a[1::2])
+    assert_equal(o, xnd([2, 6, 12], dtype=long_t))
+    assert_equal(a, xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t))
+
+
+def test_array_cumsum_inplace_parallel():
+    def cumsum(rows):
+        return [[sum(row[:i + 1]) for i in range(len(row))] for row in rows]
+
+    nthreads = m._set_num_threads(4)
+    try:
+        rows = [[i, 1, 2, 3, -i] for i in range(101)]
+        a = xnd(rows, dtype=long_t)
+        m.test_array_cumsum_inplace_parallel(a)
+        assert_equal(a, xnd(cumsum(rows), dtype=long_t))
+
+        # rows are copied to contiguous buffers and back
+        a = xnd(rows, dtype=long_t)
+        m.test_array_cumsum_inplace_parallel(a[::-3, 1:])
+        expected = [row[:] for row in rows]
+        expected[::-3] = [row[:1] + r for row, r in
+                          zip(rows[::-3], cumsum([row[1:] for row in rows[::-3]]))]
+        assert_equal(a, xnd(expected, dtype=long_t))
+
+        a = xnd([rows[:50], rows[50:100]], dtype=long_t)
+        m.test_array_cumsum_inplace_parallel(a)
+        assert_equal(a, xnd([cumsum(rows[:50]), cumsum(rows[50:100])],
+                            dtype=long_t))
+
+        # serial execution gives the same result
+        assert m._set_num_threads(1) == 4
+        a = xnd(rows, dtype=long_t)
+        m.test_array_cumsum_inplace_parallel(a)
+        assert_equal(a, xnd(cumsum(rows), dtype=long_t))
+    finally:
+        m._set_num_threads(nthreads)
+
+
+def test_array_square_fused():
+    rows = [[i, 1, 2, -i] for i in range(10)]
+    squares = [[x * x for x in row] for row in rows]
+    name = 'gmk_test_array_square_fused__DOTS__STAR__symbolic_Xnd_test_array_square'
+
+    m._reset_kernel_stats()
+    a = xnd(rows, dtype=long_t)
+    assert_equal(m.test_array_square_fused(a), xnd(squares, dtype=long_t))
+    assert m._kernel_stats()[name]['calls'] == 1  # one call for all rows
+
+    a = xnd([rows[:5], rows[5:]], dtype=long_t)
+    assert_equal(m.test_array_square_fused(a),
+                 xnd([squares[:5], squares[5:]], dtype=long_t))
+    assert m._kernel_stats()[name]['calls'] == 3
+
+    # non-contiguous input is processed row by row
+    a = xnd(rows, dtype=long_t)
+    assert_equal(m.test_array_square_fused(a[::2, 1:]),
+                 xnd([row[1:] for row in squares[::2]], dtype=long_t))
+    assert m._kernel_stats()[name]['calls'] == 8
+
+    assert_equal(m.test_array_square_fused(xnd([1, -2, 3], dtype=long_t)),
+                 xnd([1, 4, 9], dtype=long_t))
+
+
+def test_array_ranges_lda_inout():
+    # rows are contiguous, lda is the row step of the view
+    a = xnd([[1, 2, 3, 4], [5, 6, 7, 8], [9, 8, 7, 6]], dtype=long_t)
+    m.test_array_ranges_lda_inout(a[::2, 1:3])
+    assert_equal(a, xnd([[1, 0, 1, 4], [5, 6, 7, 8], [9, 10, 11, 6]],
+                        dtype=long_t))
+
+    a = xnd([[1, 2, 3, 4], [5, 6, 7, 8], [9, 10, 11, 12]], dtype=long_t)
+    with pytest.raises(ValueError, match=r'.* must be C-contiguous .*'):
+        m.test_array_ranges_lda_inout(a[:, ::2])
+
+
+def test_scratch_pool():
+    # Xnd kernel copies the sliced input to a scratch buffer
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    m._release_scratch()
+    assert_equal(m.test_array_range_input(a[1::2]), xnd(12, type=long_t))
+    assert m._release_scratch() > 0  # input copy buffer is cached
+    assert m._release_scratch() == 0
+
+    limit = m._set_scratch_limit(0)
+    assert limit > 0
+    try:
+        m.test_array_range_input(a[1::2])
+        assert m._release_scratch() == 0
+    finally:
+        m._set_scratch_limit(limit)
+
+
+def test_scratch_pool_parallel():
+    # worker threads of parallel kernels cache their row copy buffers
+    rows = [[i, 1, 2, 3, -i] for i in range(101)]
+    nthreads = m._set_num_threads(4)
+    try:
+        m._release_scratch()
+        for i in range(10):
+            a = xnd(rows, dtype=long_t)
+            m.test_array_cumsum_inplace_parallel(a[:, ::2])
+        assert m._scratch_cached() > 0
+        assert m._release_scratch() > 0
+        assert m._scratch_cached() == 0  # including worker threads
+
+        m.test_array_cumsum_inplace_parallel(xnd(rows, dtype=long_t)[:, ::2])
+        limit = m._set_scratch_limit(0)
+        try:
+            assert m._scratch_cached() == 0
+        finally:
+            m._set_scratch_limit(limit)
+    finally:
+        m._set_num_threads(nthreads)
+
+
+def test_array_range_output_no_temporary():
+    m._release_scratch()
+    o, r = m.test_array_range_output(xnd(3, type=long_t))
+    assert_equal(o, xnd([0, 1, 2], dtype=long_t))
+    assert m._release_scratch() == 0  # written directly to output
+
+    a = xnd([1, 2, 3], dtype=long_t)
+    o, r = m.test_array_range_input_output(a)
+    assert_equal(o, xnd([0, 1, 2], dtype=long_t))
+    assert_equal(a, xnd([1, 2, 3], dtype=long_t))
+    assert m._release_scratch() == 0
+
+
+def test_kernel_stats():
+    m._reset_kernel_stats()
+    stats = m._kernel_stats()
+    name = 'gmk_test_array_range_input__symbolic_Xnd_test_array_range'
+    assert stats[name] == dict(calls=0, time=0.0, copied_in=0, copied_out=0)
+
+    a = xnd([1, 2, 3, 4, 5, 6, 7], dtype=long_t)
+    m.test_array_range_input(a[1::2])
+    m.test_array_range_input(a[1::2])
+    s = m._kernel_stats()[name]
+    assert s['calls'] == 2
+    assert s['time'] > 0
+    assert s['copied_in'] == 2 * 3 * a.type.hidden_dtype.datasize
+    assert s['copied_out'] == 0
+
+    name = 'gmk_test_array_range_inplace__symbolic_Xnd_test_array_range'
+    m.test_array_range_inplace(a[1::2])
+    s = m._kernel_stats()[name]
+    assert s['calls'] == 1
+    assert s['copied_in'] == s['copied_out'] == 3 * a.type.hidden_dtype.datasize
+
+    m._reset_kernel_stats()
+    assert m._kernel_stats()[name]['calls'] == 0
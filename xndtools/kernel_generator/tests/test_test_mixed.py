@@ -74,3 +74,37 @@ def test_mixed_matrices_FF_inout():
 
     with pytest.raises(ValueError, match=r'.* must be F-contiguous .*'):
         r = m.test_mixed_matrices_inout_FF(a, b)
+
+
+def test_mixed_matrices_CF_input():
+    a = xnd([[10, 20],
+             [30, 40]], type=f'2 * 2 * {long_t}')
+    b = xnd([[5, 6],
+             [7, 8]], type=f'2 * 2 * {long_t}')
+    r = m.test_mixed_matrices_input_CF(a, b)
+    assert_equal(r, xnd(26, type=long_t))
+
+    a = xnd([[10, 0, 20],
+             [0, 0, 0],
+             [30, 0, 40]], type=f'3 * 3 * {long_t}')
+    b = xnd([[5, 0, 6],
+             [0, 0, 0],
+             [7, 0, 8]], type=f'3 * 3 * {long_t}')
+    r = m.test_mixed_matrices_input_CF(a[::2, ::2], b[::2, ::2])
+    assert_equal(r, xnd(26, type=long_t))
+
+    r = m.test_mixed_matrices_input_CF(a[::-2, ::-2], b[::-2, ::-2])
+    assert_equal(r, xnd(37, type=long_t))
+
+
+def test_instrumented_build():
+    m._reset_kernel_stats()
+    a = xnd([[10, 20],
+             [30, 40]], type=f'2 * 2 * {long_t}')
+    b = xnd([[5, 6],
+             [7, 8]], type=f'2 * 2 * {long_t}')
+    m.test_mixed_matrices_input_CF(a, b)
+    s = m._kernel_stats()['gmk_test_mixed_matrices_input_CF__symbolic_Xnd_test_mixed_matrices']
+    assert s['calls'] == 1
+    assert s['copied_in'] == 4 * b.type.hidden_dtype.datasize
+    assert s['copied_out'] == 0
@@ -848,3 +848,80 @@ def test_scalar_ptr_value_return_inout_output():
     assert_equal(m.test_scalar_ptr_value_return_inout_output(a),
                  (xnd([20, 15], dtype=long_t), xnd([40, 35], dtype=long_t)))
     assert_equal(a, xnd([20, 15], type=dt))
+
+
+# STRIDED KERNELS
+
+
+def test_scalar_ptr_return_input_strided():
+    a = xnd(10, type=long_t)
+    assert_equal(m.test_scalar_ptr_return_input_strided(a),
+                 xnd(40, type=long_t))
+    assert_equal(a, xnd(10, type=long_t))
+
+    a = xnd([10, 11], dtype=long_t)
+    assert_equal(m.test_scalar_ptr_return_input_strided(a),
+                 xnd([40, 41], dtype=long_t))
+    assert_equal(a, xnd([10, 11], dtype=long_t))
+
+    a = xnd([[10, 11], [12, 13]], dtype=long_t)
+    assert_equal(m.test_scalar_ptr_return_input_strided(a),
+                 xnd([[40, 41], [42, 43]], dtype=long_t))
+
+    a = xnd([10, 11, 12, 13, 14], dtype=long_t)
+    assert_equal(m.test_scalar_ptr_return_input_strided(a[::2]),
+                 xnd([40, 42, 44], dtype=long_t))
+    assert_equal(a, xnd([10, 11, 12, 13, 14], dtype=long_t))
+
+
+def test_scalar_ptr_return_inplace_strided():
+    a = xnd(10, type=long_t)
+    assert_equal(m.test_scalar_ptr_return_inplace_strided(a),
+                 xnd(40, type=long_t))
+    assert_equal(a, xnd(20, type=long_t))
+
+    a = xnd([10, 11, 12, 13, 14], dtype=long_t)
+    assert_equal(m.test_scalar_ptr_return_inplace_strided(a[::2]),
+                 xnd([40, 42, 44], dtype=long_t))
+    assert_equal(a, xnd([20, 11, 22, 13, 24], dtype=long_t))
+
+
+def test_scalar_ptr_return_input_output_strided():
+    a = xnd([10, 11, 12, 13, 14], dtype=long_t)
+    assert_equal(m.test_scalar_ptr_return_input_output_strided(a[1::2]),
+                 (xnd([21, 23], dtype=long_t), xnd([41, 43], dtype=long_t)))
+    assert_equal(a, xnd([10, 11, 12, 13, 14], dtype=long_t))
+
+
+def test_lean_build():
+    import os
+    from xndtools.kernel_generator.generate_kernel import get_module_data
+    from xndtools.kernel_generator.kernel_source_template import source_template
+    config_file = os.path.join(os.path.dirname(__file__), 'test_scalar-kernels.cfg')
+    source = source_template(get_module_data(config_file))['c_source']
+    for word in ['_counter', 'atexit', 'DEBUGMSG', 'xndtools_kernel_stats_enter']:
+        assert word not in source
+    source = source_template(get_module_data(config_file, build='default'))['c_source']
+    for word in ['_counter', 'atexit', 'DEBUGMSG']:
+        assert word in source
+
+    assert m._kernel_stats() == {}
+
+
+def test_lazy_kernels():
+    # test_scalar is built with `lazy: true`
+    assert 'test_scalar_input' in dir(m)
+    assert '_kernel_stats' in dir(m)
+    f = m.test_scalar_input
+    assert 'test_scalar_input' in vars(m)
+    del m.test_scalar_input
+    assert 'test_scalar_input' not in vars(m)
+    assert 'test_scalar_input' in dir(m)
+    g = m.test_scalar_input
+    assert g is not f
+    assert 'test_scalar_input' in vars(m)
+    a = xnd(10, type=long_t)
+    assert_equal(g(a), None)
+
+    assert not hasattr(m, 'test_scalar_no_such_kernel')
+    assert 'test_scalar_no_such_kernel' not in dir(m)
@@ -41,3 +41,19 @@ def test_resolve_path():
             == os.path.join(sys.prefix, 'a'))
     assert (resolve_path('p/${TEST_RESOLVE_PATH_NOT_EXISTING|}/a')
             == os.path.join('p', 'a'))
+
+
+def test_prototype_variant():
+    from xndtools.kernel_generator.readers import PrototypeReader
+    prototype = PrototypeReader()('void foo(long n, double* a);')[0]
+    prototype.set_argument_shape('a', ['n'])
+    kernel = prototype.variant(kind='C')
+    assert kernel['kind'] == 'C' and 'kind' not in prototype
+    assert repr(kernel) == repr(prototype.variant(kind='C'))
+
+    a = kernel.get_argument('a')
+    assert a == prototype.get_argument('a')
+    a['input_index'] = 0
+    a['shape'][0]['dimension'] = 'N'
+    assert 'input_index' not in prototype.get_argument('a')
+    assert prototype.get_argument('a')['shape'] == [dict(value='n')]
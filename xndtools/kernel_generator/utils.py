@@ -291,6 +291,18 @@ class Prototype(dict):
             _conventions=(self.get('conventions') or ''),
             **self)
 
+    def variant(self, **items):
+        """ Return a copy of prototype with updated items.
+
+        The copy shares argument data with the prototype except the
+        argument declarations and shapes that are modified per
+        kernel variant.
+        """
+        kernel = type(self)(self)
+        kernel['arguments'] = [a.variant() for a in self['arguments']]
+        kernel.update(items)
+        return kernel
+
     def update_typemap(self, typemap):
         for a in self['arguments']:
             a.update_typemap(typemap)
@@ -318,7 +330,7 @@ class Prototype(dict):
         a = self.get_argument(name)
         a['fortran'] = False
 
-    def set_argument_value(self, name, value):
+    def set_argument_value(self, name, value, kind='Xnd'):
         # print('{}.set_argument_value({!r}, {!r})'
         #       .format(type(self).__name__, name, value))
         a = self.get_argument(name)
@@ -327,7 +339,39 @@ class Prototype(dict):
             assert i != -1, repr(value)
             f = value[:i].strip().lower()
             args = value[i+1:-1].strip()
-            if f == 'shape':
+            if f in ['stride', 'step']:
+                # leading stride (incx, lda) of an input array that
+                # allows passing the array data without copying
+                b = self.get_argument(args)
+                if not b.is_intent_inany:
+                    print('{}.set_argument_value:NOT IMPL:{!r} (`{}` must be input argument)'
+                          .format(type(self).__name__, value, args))
+                else:
+                    b['stride'] = name
+                    fortran = 'true' if b.is_fortran else 'false'
+                    # C and Fortran kernels receive contiguous arrays,
+                    # input-output arrays are passed via contiguous buffers
+                    contiguous = 'true'
+                    if kind in ['Xnd', 'Strided'] and not b.is_intent_outany:
+                        contiguous = 'gmk_{}_new'.format(args)
+                    if kind == 'Strided':
+                        value = ('xndtools_strided_stride({}, gmk_input_{}_dims, gmk_input_{}_steps, sizeof({}), {}, {})'
+                                 .format(len(b.get('shape') or ()), args, args, b['ctype'], fortran, contiguous))
+                    else:
+                        value = 'xndtools_fixed_stride(&gmk_input_{}, {}, {})'.format(args, fortran, contiguous)
+            elif kind == 'Strided':
+                # Strided kernels receive array dimensions via
+                # gmk_input_<name>_dims, see kernel_source_template.py
+                args, index = (args.split(',', 1) + ['0'])[:2]
+                args, index = args.strip(), index.strip()
+                if f in ['shape', 'len']:
+                    value = 'gmk_input_{}_dims[{}]'.format(args, index)
+                elif f == 'ndim':
+                    value = str(len(self.get_argument(args).get('shape') or ()))
+                else:
+                    print('{}.set_argument_value:NOT IMPL:{!r}'
+                          .format(type(self).__name__, value))
+            elif f == 'shape':
                 value = 'xnd_fixed_shape_at(&gmk_input_{})'.format(args)
             elif f == 'len':
                 value = 'xnd_fixed_shape_at(&gmk_input_{}, 0)'.format(args)
@@ -427,6 +471,14 @@ class ArgumentDeclaration(dict):
                 _name=(self.get('name') or ''),
                 **self))
 
+    def variant(self):
+        """ Return a copy of argument declaration with a copy of shape.
+        """
+        a = type(self)(self)
+        if a.get('shape'):
+            a['shape'] = [dict(dim) for dim in a['shape']]
+        return a
+
     @property
     def is_scalar(self):
         return not (self.get('left_modifier') or self.get('right_modifier'))
@@ -537,44 +589,77 @@ def prettify(source, target='c', skip_emptylines=True):
     """ Simple prettier of source code.
     """
     if target == 'c':
-        intent_str = '    '
-        intent_count = 0
-        next_count = 0
-        lines = []
-        stmt_match = re.compile(r'\A(if|while|else)\b[^;]*\Z').match
-        comment_start_match = re.compile(r'\A\s*/[*]').match
-        comment_end_match = re.compile(r'.*?[*]/\s*\Z').match
-        comment = False
-        for orig_line in source.splitlines():
-            cstart = comment_start_match(orig_line)
-            cend = comment_end_match(orig_line)
-            if comment or cstart:
-                comment = not cend
-                lines.append(orig_line)
-                continue
-
-            line = orig_line.strip() if intent_count else orig_line
-            if skip_emptylines and (not line and intent_count):
-                continue
-            start = line.count('{')
-            stop = line.count('}')
-            diff = start - stop
-            if next_count and diff:
-                next_count = 0
-            if diff >= 0:
-                lines.append(intent_str * (intent_count+next_count) + line)
-                intent_count += diff
-            else:
-                intent_count += diff
-                lines.append(intent_str * (intent_count+next_count) + line)
-            next_count = 0
-            if stmt_match(line) and not diff:
-                next_count = 1
-        assert intent_count == 0
-        return '\n'.join(lines)
+        return '\n'.join(prettify_lines(source.splitlines(),
+                                        skip_emptylines=skip_emptylines))
     return source
 
 
+def prettify_lines(lines, skip_emptylines=True):
+    """ Generator of prettified lines of C source code. The lines are
+    processed one at a time, see prettify.
+    """
+    intent_str = '    '
+    intent_count = 0
+    next_count = 0
+    stmt_match = re.compile(r'\A(if|while|else)\b[^;]*\Z').match
+    comment_start_match = re.compile(r'\A\s*/[*]').match
+    comment_end_match = re.compile(r'.*?[*]/\s*\Z').match
+    comment = False
+    for orig_line in lines:
+        cstart = comment_start_match(orig_line)
+        cend = comment_end_match(orig_line)
+        if comment or cstart:
+            comment = not cend
+            yield orig_line
+            continue
+
+        line = orig_line.strip() if intent_count else orig_line
+        if skip_emptylines and (not line and intent_count):
+            continue
+        start = line.count('{')
+        stop = line.count('}')
+        diff = start - stop
+        if next_count and diff:
+            next_count = 0
+        if diff >= 0:
+            yield intent_str * (intent_count+next_count) + line
+            intent_count += diff
+        else:
+            intent_count += diff
+            yield intent_str * (intent_count+next_count) + line
+        next_count = 0
+        if stmt_match(line) and not diff:
+            next_count = 1
+    assert intent_count == 0
+
+
+def iter_lines(chunks):
+    """ Generator of the lines of ''.join(chunks), split as in
+    str.splitlines, without joining the chunks.
+    """
+    rest = ''
+    for chunk in chunks:
+        lines = (rest + chunk).splitlines(True)
+        rest = ''
+        if lines and (lines[-1].splitlines()[0] == lines[-1]
+                      or lines[-1].endswith('\r')):
+            # incomplete line, or \r that may be followed by \n
+            rest = lines.pop()
+        for line in lines:
+            yield line.splitlines()[0]
+    if rest:
+        yield from rest.splitlines()
+
+
+def write_lines(f, lines):
+    """ Write lines to file object f as '\\n'.join(lines).
+    """
+    for i, line in enumerate(lines):
+        if i:
+            f.write('\n')
+        f.write(line)
+
+
 def resolve_path(path, prefix=None, normpath=True):
     """Apply environment variables to path and resolve <...>
     substitutions, return normalized path.
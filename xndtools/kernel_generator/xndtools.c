@@ -6,6 +6,14 @@
 #include <stdio.h>
 #include <string.h>
 #include <stdlib.h>
+#include <time.h>
+#ifdef _WIN32
+#define WIN32_LEAN_AND_MEAN
+#include <windows.h>
+#else
+#include <pthread.h>
+#include <unistd.h>
+#endif
 
 #include "xndtools.h"
 
@@ -24,86 +32,192 @@ int64_t xndtools_fixed_nbytes(const xnd_t* stack_ptr) {
  }
 
 /*
-  Copy fixed dims stack (possibly sliced) to a C or Fortran contiguous destination.
-  Return number of bytes copied.
+  Strided copy engine.
+
+  Copies items between two strided views of the same shape. Length-1
+  dimensions are dropped and adjacent dimensions that are contiguous
+  in both views are collapsed so that contiguous runs are copied with
+  a single memcpy. When the source and destination are unit-strided
+  along different dimensions (e.g. C <-> Fortran transposition), the
+  two dimensions are copied in tiles to keep both sides cache
+  resident. The remaining dimensions are iterated without
+  recursion. Negative steps are supported.
  */
-int xndtools_cpy(char* dest, const xnd_t* stack_ptr, bool fortran) {
-  int ndim = xnd_ndim(stack_ptr);
-  int64_t itemsize = stack_ptr->type->Concrete.FixedDim.itemsize;
-  char* ptr0 = stack_ptr->ptr + stack_ptr->index * itemsize;
-  //printf("xndtools_cpy: ndim=%d, c_contiguous=%d\n", ndim, ndt_is_c_contiguous(stack_ptr->type));
-  if (ndim==0) {
-    memcpy(dest, ptr0, itemsize); // avoid broadcasting scalar to 1d array   
-    return itemsize;
-  } else if (!fortran && ndt_is_c_contiguous(stack_ptr->type)) {
-    int64_t nbytes = xndtools_fixed_nbytes(stack_ptr);
-    memcpy(dest, ptr0, nbytes);
-    return nbytes;
-  } else if (fortran && ndt_is_f_contiguous(stack_ptr->type)) {
-    int64_t nbytes = xndtools_fixed_nbytes(stack_ptr);
-    memcpy(dest, ptr0, nbytes);
-    return nbytes;
-  } else if (ndim>1) {
-    int64_t N = xnd_fixed_shape_at(stack_ptr, 0);
-    int64_t N1 = 1;
-    for (int64_t i=0; i<N; i++) {
-      xnd_t row = xnd_fixed_dim_next(stack_ptr, i);
-      N1 = xndtools_cpy(dest + N1*i, &row, fortran);
-      assert(N1>=1);
-    }
-    return N * N1;
-  } else if (ndim==1) {
-    int64_t N = xnd_fixed_shape_at(stack_ptr, 0);
-    int64_t step = stack_ptr->type->Concrete.FixedDim.step * itemsize;
-    switch (itemsize) { // todo: check if assignment is faster than memcpy or not
-    case 1:
-      {
-	int8_t* out = (int8_t*)dest;
-	for (int64_t i=0; i< N; i++)
-	  out[i] = *(const int8_t*)(ptr0+i*step);
-	break;
-      }
-    case 2:
-      {
-	int16_t* out = (int16_t*)dest;
-	for (int64_t i=0; i< N; i++)
-	  out[i] = *(const int16_t*)(ptr0+i*step);
-	break;
+
+#define XNDTOOLS_COPY_TILE 32
+
+#define XNDTOOLS_COPY_ITEMS(SIZE)					\
+  for (intptr_t i=0; i<n; i++)						\
+    memcpy(dest + i * dest_step, src + i * src_step, SIZE)
+
+static void xndtools_copy_items(char* dest, intptr_t dest_step, const char* src, intptr_t src_step, intptr_t n, int64_t itemsize) {
+  if (dest_step == itemsize && src_step == itemsize) {
+    memcpy(dest, src, n * itemsize);
+    return;
+  }
+  switch (itemsize) { // constant sizes let the compiler emit plain loads and stores
+  case 1: XNDTOOLS_COPY_ITEMS(1); break;
+  case 2: XNDTOOLS_COPY_ITEMS(2); break;
+  case 4: XNDTOOLS_COPY_ITEMS(4); break;
+  case 8: XNDTOOLS_COPY_ITEMS(8); break;
+  case 16: XNDTOOLS_COPY_ITEMS(16); break;
+  default: XNDTOOLS_COPY_ITEMS(itemsize);
+  }
+}
+
+#define XNDTOOLS_COPY_TILE_ITEMS(SIZE)					\
+  for (intptr_t a=a0; a<a1; a++)					\
+    for (intptr_t b=b0; b<b1; b++)					\
+      memcpy(dest + a * dest_a + b * dest_b, src + a * src_a + b * src_b, SIZE)
+
+static void xndtools_copy_tiled(char* dest, const char* src, intptr_t na, intptr_t dest_a, intptr_t src_a, intptr_t nb, intptr_t dest_b, intptr_t src_b, int64_t itemsize) {
+  for (intptr_t a0=0; a0<na; a0+=XNDTOOLS_COPY_TILE) {
+    intptr_t a1 = (a0 + XNDTOOLS_COPY_TILE < na ? a0 + XNDTOOLS_COPY_TILE : na);
+    for (intptr_t b0=0; b0<nb; b0+=XNDTOOLS_COPY_TILE) {
+      intptr_t b1 = (b0 + XNDTOOLS_COPY_TILE < nb ? b0 + XNDTOOLS_COPY_TILE : nb);
+      switch (itemsize) {
+      case 1: XNDTOOLS_COPY_TILE_ITEMS(1); break;
+      case 2: XNDTOOLS_COPY_TILE_ITEMS(2); break;
+      case 4: XNDTOOLS_COPY_TILE_ITEMS(4); break;
+      case 8: XNDTOOLS_COPY_TILE_ITEMS(8); break;
+      case 16: XNDTOOLS_COPY_TILE_ITEMS(16); break;
+      default: XNDTOOLS_COPY_TILE_ITEMS(itemsize);
       }
-    case 4:
-      {
-	int32_t* out = (int32_t*)dest;
-	for (int64_t i=0; i< N; i++)
-	  out[i] = *(const int32_t*)(ptr0+i*step);
+    }
+  }
+}
+
+static void xndtools_transfer(char* dest, const char* src, int ndim, const intptr_t* dimensions, const intptr_t* dest_steps, const intptr_t* src_steps, int64_t itemsize) {
+  intptr_t dims[NDT_MAX_DIM];
+  intptr_t dsteps[NDT_MAX_DIM];
+  intptr_t ssteps[NDT_MAX_DIM];
+  intptr_t index[NDT_MAX_DIM];
+  int n = 0;
+  for (int i=0; i<ndim; i++) {
+    if (dimensions[i] == 0)
+      return;
+    if (dimensions[i] == 1)
+      continue;
+    if (n > 0 && dsteps[n-1] == dest_steps[i] * dimensions[i] && ssteps[n-1] == src_steps[i] * dimensions[i]) {
+      dims[n-1] *= dimensions[i];
+      dsteps[n-1] = dest_steps[i];
+      ssteps[n-1] = src_steps[i];
+      continue;
+    }
+    dims[n] = dimensions[i];
+    dsteps[n] = dest_steps[i];
+    ssteps[n] = src_steps[i];
+    n++;
+  }
+  if (n == 0) {
+    memcpy(dest, src, itemsize);
+    return;
+  }
+  int inner = n - 1;
+  int tile = -1;
+  if (dsteps[inner] != itemsize || ssteps[inner] != itemsize)
+    for (int i=0; i<inner; i++)
+      if ((dsteps[i] == itemsize && dsteps[inner] != itemsize) || (ssteps[i] == itemsize && ssteps[inner] != itemsize)) {
+	tile = i;
 	break;
       }
-    case 8:
-      {
-	int64_t* out = (int64_t*)dest;
-	for (int64_t i=0; i< N; i++)
-	  out[i] = *(const int64_t*)(ptr0+i*step);
+  int64_t nouter = 1;
+  for (int i=0; i<inner; i++) {
+    index[i] = 0;
+    if (i != tile)
+      nouter *= dims[i];
+  }
+  for (int64_t k=0; k<nouter; k++) {
+    if (tile < 0)
+      xndtools_copy_items(dest, dsteps[inner], src, ssteps[inner], dims[inner], itemsize);
+    else
+      xndtools_copy_tiled(dest, src, dims[tile], dsteps[tile], ssteps[tile], dims[inner], dsteps[inner], ssteps[inner], itemsize);
+    // advance to the next outer index, the last dimension is the fastest one
+    for (int i=inner-1; i>=0; i--) {
+      if (i == tile)
+	continue;
+      dest += dsteps[i];
+      src += ssteps[i];
+      if (++index[i] < dims[i])
 	break;
-      }
-    default:
-      {
-	for (int64_t i=0; i< N; i++)
-	  memcpy(dest+i*itemsize, ptr0+i*step, itemsize);
-      }
+      dest -= dsteps[i] * dims[i];
+      src -= ssteps[i] * dims[i];
+      index[i] = 0;
     }
-    return N*itemsize;
   }
-  return -1;
+}
+
+/*
+  Number of bytes copied to (index 0) and from (index 1) contiguous
+  buffers by the calling thread, see xndtools_kernel_stats_leave.
+ */
+static XNDTOOLS_THREAD_LOCAL int64_t xndtools_copied_nbytes[2];
+
+/*
+  Copy items between strided data and a C or Fortran contiguous
+  buffer. When inverse is true, copy from buffer to strided data.
+  Return number of bytes copied.
+ */
+static int64_t xndtools_strided_transfer(char* buf, char* ptr, int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran, bool inverse) {
+  intptr_t dims[NDT_MAX_DIM];
+  intptr_t psteps[NDT_MAX_DIM];
+  intptr_t bsteps[NDT_MAX_DIM];
+  int64_t nbytes = itemsize;
+  // order dimensions such that the last one is the fastest in the buffer
+  for (int k=ndim-1; k>=0; k--) {
+    int i = (fortran ? ndim - 1 - k : k);
+    dims[k] = dimensions[i];
+    psteps[k] = steps[i];
+    bsteps[k] = nbytes;
+    nbytes *= dimensions[i];
+  }
+  if (inverse)
+    xndtools_transfer(ptr, buf, ndim, dims, psteps, bsteps, itemsize);
+  else
+    xndtools_transfer(buf, ptr, ndim, dims, bsteps, psteps, itemsize);
+  xndtools_copied_nbytes[inverse] += nbytes;
+  return nbytes;
+}
+
+/*
+  Get the pointer to the first item, dimensions and steps (in bytes)
+  of fixed dims stack. Return the number of dimensions.
+ */
+static int xndtools_fixed_strides(const xnd_t* stack_ptr, char** ptr, intptr_t* dimensions, intptr_t* steps) {
+  const ndt_t* t = stack_ptr->type;
+  int64_t itemsize = t->Concrete.FixedDim.itemsize;
+  int ndim = t->ndim;
+  *ptr = stack_ptr->ptr + stack_ptr->index * itemsize;
+  for (int i=0; i<ndim; i++, t=t->FixedDim.type) {
+    dimensions[i] = t->FixedDim.shape;
+    steps[i] = t->Concrete.FixedDim.step * itemsize;
+  }
+  return ndim;
+}
+
+/*
+  Copy fixed dims stack (possibly sliced) to a C or Fortran contiguous destination.
+  Return number of bytes copied.
+ */
+int xndtools_cpy(char* dest, const xnd_t* stack_ptr, bool fortran) {
+  intptr_t dimensions[NDT_MAX_DIM];
+  intptr_t steps[NDT_MAX_DIM];
+  char* ptr0 = NULL;
+  int64_t itemsize = stack_ptr->type->Concrete.FixedDim.itemsize;
+  int ndim = xndtools_fixed_strides(stack_ptr, &ptr0, dimensions, steps);
+  return xndtools_strided_transfer(dest, ptr0, ndim, dimensions, steps, itemsize, fortran, false);
 }
 
 /*
   Return a C contiguous copy of fixed dims stack. Caller is
-  responsible for deallocating the returned array.
+  responsible for deallocating the returned array using
+  xndtools_scratch_free.
  */
 
 char* xndtools_copy(const xnd_t* stack_ptr, ndt_context_t *ctx) {
   char* target = NULL;
   int64_t nbytes = xndtools_fixed_nbytes(stack_ptr);
-  target = (char*)malloc(nbytes);
+  target = (char*)xndtools_scratch_alloc(nbytes);
   if (target==NULL) {
     ndt_err_format(ctx, NDT_MemoryError,
 		   "xndtools_copy: failed to allocate memory");
@@ -113,7 +227,7 @@ char* xndtools_copy(const xnd_t* stack_ptr, ndt_context_t *ctx) {
   if (tbytes!=nbytes) {
     ndt_err_format(ctx, NDT_RuntimeError,
 		   "xndtools_copy: mismatch of allocated and copied memory");
-    free(target);
+    xndtools_scratch_free(target);
     target = NULL;
   }
   return target;
@@ -121,13 +235,14 @@ char* xndtools_copy(const xnd_t* stack_ptr, ndt_context_t *ctx) {
 
 /*
   Return a Fortran contiguous copy of fixed dims stack. Caller is
-  responsible for deallocating the returned array.
+  responsible for deallocating the returned array using
+  xndtools_scratch_free.
  */
 
 char* xndtools_fcopy(const xnd_t* stack_ptr, ndt_context_t *ctx) {
   char* target = NULL;
   int64_t nbytes = xndtools_fixed_nbytes(stack_ptr);
-  target = (char*)malloc(nbytes);
+  target = (char*)xndtools_scratch_alloc(nbytes);
   if (target==NULL) {
     ndt_err_format(ctx, NDT_MemoryError,
 		   "xndtools_fcopy: failed to allocate memory");
@@ -137,7 +252,7 @@ char* xndtools_fcopy(const xnd_t* stack_ptr, ndt_context_t *ctx) {
   if (tbytes!=nbytes) {
     ndt_err_format(ctx, NDT_RuntimeError,
 		   "xndtools_fcopy: mismatch of allocated and copied memory");
-    free(target);
+    xndtools_scratch_free(target);
     target = NULL;
   }
   return target;
@@ -148,70 +263,673 @@ char* xndtools_fcopy(const xnd_t* stack_ptr, ndt_context_t *ctx) {
   Return number of bytes copied.
  */
 int xndtools_invcpy(const char* src, const xnd_t* stack_ptr, bool fortran) {
-  int ndim = xnd_ndim(stack_ptr);
+  intptr_t dimensions[NDT_MAX_DIM];
+  intptr_t steps[NDT_MAX_DIM];
+  char* ptr0 = NULL;
+  int64_t itemsize = stack_ptr->type->Concrete.FixedDim.itemsize;
+  int ndim = xndtools_fixed_strides(stack_ptr, &ptr0, dimensions, steps);
+  return xndtools_strided_transfer((char*)src, ptr0, ndim, dimensions, steps, itemsize, fortran, true);
+}
+
+/*
+  Strided kernel support. The data of a strided argument is described
+  by a pointer to its first item, dimensions and steps (in bytes) as
+  used in gumath strided kernels.
+ */
+
+/*
+  Return number of bytes in strided data.
+ */
+int64_t xndtools_strided_nbytes(int ndim, const intptr_t* dimensions, int64_t itemsize) {
+  int64_t items = 1;
+  for (int i=0; i<ndim; i++)
+    items *= dimensions[i];
+  return items * itemsize;
+}
+
+/*
+  Check if strided data is C or Fortran contiguous.
+ */
+bool xndtools_strided_is_contiguous(int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran) {
+  int64_t expected = itemsize;
+  for (int k=0; k<ndim; k++) {
+    int i = (fortran ? k : ndim - 1 - k);
+    if (dimensions[i] > 1 && steps[i] != expected)
+      return false;
+    expected *= dimensions[i];
+  }
+  return true;
+}
+
+/*
+  Copy strided data (possibly non-contiguous) to a C or Fortran contiguous destination.
+  Return number of bytes copied.
+ */
+int64_t xndtools_strided_cpy(char* dest, const char* src, int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran) {
+  return xndtools_strided_transfer(dest, (char*)src, ndim, dimensions, steps, itemsize, fortran, false);
+}
+
+/*
+  Copy C or Fortran contiguous data to strided destination (possibly non-contiguous).
+  Return number of bytes copied.
+ */
+int64_t xndtools_strided_invcpy(const char* src, char* dest, int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran) {
+  return xndtools_strided_transfer((char*)src, dest, ndim, dimensions, steps, itemsize, fortran, true);
+}
+
+/*
+  Return a C or Fortran contiguous copy of strided data. Caller is
+  responsible for deallocating the returned array using
+  xndtools_scratch_free. Return NULL when memory allocation fails.
+ */
+char* xndtools_strided_copy(const char* src, int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran) {
+  int64_t nbytes = xndtools_strided_nbytes(ndim, dimensions, itemsize);
+  char* target = (char*)xndtools_scratch_alloc(nbytes);
+  if (target!=NULL)
+    xndtools_strided_cpy(target, src, ndim, dimensions, steps, itemsize, fortran);
+  return target;
+}
+
+/*
+  Return the leading stride (in items) of strided data that allows
+  passing the data to BLAS-like functions without copying, that is,
+  incx of 1-D arrays or lda of 2-D arrays. When contiguous is true,
+  return the leading stride of a C or Fortran contiguous copy of the
+  data. Return 0 when the data must be copied. Arrays with rank
+  larger than 2 are supported only when contiguous, the returned
+  stride is 1.
+ */
+int64_t xndtools_strided_stride(int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran, bool contiguous) {
+  if (ndim == 0)
+    return 1;
+  if (ndim == 1) {
+    if (contiguous || dimensions[0] <= 1)
+      return 1;
+    if (steps[0] > 0 && steps[0] % itemsize == 0)
+      return steps[0] / itemsize;
+    return 0;
+  }
+  if (ndim == 2) {
+    int inner = (fortran ? 0 : 1);
+    int outer = (fortran ? 1 : 0);
+    int64_t lda = (dimensions[inner] > 1 ? dimensions[inner] : 1);
+    if (contiguous)
+      return lda;
+    if (dimensions[inner] > 1 && steps[inner] != itemsize)
+      return 0;
+    if (dimensions[outer] <= 1)
+      return lda;
+    if (steps[outer] <= 0 || steps[outer] % itemsize != 0 || steps[outer] / itemsize < lda)
+      return 0;
+    return steps[outer] / itemsize;
+  }
+  if (contiguous || xndtools_strided_is_contiguous(ndim, dimensions, steps, itemsize, fortran))
+    return 1;
+  return 0;
+}
+
+/*
+  Return the leading stride (in items) of fixed dims stack, see
+  xndtools_strided_stride.
+ */
+int64_t xndtools_fixed_stride(const xnd_t* stack_ptr, bool fortran, bool contiguous) {
+  intptr_t dimensions[NDT_MAX_DIM];
+  intptr_t steps[NDT_MAX_DIM];
+  char* ptr0 = NULL;
   int64_t itemsize = stack_ptr->type->Concrete.FixedDim.itemsize;
-  char* ptr0 = stack_ptr->ptr + stack_ptr->index * itemsize;
-  if (ndim==0) {
-    memcpy(ptr0, src, itemsize); // avoid broadcasting scalar to 1d array   
-    return itemsize;
-  } else if (!fortran && ndt_is_c_contiguous(stack_ptr->type)) {
-    int64_t nbytes = xndtools_fixed_nbytes(stack_ptr);
-    memcpy(ptr0, src, nbytes);
-    return nbytes;
-  } else if (fortran && ndt_is_f_contiguous(stack_ptr->type)) {
-    int64_t nbytes = xndtools_fixed_nbytes(stack_ptr);
-    memcpy(ptr0, src, nbytes);
-    return nbytes;
-  } else if (ndim>1) {
-    int64_t N = xnd_fixed_shape_at(stack_ptr, 0);
-    int64_t N1 = 1;
-    for (int64_t i=0; i<N; i++) {
-      xnd_t row = xnd_fixed_dim_next(stack_ptr, i);
-      N1 = xndtools_invcpy(src + N1*i, &row, fortran);
-      assert(N1>=1);
+  int ndim = xndtools_fixed_strides(stack_ptr, &ptr0, dimensions, steps);
+  return xndtools_strided_stride(ndim, dimensions, steps, itemsize, fortran, contiguous);
+}
+
+/*
+  Scratch buffer pool.
+
+  Temporary arrays of generated kernels are allocated from a
+  per-thread pool of size-bucketed buffers (bucket sizes are powers
+  of two). Freed buffers are cached for reuse until the total size of
+  cached buffers in a thread reaches the high-water mark (see
+  xndtools_scratch_set_limit). Buffers larger than the largest bucket
+  are allocated and freed directly. The pool of a thread is allocated
+  when the thread caches its first buffer and it is deallocated,
+  together with its cached buffers, when the thread exits. The worker
+  threads of parallel kernels never exit, their cached buffers are
+  released on request of xndtools_scratch_release and
+  xndtools_scratch_set_limit.
+ */
+
+#define XNDTOOLS_SCRATCH_MIN_SHIFT 6  /* smallest bucket is 64 bytes */
+#define XNDTOOLS_SCRATCH_NBUCKETS 21  /* largest bucket is 64 MB */
+#define XNDTOOLS_SCRATCH_SLOTS 4      /* number of cached buffers per bucket */
+#define XNDTOOLS_SCRATCH_HEADER 16    /* keeps buffers 16-byte aligned */
+
+typedef struct {
+  char* buffers[XNDTOOLS_SCRATCH_NBUCKETS][XNDTOOLS_SCRATCH_SLOTS];
+  int count[XNDTOOLS_SCRATCH_NBUCKETS];
+  int64_t nbytes;
+} xndtools_scratch_pool_t;
+
+static XNDTOOLS_THREAD_LOCAL xndtools_scratch_pool_t* xndtools_scratch_pool = NULL;
+static int64_t xndtools_scratch_limit = ((int64_t)64) << 20;
+static int64_t xndtools_scratch_nbytes = 0;  /* cached in all pools, updated with xndtools_atomic_add */
+
+static int64_t xndtools_scratch_pool_clear(xndtools_scratch_pool_t* pool) {
+  int64_t nbytes = pool->nbytes;
+  for (int k=0; k<XNDTOOLS_SCRATCH_NBUCKETS; k++) {
+    while (pool->count[k] > 0)
+      free(pool->buffers[k][--pool->count[k]]);
+  }
+  pool->nbytes = 0;
+  xndtools_atomic_add(&xndtools_scratch_nbytes, -nbytes);
+  return nbytes;
+}
+
+/*
+  Deallocate the cached buffers of the calling thread when these
+  exceed nbytes bytes. Return the number of bytes released.
+ */
+static int64_t xndtools_scratch_trim(int64_t nbytes) {
+  xndtools_scratch_pool_t* pool = xndtools_scratch_pool;
+  if (pool == NULL || pool->nbytes <= nbytes)
+    return 0;
+  return xndtools_scratch_pool_clear(pool);
+}
+
+#ifndef _WIN32
+static int64_t xndtools_parallel_trim(int64_t nbytes);
+#endif
+
+/*
+  Thread exit destructor of the pool.
+ */
+static void xndtools_scratch_pool_del(void* pool) {
+  xndtools_scratch_pool_clear((xndtools_scratch_pool_t*)pool);
+  free(pool);
+  xndtools_scratch_pool = NULL;
+}
+
+#ifdef _WIN32
+static INIT_ONCE xndtools_scratch_once = INIT_ONCE_STATIC_INIT;
+static DWORD xndtools_scratch_key = FLS_OUT_OF_INDEXES;
+
+static void WINAPI xndtools_scratch_pool_exit(PVOID pool) {
+  if (pool != NULL)
+    xndtools_scratch_pool_del(pool);
+}
+
+static BOOL CALLBACK xndtools_scratch_key_create(PINIT_ONCE once, PVOID param, PVOID* context) {
+  (void)once;
+  (void)param;
+  (void)context;
+  xndtools_scratch_key = FlsAlloc(xndtools_scratch_pool_exit);
+  return TRUE;
+}
+
+static int xndtools_scratch_register(xndtools_scratch_pool_t* pool) {
+  InitOnceExecuteOnce(&xndtools_scratch_once, xndtools_scratch_key_create, NULL, NULL);
+  if (xndtools_scratch_key == FLS_OUT_OF_INDEXES || !FlsSetValue(xndtools_scratch_key, pool))
+    return -1;
+  return 0;
+}
+#else
+static pthread_once_t xndtools_scratch_once = PTHREAD_ONCE_INIT;
+static pthread_key_t xndtools_scratch_key;
+static int xndtools_scratch_key_status = -1;
+
+static void xndtools_scratch_key_create(void) {
+  xndtools_scratch_key_status = pthread_key_create(&xndtools_scratch_key, xndtools_scratch_pool_del);
+}
+
+static int xndtools_scratch_register(xndtools_scratch_pool_t* pool) {
+  pthread_once(&xndtools_scratch_once, xndtools_scratch_key_create);
+  if (xndtools_scratch_key_status != 0 || pthread_setspecific(xndtools_scratch_key, pool) != 0)
+    return -1;
+  return 0;
+}
+#endif
+
+/*
+  Return the pool of the calling thread, allocate the pool and
+  register its destructor when needed. Return NULL when this fails,
+  then buffers are not cached.
+ */
+static xndtools_scratch_pool_t* xndtools_scratch_pool_get(void) {
+  xndtools_scratch_pool_t* pool = xndtools_scratch_pool;
+  if (pool == NULL) {
+    pool = (xndtools_scratch_pool_t*)calloc(1, sizeof(xndtools_scratch_pool_t));
+    if (pool == NULL)
+      return NULL;
+    if (xndtools_scratch_register(pool) < 0) {
+      free(pool);
+      return NULL;
     }
-    return N * N1;
-  } else if (ndim==1) {
-    int64_t N = xnd_fixed_shape_at(stack_ptr, 0);
-    int64_t step = stack_ptr->type->Concrete.FixedDim.step * itemsize;
-    switch (itemsize) { // todo: check if assignment is faster than memcpy or not
-    case 1:
-      {
-	const int8_t* in = (const int8_t*)src;
-	for (int64_t i=0; i< N; i++)
-	  *(int8_t*)(ptr0+i*step) = in[i];
-	break;
-      }
-    case 2:
-      {
-	const int16_t* in = (const int16_t*)src;
-	for (int64_t i=0; i< N; i++)
-	  *(int16_t*)(ptr0+i*step) = in[i];
-	break;
-      }
-    case 4:
-      {
-	const int32_t* in = (const int32_t*)src;
-	for (int64_t i=0; i< N; i++)
-	  *(int32_t*)(ptr0+i*step) = in[i];
-	break;
-      }
-    case 8:
-      {
-	const int64_t* in = (const int64_t*)src;
-	for (int64_t i=0; i< N; i++)
-	  *(int64_t*)(ptr0+i*step) = in[i];
-	break;
-      }
-    default:
-      {
-	for (int64_t i=0; i< N; i++)
-	  memcpy(ptr0+i*step, src+i*itemsize, itemsize);
+    xndtools_scratch_pool = pool;
+  }
+  return pool;
+}
+
+static int xndtools_scratch_bucket(int64_t nbytes) {
+  int k = 0;
+  while ((((int64_t)1) << (k + XNDTOOLS_SCRATCH_MIN_SHIFT)) < nbytes)
+    k++;
+  return k;
+}
+
+/*
+  Return a buffer of at least nbytes bytes. Return NULL when memory
+  allocation fails. The buffer must be deallocated using
+  xndtools_scratch_free.
+ */
+void* xndtools_scratch_alloc(int64_t nbytes) {
+  xndtools_scratch_pool_t* pool = xndtools_scratch_pool;
+  int k = xndtools_scratch_bucket(nbytes);
+  int64_t size = nbytes;
+  char* ptr = NULL;
+  if (k < XNDTOOLS_SCRATCH_NBUCKETS) {
+    size = ((int64_t)1) << (k + XNDTOOLS_SCRATCH_MIN_SHIFT);
+    if (pool != NULL && pool->count[k] > 0) {
+      ptr = pool->buffers[k][--pool->count[k]];
+      pool->nbytes -= size;
+      xndtools_atomic_add(&xndtools_scratch_nbytes, -size);
+      return ptr + XNDTOOLS_SCRATCH_HEADER;
+    }
+  }
+  ptr = (char*)malloc(size + XNDTOOLS_SCRATCH_HEADER);
+  if (ptr == NULL)
+    return NULL;
+  *(int*)ptr = k;
+  return ptr + XNDTOOLS_SCRATCH_HEADER;
+}
+
+/*
+  Return buffer to the pool of the calling thread. The buffer is
+  deallocated when the pool is full.
+ */
+void xndtools_scratch_free(void* buffer) {
+  xndtools_scratch_pool_t* pool;
+  char* ptr;
+  int k;
+  if (buffer == NULL)
+    return;
+  ptr = (char*)buffer - XNDTOOLS_SCRATCH_HEADER;
+  k = *(int*)ptr;
+  if (k < XNDTOOLS_SCRATCH_NBUCKETS) {
+    int64_t size = ((int64_t)1) << (k + XNDTOOLS_SCRATCH_MIN_SHIFT);
+    pool = (size <= xndtools_scratch_limit ? xndtools_scratch_pool_get() : NULL);
+    if (pool != NULL && pool->count[k] < XNDTOOLS_SCRATCH_SLOTS
+        && pool->nbytes + size <= xndtools_scratch_limit) {
+      pool->buffers[k][pool->count[k]++] = ptr;
+      pool->nbytes += size;
+      xndtools_atomic_add(&xndtools_scratch_nbytes, size);
+      return;
+    }
+  }
+  free(ptr);
+}
+
+/*
+  Deallocate the cached buffers of the calling thread and of the
+  worker threads of parallel kernels (waits for a running parallel
+  kernel to finish). Return the number of bytes released. The cached
+  buffers of other threads are released when these threads exit.
+ */
+int64_t xndtools_scratch_release(void) {
+  int64_t released = xndtools_scratch_trim(0);
+#ifndef _WIN32
+  released += xndtools_parallel_trim(0);
+#endif
+  return released;
+}
+
+/*
+  Set the high-water mark of cached buffers per thread (negative
+  value leaves the mark unchanged). Cached buffers of the calling
+  thread and of the worker threads of parallel kernels are released
+  when exceeding the new mark. Return the previous mark.
+ */
+int64_t xndtools_scratch_set_limit(int64_t nbytes) {
+  int64_t limit = xndtools_scratch_limit;
+  if (nbytes >= 0) {
+    xndtools_scratch_limit = nbytes;
+    xndtools_scratch_trim(nbytes);
+#ifndef _WIN32
+    xndtools_parallel_trim(nbytes);
+#endif
+  }
+  return limit;
+}
+
+/*
+  Return the number of bytes cached in the pools of all threads.
+ */
+int64_t xndtools_scratch_cached(void) {
+  return xndtools_atomic_load(&xndtools_scratch_nbytes);
+}
+
+/*
+  Kernel statistics.
+
+  Kernels generated with `stats: true` (or `build: instrumented`)
+  record the number of calls, the wall-clock time and the number of
+  bytes copied in and out of temporary arrays. A kernel calls
+  xndtools_kernel_stats_enter on entry and xndtools_kernel_stats_leave
+  on exit, the mark array holds the state at entry. Statistics are
+  updated atomically so that kernels can be called from several
+  threads.
+ */
+
+static int64_t xndtools_clock(void) {
+  struct timespec ts;
+  timespec_get(&ts, TIME_UTC);
+  return ((int64_t)ts.tv_sec) * 1000000000 + ts.tv_nsec;
+}
+
+void xndtools_kernel_stats_enter(int64_t* mark) {
+  mark[0] = xndtools_clock();
+  mark[1] = xndtools_copied_nbytes[0];
+  mark[2] = xndtools_copied_nbytes[1];
+}
+
+void xndtools_kernel_stats_leave(xndtools_kernel_stats_t* stats, const int64_t* mark) {
+  xndtools_atomic_add(&stats->calls, 1);
+  xndtools_atomic_add(&stats->time, xndtools_clock() - mark[0]);
+  xndtools_atomic_add(&stats->copied_in, xndtools_copied_nbytes[0] - mark[1]);
+  xndtools_atomic_add(&stats->copied_out, xndtools_copied_nbytes[1] - mark[2]);
+}
+
+/*
+  Reset the statistics of a NULL terminated list of kernels.
+ */
+void xndtools_kernel_stats_reset(xndtools_kernel_stats_t** stats) {
+  for (; *stats != NULL; stats++) {
+    xndtools_atomic_store(&(*stats)->calls, 0);
+    xndtools_atomic_store(&(*stats)->time, 0);
+    xndtools_atomic_store(&(*stats)->copied_in, 0);
+    xndtools_atomic_store(&(*stats)->copied_out, 0);
+  }
+}
+
+/*
+  Parallel map of kernels over the outer dimension.
+
+  Kernels generated with `parallel: threads` are registered with
+  `.vectorize = true`, so gumath calls them with one outer
+  (ellipsis) dimension at most. xndtools_parallel_map partitions the
+  outer dimension into chunks of at least min_chunk items that are
+  processed by a pool of worker threads and the calling thread. The
+  number of threads is read from the XNDTOOLS_NUM_THREADS environment
+  variable (default is the number of online processors), see also
+  xndtools_set_num_threads. On Windows, there is no thread pool and
+  the outer dimension is processed in the calling thread.
+ */
+
+typedef struct {
+  xndtools_xnd_kernel_t f;
+  xnd_t* stack;
+  int nargs;
+  int64_t n;
+  int64_t chunk;
+  int64_t next;    /* updated with xndtools_atomic_add */
+  int64_t status;
+  ndt_context_t* ctx;
+} xndtools_parallel_job_t;
+
+static int xndtools_num_threads = 0;
+
+static void xndtools_parallel_run(xndtools_parallel_job_t* job) {
+  xnd_t next[NDT_MAX_ARGS];
+  NDT_STATIC_CONTEXT(ctx);
+  for (;;) {
+    int64_t start = xndtools_atomic_add(&job->next, job->chunk);
+    if (start >= job->n || xndtools_atomic_load(&job->status) != 0)
+      return;
+    int64_t stop = (start + job->chunk < job->n ? start + job->chunk : job->n);
+    for (int64_t i=start; i<stop; i++) {
+      for (int k=0; k<job->nargs; k++)
+	next[k] = xnd_fixed_dim_next(&job->stack[k], i);
+      if (job->f(next, &ctx) < 0) {
+	if (xndtools_atomic_cas(&job->status, 0, -1))
+	  ndt_err_format(job->ctx, ctx.err, "%s", ndt_context_msg(&ctx));
+	ndt_err_clear(&ctx);
+	return;
       }
     }
-    return N*itemsize;
   }
-  return -1;
 }
 
+#ifndef _WIN32
+static struct {
+  pthread_mutex_t lock;
+  pthread_cond_t wake;
+  pthread_cond_t done;
+  int nworkers;  /* number of started worker threads */
+  int wanted;    /* number of workers the current job still accepts */
+  int running;   /* number of workers processing the current job */
+  xndtools_parallel_job_t* job;
+  pthread_cond_t trimmed;
+  int64_t trim;         /* generation of scratch trim requests */
+  int64_t trim_nbytes;  /* high-water mark of the current trim request */
+  int64_t released;     /* number of bytes released by the current trim request */
+  int pending;          /* number of workers still to trim their scratch pools */
+} xndtools_pool = {PTHREAD_MUTEX_INITIALIZER, PTHREAD_COND_INITIALIZER, PTHREAD_COND_INITIALIZER, 0, 0, 0, NULL,
+                   PTHREAD_COND_INITIALIZER, 0, 0, 0, 0};
+
+static pthread_mutex_t xndtools_pool_submit = PTHREAD_MUTEX_INITIALIZER;
+
+/*
+  Trim the scratch pool of the calling worker thread (pool lock is
+  held).
+ */
+static void xndtools_parallel_trimmed(int64_t nbytes) {
+  xndtools_pool.released += xndtools_scratch_trim(nbytes);
+  if (--xndtools_pool.pending == 0)
+    pthread_cond_signal(&xndtools_pool.trimmed);
+}
+
+static void* xndtools_parallel_worker(void* arg) {
+  (void)arg;
+  pthread_mutex_lock(&xndtools_pool.lock);
+  int64_t trim = xndtools_pool.trim;
+  /* the worker is counted by a trim request issued before it started */
+  if (xndtools_pool.pending > 0)
+    xndtools_parallel_trimmed(xndtools_pool.trim_nbytes);
+  for (;;) {
+    while (xndtools_pool.wanted == 0 && xndtools_pool.trim == trim)
+      pthread_cond_wait(&xndtools_pool.wake, &xndtools_pool.lock);
+    if (xndtools_pool.trim != trim) {
+      trim = xndtools_pool.trim;
+      xndtools_parallel_trimmed(xndtools_pool.trim_nbytes);
+      continue;
+    }
+    xndtools_parallel_job_t* job = xndtools_pool.job;
+    xndtools_pool.wanted--;
+    xndtools_pool.running++;
+    pthread_mutex_unlock(&xndtools_pool.lock);
+    xndtools_parallel_run(job);
+    pthread_mutex_lock(&xndtools_pool.lock);
+    if (--xndtools_pool.running == 0)
+      pthread_cond_signal(&xndtools_pool.done);
+  }
+  return NULL;
+}
+
+/*
+  Process the job by nthreads - 1 workers and the calling thread.
+  Return -1 when the pool is busy (a kernel calls a parallel kernel).
+ */
+static int xndtools_parallel_submit(xndtools_parallel_job_t* job, int nthreads) {
+  if (pthread_mutex_trylock(&xndtools_pool_submit) != 0)
+    return -1;
+  pthread_mutex_lock(&xndtools_pool.lock);
+  while (xndtools_pool.nworkers < nthreads - 1) {
+    pthread_t thread;
+    if (pthread_create(&thread, NULL, xndtools_parallel_worker, NULL) != 0)
+      break;
+    pthread_detach(thread);
+    xndtools_pool.nworkers++;
+  }
+  xndtools_pool.job = job;
+  xndtools_pool.wanted = (nthreads - 1 < xndtools_pool.nworkers ? nthreads - 1 : xndtools_pool.nworkers);
+  pthread_cond_broadcast(&xndtools_pool.wake);
+  pthread_mutex_unlock(&xndtools_pool.lock);
+  xndtools_parallel_run(job);
+  pthread_mutex_lock(&xndtools_pool.lock);
+  xndtools_pool.wanted = 0;
+  while (xndtools_pool.running > 0)
+    pthread_cond_wait(&xndtools_pool.done, &xndtools_pool.lock);
+  xndtools_pool.job = NULL;
+  pthread_mutex_unlock(&xndtools_pool.lock);
+  pthread_mutex_unlock(&xndtools_pool_submit);
+  return 0;
+}
+
+/*
+  Request the workers to release their cached scratch buffers when
+  these exceed nbytes bytes and wait until they are done (a running
+  job is finished first). Return the number of bytes released.
+ */
+static int64_t xndtools_parallel_trim(int64_t nbytes) {
+  int64_t released;
+  pthread_mutex_lock(&xndtools_pool_submit);
+  pthread_mutex_lock(&xndtools_pool.lock);
+  xndtools_pool.trim++;
+  xndtools_pool.trim_nbytes = nbytes;
+  xndtools_pool.released = 0;
+  xndtools_pool.pending = xndtools_pool.nworkers;
+  pthread_cond_broadcast(&xndtools_pool.wake);
+  while (xndtools_pool.pending > 0)
+    pthread_cond_wait(&xndtools_pool.trimmed, &xndtools_pool.lock);
+  released = xndtools_pool.released;
+  pthread_mutex_unlock(&xndtools_pool.lock);
+  pthread_mutex_unlock(&xndtools_pool_submit);
+  return released;
+}
+#endif
+
+/*
+  Return the number of threads used by parallel kernels.
+ */
+int xndtools_get_num_threads(void) {
+  if (xndtools_num_threads <= 0) {
+    const char* value = getenv("XNDTOOLS_NUM_THREADS");
+    int n = (value != NULL ? atoi(value) : 0);
+#ifdef _WIN32
+    if (n <= 0) {
+      SYSTEM_INFO info;
+      GetSystemInfo(&info);
+      n = (int)info.dwNumberOfProcessors;
+    }
+#else
+    if (n <= 0)
+      n = (int)sysconf(_SC_NPROCESSORS_ONLN);
+#endif
+    xndtools_num_threads = (n > 0 ? n : 1);
+  }
+  return xndtools_num_threads;
+}
+
+/*
+  Set the number of threads used by parallel kernels (non-positive
+  value leaves the number unchanged). Return the previous number.
+ */
+int xndtools_set_num_threads(int nthreads) {
+  int previous = xndtools_get_num_threads();
+  if (nthreads > 0)
+    xndtools_num_threads = nthreads;
+  return previous;
+}
+
+/*
+  Apply kernel f to stack. When the rank of the first stack item is
+  larger than inner_ndim, apply f to all items of the outer dimension
+  in parallel. Return 0 on success, -1 on failure (error is set in
+  ctx).
+ */
+int xndtools_parallel_map(xndtools_xnd_kernel_t f, xnd_t stack[], int nargs, int inner_ndim, int64_t min_chunk, ndt_context_t* ctx) {
+  if (nargs == 0 || stack[0].type->ndim <= inner_ndim)
+    return f(stack, ctx);
+  for (int k=0; k<nargs; k++)
+    if (stack[k].type->tag != FixedDim || stack[k].type->FixedDim.shape != stack[0].type->FixedDim.shape) {
+      ndt_err_format(ctx, NDT_RuntimeError, "type or shape mismatch in outer dimensions");
+      return -1;
+    }
+  xndtools_parallel_job_t job;
+  job.f = f;
+  job.stack = stack;
+  job.nargs = nargs;
+  job.n = stack[0].type->FixedDim.shape;
+  job.chunk = (min_chunk > 0 ? min_chunk : 1);
+  job.next = 0;
+  job.status = 0;
+  job.ctx = ctx;
+#ifndef _WIN32
+  int64_t nchunks = (job.n + job.chunk - 1) / job.chunk;
+  int nthreads = xndtools_get_num_threads();
+  if (nchunks < nthreads)
+    nthreads = (int)nchunks;
+  if (nthreads > 1 && xndtools_parallel_submit(&job, nthreads) == 0)
+    return (int)xndtools_atomic_load(&job.status);
+#endif
+  job.chunk = job.n;
+  xndtools_parallel_run(&job);
+  return (int)xndtools_atomic_load(&job.status);
+}
 
+/*
+  Apply kernel f to all items of the outer dimension of stack in the
+  calling thread. Return 0 on success, -1 on failure.
+ */
+int xndtools_outer_map(xndtools_xnd_kernel_t f, xnd_t stack[], int nargs, int inner_ndim, ndt_context_t* ctx) {
+  xnd_t next[NDT_MAX_ARGS];
+  if (nargs == 0 || stack[0].type->ndim <= inner_ndim)
+    return f(stack, ctx);
+  for (int k=0; k<nargs; k++)
+    if (stack[k].type->tag != FixedDim || stack[k].type->FixedDim.shape != stack[0].type->FixedDim.shape) {
+      ndt_err_format(ctx, NDT_RuntimeError, "type or shape mismatch in outer dimensions");
+      return -1;
+    }
+  for (int64_t i=0; i<stack[0].type->FixedDim.shape; i++) {
+    for (int k=0; k<nargs; k++)
+      next[k] = xnd_fixed_dim_next(&stack[k], i);
+    if (f(next, ctx) < 0)
+      return -1;
+  }
+  return 0;
+}
+
+/*
+  Fuse the outer dimension of stack items with their only inner
+  dimension: when all items are non-empty C-contiguous `m * n * T`
+  arrays with equal m and n, fill fused with `m*n * T` views of the
+  items and return 1 (the views are released with
+  xndtools_fused_del). Otherwise, return 0, or -1 on failure.
+ */
+int xndtools_fuse_outer(xnd_t fused[], const xnd_t stack[], int nargs, ndt_context_t* ctx) {
+  if (nargs == 0)
+    return 0;
+  for (int k=0; k<nargs; k++) {
+    const ndt_t* t = stack[k].type;
+    if (t->ndim != 2 || t->tag != FixedDim || t->FixedDim.type->tag != FixedDim
+        || t->FixedDim.shape != stack[0].type->FixedDim.shape
+        || t->FixedDim.type->FixedDim.shape != stack[0].type->FixedDim.type->FixedDim.shape
+        || t->FixedDim.shape == 0 || t->FixedDim.type->FixedDim.shape == 0
+        || !ndt_is_c_contiguous(t))
+      return 0;
+  }
+  for (int k=0; k<nargs; k++) {
+    const ndt_t* t = stack[k].type;
+    ndt_t* dtype = ndt_copy(t->FixedDim.type->FixedDim.type, ctx);
+    ndt_t* u = (dtype == NULL ? NULL : ndt_fixed_dim(dtype, t->FixedDim.shape * t->FixedDim.type->FixedDim.shape, INT64_MAX, ctx));
+    if (u == NULL) {
+      xndtools_fused_del(fused, k);
+      return -1;
+    }
+    fused[k] = stack[k];
+    fused[k].type = u;
+  }
+  return 1;
+}
+
+void xndtools_fused_del(xnd_t fused[], int nargs) {
+  for (int k=0; k<nargs; k++)
+    ndt_del((ndt_t*)fused[k].type);
+}
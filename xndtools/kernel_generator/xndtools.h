@@ -1,5 +1,39 @@
 
 #include "xnd.h"
+
+/*
+  Thread-local storage and atomic updates of int64_t counters. MSVC
+  (VS2015) has neither C11 _Thread_local nor <stdatomic.h>, so the
+  runtime and the generated kernels use these macros.
+ */
+#if defined(_MSC_VER)
+#include <intrin.h>
+#define XNDTOOLS_THREAD_LOCAL __declspec(thread)
+static __inline int64_t xndtools_atomic_add(volatile int64_t* ptr, int64_t value) {
+  int64_t old;
+  do {
+    old = *ptr;
+  } while (_InterlockedCompareExchange64((volatile __int64*)ptr, old + value, old) != old);
+  return old;
+}
+#define xndtools_atomic_load(ptr) _InterlockedCompareExchange64((volatile __int64*)(ptr), 0, 0)
+static __inline void xndtools_atomic_store(volatile int64_t* ptr, int64_t value) {
+  int64_t old;
+  do {
+    old = *ptr;
+  } while (_InterlockedCompareExchange64((volatile __int64*)ptr, value, old) != old);
+}
+#define xndtools_atomic_cas(ptr, expected, desired) (_InterlockedCompareExchange64((volatile __int64*)(ptr), (desired), (expected)) == (expected))
+#else
+#define XNDTOOLS_THREAD_LOCAL _Thread_local
+#define xndtools_atomic_add(ptr, value) __atomic_fetch_add((ptr), (value), __ATOMIC_RELAXED)
+#define xndtools_atomic_load(ptr) __atomic_load_n((ptr), __ATOMIC_RELAXED)
+#define xndtools_atomic_store(ptr, value) __atomic_store_n((ptr), (value), __ATOMIC_RELAXED)
+static inline bool xndtools_atomic_cas(int64_t* ptr, int64_t expected, int64_t desired) {
+  return __atomic_compare_exchange_n(ptr, &expected, desired, false, __ATOMIC_SEQ_CST, __ATOMIC_SEQ_CST);
+}
+#endif
+
 extern int64_t xndtools_fixed_nbytes(const xnd_t* stack_ptr);
 extern int xndtools_cpy(char* dest, const xnd_t* stack_ptr, bool fortran);
 extern char* xndtools_copy(const xnd_t* stack_ptr, ndt_context_t *ctx);
@@ -12,3 +46,37 @@ inline int xndtools_inv_copy(const char* src, const xnd_t* stack_ptr) {
 inline int xndtools_inv_fcopy(const char* src, const xnd_t* stack_ptr) {
   return xndtools_invcpy(src, stack_ptr, true);
 }
+
+extern int64_t xndtools_strided_nbytes(int ndim, const intptr_t* dimensions, int64_t itemsize);
+extern bool xndtools_strided_is_contiguous(int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran);
+extern int64_t xndtools_strided_cpy(char* dest, const char* src, int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran);
+extern int64_t xndtools_strided_invcpy(const char* src, char* dest, int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran);
+extern char* xndtools_strided_copy(const char* src, int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran);
+extern int64_t xndtools_strided_stride(int ndim, const intptr_t* dimensions, const intptr_t* steps, int64_t itemsize, bool fortran, bool contiguous);
+extern int64_t xndtools_fixed_stride(const xnd_t* stack_ptr, bool fortran, bool contiguous);
+
+extern void* xndtools_scratch_alloc(int64_t nbytes);
+extern void xndtools_scratch_free(void* buffer);
+extern int64_t xndtools_scratch_release(void);
+extern int64_t xndtools_scratch_set_limit(int64_t nbytes);
+extern int64_t xndtools_scratch_cached(void);
+
+typedef struct {
+  const char* name;
+  int64_t calls;      /* updated with xndtools_atomic_add */
+  int64_t time;       /* nanoseconds */
+  int64_t copied_in;  /* bytes */
+  int64_t copied_out; /* bytes */
+} xndtools_kernel_stats_t;
+
+extern void xndtools_kernel_stats_enter(int64_t* mark);
+extern void xndtools_kernel_stats_leave(xndtools_kernel_stats_t* stats, const int64_t* mark);
+extern void xndtools_kernel_stats_reset(xndtools_kernel_stats_t** stats);
+
+typedef int (*xndtools_xnd_kernel_t)(xnd_t stack[], ndt_context_t *ctx);
+extern int xndtools_get_num_threads(void);
+extern int xndtools_set_num_threads(int nthreads);
+extern int xndtools_parallel_map(xndtools_xnd_kernel_t f, xnd_t stack[], int nargs, int inner_ndim, int64_t min_chunk, ndt_context_t* ctx);
+extern int xndtools_outer_map(xndtools_xnd_kernel_t f, xnd_t stack[], int nargs, int inner_ndim, ndt_context_t* ctx);
+extern int xndtools_fuse_outer(xnd_t fused[], const xnd_t stack[], int nargs, ndt_context_t* ctx);
+extern void xndtools_fused_del(xnd_t fused[], int nargs);
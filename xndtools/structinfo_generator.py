@@ -124,7 +124,12 @@ def generate(args):
         include = c_utils.find_include(include, include_dirs)
         source.append('#include "{}"'.format(include))
     source = '\n'.join(source)
-    source = c_utils.preprocess(source, include_dirs=include_dirs)
+    macros = dict((d.split('=', 1) + [None])[:2]
+                  for d in getattr(args, 'define', None) or [])
+    source = c_utils.preprocess(source, include_dirs=include_dirs,
+                                use_compiler=getattr(args, 'cpp', False),
+                                macros=macros,
+                                cache_dir=getattr(args, 'cache_dir', None))
     print(source)
     structs = c_utils.get_structs(source)
     lines = ['/* This file is generated using structinfo_generator from the xndtools project */']